@@ -1,12 +1,17 @@
 import logging
+import os
+import os.path
+import shutil
 import signal
 import sys
+import tempfile
 
 import tornado.httpserver
+import tornado.netutil
 from tornado.gen import coroutine, with_timeout, TimeoutError
 from tornado.options import options, parse_command_line
 
-from . import linger
+from . import linger, workers
 
 
 def handle_signals(http_server, shutdown_callback=None):
@@ -50,11 +55,193 @@ def handle_signals(http_server, shutdown_callback=None):
     signal.signal(signal.SIGTERM, sdcb)
 
 
+def max_body_size():
+    """Get the max request body size, allowing for (URL-encoded) messages
+    of up to msg_max_size bytes
+    """
+    return max(100 * 1024 * 1024, 3 * options.msg_max_size)
+
+
+def stop_processes(pids):
+    """Terminate the processes, and wait for them to exit"""
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    for pid in pids:
+        os.waitpid(pid, 0)
+
+
+def run_owner(path, pids=(), tmpdir=None):
+    """Run a queue owner process, serving the queue to the workers (and
+    stopping the pids processes, and removing tmpdir, on shutdown)
+    """
+    queue = linger.make_queue()
+    queue_server = workers.QueueServer(queue)
+    queue_server.add_socket(tornado.netutil.bind_unix_socket(path, 0o600))
+    logging.info('Serving the queue at {}'.format(path))
+
+    io_loop = tornado.ioloop.IOLoop.current()
+
+    def on_shutdown():
+        logging.info('Initiating shutdown')
+        stop_processes(pids)
+        queue_server.stop()
+        queue.stop()
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        io_loop.stop()
+        logging.info('Shutdown completed')
+
+    def sdcb(sig, frame):
+        """handle SIGTERM (kill) and SIGINT (Ctrl-C) signals"""
+        return io_loop.add_callback_from_signal(on_shutdown)
+
+    signal.signal(signal.SIGINT, sdcb)
+    signal.signal(signal.SIGTERM, sdcb)
+
+    io_loop.start()
+
+
+def run_worker(paths, pids=(), tmpdir=None):
+    """Run a worker process, serving HTTP with the queue of the owner (or
+    the queue shards), stopping the pids processes, and removing tmpdir,
+    on shutdown
+    """
+    io_loop = tornado.ioloop.IOLoop.current()
+    proxies = [workers.QueueProxy(path) for path in paths]
+    for proxy in proxies:
+        io_loop.run_sync(proxy.connect)
+    if len(proxies) == 1:
+        queue = proxies[0]
+    else:
+        queue = workers.ShardedQueue(proxies)
+        io_loop.run_sync(queue.sync_routes)
+    application, settings = linger.make_app(queue)
+    http_server = tornado.httpserver.HTTPServer(
+        application, xheaders=not options.debug,
+        max_body_size=max_body_size())
+    http_server.add_sockets(
+        tornado.netutil.bind_sockets(options.port, reuse_port=True))
+
+    # stop when an owner is gone
+    for proxy in proxies:
+        proxy.on_close = lambda: io_loop.add_callback(sys.exit, 1)
+
+    def shutdown():
+        queue.stop()
+        stop_processes(pids)
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    handle_signals(http_server, shutdown)
+
+    io_loop.start()
+
+
+def run_supervisor(pids, tmpdir):
+    """Wait for SIGINT or SIGTERM, and stop the processes"""
+    def sdcb(sig, frame):
+        """handle SIGTERM (kill) and SIGINT (Ctrl-C) signals"""
+        logging.info('Initiating shutdown')
+        stop_processes(pids)
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        logging.info('Shutdown completed')
+        sys.exit(0)
+
+    signal.signal(signal.SIGINT, sdcb)
+    signal.signal(signal.SIGTERM, sdcb)
+    while True:
+        signal.pause()
+
+
+def fork(target, *args):
+    """Run the target function in a child process, returns the pid"""
+    pid = os.fork()
+    if pid == 0:
+        try:
+            target(*args)
+        finally:
+            os._exit(0)
+    return pid
+
+
+def check_shards(dbdir):
+    """Create the shard database directory, and exit if it was created for
+    another number of shards (or is a database file)
+    """
+    if os.path.exists(dbdir) and not os.path.isdir(dbdir):
+        logging.error('The database {} is a file, with --shards the dbfile '
+                      'is a directory of shard databases'.format(dbdir))
+        sys.exit(1)
+    os.makedirs(dbdir, exist_ok=True)
+    path = os.path.join(dbdir, 'shards')
+    if os.path.exists(path):
+        with open(path) as fh:
+            shards = int(fh.read())
+        if shards != options.shards:
+            logging.error('The database directory {} has {} shards, '
+                          'expected {}'.format(dbdir, shards, options.shards))
+            sys.exit(1)
+    else:
+        with open(path, 'w') as fh:
+            fh.write('{}\n'.format(options.shards))
+
+
+def run_shard(path, dbfile):
+    """Run a queue shard process"""
+    options.dbfile = dbfile
+    run_owner(path)
+
+
+def main_processes():
+    """Fork the worker processes (and shard processes), and run the queue
+    owner (or the HTTP server, or a supervisor of the processes)
+    """
+    tmpdir = tempfile.mkdtemp(prefix='linger-')
+    pids = []
+    if options.shards > 1:
+        dbdir = options.dbfile
+        if dbdir != ':memory:':
+            check_shards(dbdir)
+        paths = []
+        for i in range(options.shards):
+            paths.append(os.path.join(tmpdir, 'shard-{}.sock'.format(i)))
+            dbfile = dbdir if dbdir == ':memory:' else os.path.join(
+                dbdir, 'shard-{}.db'.format(i))
+            pids.append(fork(run_shard, paths[-1], dbfile))
+        logging.info('Started {} queue shards'.format(options.shards))
+    else:
+        paths = [os.path.join(tmpdir, 'queue.sock')]
+
+    worker_pids = [fork(run_worker, paths)
+                   for _ in range(options.workers)]
+    if worker_pids:
+        logging.info('Starting {} workers at port {}'.format(
+            len(worker_pids), options.port))
+
+    if options.shards <= 1:
+        run_owner(paths[0], worker_pids, tmpdir)
+    elif worker_pids:
+        # workers are stopped before the shards
+        run_supervisor(worker_pids + pids, tmpdir)
+    else:
+        logging.info('Starting server at port {}'.format(options.port))
+        run_worker(paths, pids, tmpdir)
+
+
 def main():
     parse_command_line()
+    if options.workers > 0 or options.shards > 1:
+        linger.check_options()
+        main_processes()
+        return
+
     application, settings = linger.make_app()
     http_server = tornado.httpserver.HTTPServer(
-        application, xheaders=not options.debug)
+        application, xheaders=not options.debug,
+        max_body_size=max_body_size())
     http_server.listen(options.port)
     logging.info('Starting server at port %d' % options.port)
     if options.debug:
@@ -0,0 +1,558 @@
+"""Linger - Benchmarks
+
+Copyright 2015-2018 Nephics AB
+Licensed under the Apache License, Version 2.0
+"""
+
+import argparse
+import json
+import os
+import os.path
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import tornado.httpserver
+import tornado.ioloop
+
+from tornado.gen import coroutine, multi, sleep
+from tornado.httpclient import AsyncHTTPClient
+from tornado.options import options
+from tornado.testing import bind_unused_port
+
+from . import linger
+
+
+def percentiles(values, points=(50, 99, 99.9)):
+    """Get a mapping of 'p<point>' -> percentile of the values"""
+    values = sorted(values)
+    res = {}
+    for p in points:
+        key = 'p{}'.format(str(p).replace('.', ''))
+        if not values:
+            res[key] = None
+            continue
+        i = min(int(len(values) * p / 100.0), len(values) - 1)
+        res[key] = values[i]
+    return res
+
+
+def rss_kb(pid=None):
+    """Get the resident set size (in KB) of a process (Linux only), or None
+    """
+    try:
+        with open('/proc/{}/status'.format(pid or 'self')) as fh:
+            for line in fh:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def fill_backlog(queue, chan_name, count, batch=10000, body='backlog'):
+    """Insert a backlog of ready messages directly into the database"""
+    queue.db.flush()
+    now = time.time()
+    row = (body, 'text/plain', '', 30, 0, chan_name, now, 0, 0, 0, 0, 0.0,
+           len(body))
+    while count > 0:
+        n = min(batch, count)
+        queue.db.executemany(
+            'insert into messages (body, mimetype, topic, timeout, priority,'
+            'channel, ts, linger, purge, deliver, dcount, show, size) values '
+            '(?,?,?,?,?,?,?,?,?,?,?,?,?)', (row for _ in range(n)))
+        queue.db.commit()
+        count -= n
+
+
+@coroutine
+def bench_backlog(sizes, ops, dbfile, engine='sqlite'):
+    """Measure per-request latency of add/get/delete with a growing backlog
+    in another channel, and in the same channel.
+    """
+    results = []
+    queue_class = linger.engines[engine]
+    queue = queue_class(dbfile)
+    try:
+        filled = 0
+        for size in sizes:
+            fill_backlog(queue, 'backlog', size - filled)
+            filled = size
+            # reopen the queue, to restore the backlog
+            queue.stop()
+            t0 = time.perf_counter()
+            queue = queue_class(dbfile)
+            res = {'size': size, 'engine': engine,
+                   'restore-s': round(time.perf_counter() - t0, 3)}
+            for chan_name in ('empty', 'backlog'):
+                t_add = t_get = t_del = 0.0
+                for _ in range(ops):
+                    t0 = time.perf_counter()
+                    queue.add_message(chan_name, 'msg', 'text/plain',
+                                      priority=-1, timeout=30, deliver=0,
+                                      linger=0)
+                    t1 = time.perf_counter()
+                    msg = yield queue.get_message(chan_name, nowait=True)
+                    t2 = time.perf_counter()
+                    queue.delete_message_from_id(msg['id'])
+                    t3 = time.perf_counter()
+                    t_add += t1 - t0
+                    t_get += t2 - t1
+                    t_del += t3 - t2
+                res[chan_name] = {
+                    'add-us': round(t_add / ops * 1e6, 1),
+                    'get-us': round(t_get / ops * 1e6, 1),
+                    'delete-us': round(t_del / ops * 1e6, 1)
+                }
+            t0 = time.perf_counter()
+            queue.heartbeat()
+            res['heartbeat-us'] = round((time.perf_counter() - t0) * 1e6, 1)
+            results.append(res)
+            print(json.dumps(res), flush=True)
+    finally:
+        queue.stop()
+    return results
+
+
+def bench_startup(sizes_mb, dbfile, engine, body_size, full_vacuum):
+    """Measure the startup time with database files of the sizes (in MB),
+    with half of the messages deleted (leaving free pages), and optionally
+    the time of a full vacuum on start
+    """
+    results = []
+    queue_class = linger.engines[engine]
+    body = 'x' * body_size
+    for size_mb in sizes_mb:
+        if os.path.exists(dbfile):
+            os.remove(dbfile)
+        queue = queue_class(dbfile)
+        count = size_mb * 1024 * 1024 // (body_size + 100)
+        fill_backlog(queue, 'startup', count, batch=1000, body=body)
+        queue.db.execute('delete from messages where id % 2 = 0')
+        queue.db.commit()
+        queue.stop()
+        res = {'size-mb': size_mb, 'engine': engine, 'messages': count,
+               'db-size-mb': os.path.getsize(dbfile) // (1024 * 1024)}
+
+        t0 = time.perf_counter()
+        queue = queue_class(dbfile)
+        res['startup-s'] = round(time.perf_counter() - t0, 3)
+        res['free-mb'] = queue.db.free_bytes() // (1024 * 1024)
+        queue.stop()
+
+        if full_vacuum:
+            t0 = time.perf_counter()
+            queue = queue_class(dbfile, vacuum=True)
+            res['startup-full-vacuum-s'] = round(time.perf_counter() - t0, 3)
+            queue.stop()
+        results.append(res)
+        print(json.dumps(res), flush=True)
+    return results
+
+
+@coroutine
+def bench_lag(dbfile, engine, db_thread, rounds, batch):
+    """Measure the IOLoop lag (the delay of timers and long-poll wake-ups)
+    while adding and draining batches of messages
+    """
+    queue = linger.engines[engine](dbfile, commit_interval=10,
+                                   db_thread=db_thread)
+    interval = 0.005
+    lags = []
+    state = {'run': True}
+
+    @coroutine
+    def probe():
+        while state['run']:
+            t0 = time.perf_counter()
+            yield sleep(interval)
+            lags.append(time.perf_counter() - t0 - interval)
+
+    msg = {'body': 'x' * 200, 'mime_type': 'text/plain', 'priority': 0,
+           'timeout': 30, 'deliver': 0, 'linger': 0}
+    try:
+        probing = probe()
+        t0 = time.perf_counter()
+        for _ in range(rounds):
+            queue.add_messages('bench', [msg] * batch)
+            yield sleep(0.05)
+            queue.drain_channel('bench')
+            yield sleep(0.05)
+        yield queue.durable()
+        elapsed = time.perf_counter() - t0
+        state['run'] = False
+        yield probing
+    finally:
+        queue.stop()
+    res = {'engine': engine, 'db-thread': db_thread,
+           'msgs-per-s': int(rounds * batch / elapsed),
+           'lag-max-ms': round(max(lags) * 1e3, 2)}
+    res.update({'lag-{}-ms'.format(k): round(v * 1e3, 2)
+                for k, v in percentiles(lags).items()})
+    print(json.dumps(res), flush=True)
+    return res
+
+
+@coroutine
+def bench_ingest(dbfile, engine, count, batch, size, commit_interval,
+                 db_thread):
+    """Measure the ingest rate (adding batches, waiting for each to be
+    durable), the restart (restore) time with the ingested backlog, and the
+    rate of taking and deleting the backlog
+    """
+    def open_queue():
+        return linger.engines[engine](dbfile, commit_interval=commit_interval,
+                                      db_thread=db_thread)
+
+    def db_size():
+        return sum(os.path.getsize(os.path.join(path, name))
+                   for path, _, names in os.walk(os.path.dirname(dbfile))
+                   for name in names)
+
+    msg = {'body': 'x' * size, 'mime_type': 'text/plain', 'priority': 0,
+           'timeout': 30, 'deliver': 0, 'linger': 0}
+    queue = open_queue()
+    try:
+        t0 = time.perf_counter()
+        for i in range(0, count, batch):
+            queue.add_messages('bench', [msg] * min(batch, count - i))
+            yield queue.durable()
+        ingest = time.perf_counter() - t0
+        queue.stop()
+        res = {'engine': engine, 'count': count, 'batch': batch,
+               'ingest-msgs-per-s': int(count / ingest),
+               'db-size-kb': db_size() // 1024}
+
+        t0 = time.perf_counter()
+        queue = open_queue()
+        res['restore-s'] = round(time.perf_counter() - t0, 3)
+
+        t0 = time.perf_counter()
+        while True:
+            msgs = queue.take_messages('bench', batch)
+            if not msgs:
+                break
+            queue.delete_messages_from_ids([m['id'] for m in msgs])
+            yield queue.durable()
+        res['consume-msgs-per-s'] = int(count / (time.perf_counter() - t0))
+    finally:
+        queue.stop()
+    print(json.dumps(res), flush=True)
+    return res
+
+
+def start_server(args):
+    """Start a Linger server in-process, or in a subprocess, returns the
+    (base url, subprocess or None, stop function)
+    """
+    sock, port = bind_unused_port()
+    url = 'http://127.0.0.1:{}'.format(port)
+    server_options = {
+        'engine': args.engine,
+        'dbfile': args.dbfile,
+        'commit_ack': args.commit_ack,
+        'commit_interval_ms': args.commit_interval_ms,
+        'db_thread': args.db_thread,
+        'db_profile': args.db_profile
+    }
+    if args.subprocess:
+        sock.close()
+        cmd = [sys.executable, '-m', 'linger', '--port={}'.format(port),
+               '--logging=warning']
+        server_options['workers'] = args.workers
+        cmd.extend('--{}={}'.format(k, v) for k, v in server_options.items())
+        proc = subprocess.Popen(cmd)
+        return url, proc, proc.terminate
+
+    for k, v in server_options.items():
+        setattr(options, k, v)
+    application, settings = linger.make_app()
+    server = tornado.httpserver.HTTPServer(application)
+    server.add_sockets([sock])
+
+    def stop():
+        server.stop()
+        settings['shutdown_callback']()
+    return url, None, stop
+
+
+@coroutine
+def wait_for_server(client, url, timeout=10.0):
+    """Wait for the server to respond"""
+    deadline = time.time() + timeout
+    while True:
+        try:
+            resp = yield client.fetch(url + '/', raise_error=False)
+            if resp.code == 200:
+                return
+        except OSError:
+            # not yet listening
+            pass
+        if time.time() > deadline:
+            raise RuntimeError('Server not responding at {}'.format(url))
+        yield sleep(0.1)
+
+
+@coroutine
+def bench_http(args):
+    """Drive a mix of producers, consumers and publishers over HTTP,
+    measuring throughput and latency
+    """
+    url, proc, stop = start_server(args)
+    workers = args.producers + args.consumers + args.publishers
+    AsyncHTTPClient.configure(None, max_clients=workers + 2)
+    client = AsyncHTTPClient()
+    channels = ['bench{}'.format(i) for i in range(args.channels)]
+    latency = {'add': [], 'publish': [], 'get': [], 'e2e': []}
+    counts = {'added': 0, 'published': 0, 'consumed': 0, 'errors': 0}
+    pad = b'x' * args.size
+
+    def body():
+        # the add timestamp is sent in the message, for the e2e latency
+        return '{:.6f} '.format(time.time()).encode() + pad
+
+    try:
+        yield wait_for_server(client, url)
+        # each topic is delivered to fanout channels
+        for i in range(args.channels if args.publishers else 0):
+            for j in range(args.fanout):
+                yield client.fetch(
+                    '{}/channels/{}/topics/bench{}'.format(
+                        url, channels[(i + j) % args.channels], i),
+                    method='PUT', body='')
+
+        t_start = time.time()
+        t_end = t_start + args.duration
+
+        @coroutine
+        def send(kind, path, query, key):
+            while time.time() < t_end:
+                t0 = time.perf_counter()
+                resp = yield client.fetch(
+                    url + path() + query(), method='POST', body=body(),
+                    headers={'Content-Type': 'text/plain'},
+                    raise_error=False)
+                if resp.code == 202:
+                    latency[kind].append(time.perf_counter() - t0)
+                    counts[key] += 1
+                else:
+                    counts['errors'] += 1
+
+        def producer():
+            return send('add', lambda: '/channels/' + random.choice(channels),
+                        lambda: '?priority={}'.format(
+                            random.randrange(args.priorities)), 'added')
+
+        def publisher():
+            return send('publish', lambda: '/topics/bench{}'.format(
+                random.randrange(args.channels)), lambda: '', 'published')
+
+        @coroutine
+        def consumer(chan_name):
+            query = '?nowait' if args.nowait else ''
+            while time.time() < t_end:
+                t0 = time.perf_counter()
+                # long-polls end with the benchmark
+                resp = yield client.fetch(
+                    '{}/channels/{}{}'.format(url, chan_name, query),
+                    request_timeout=max(t_end - time.time(), 0) + 1.0,
+                    raise_error=False)
+                if resp.code == 599 and time.time() >= t_end:
+                    break
+                if resp.code == 204:
+                    if args.nowait:
+                        yield sleep(0.001)
+                    continue
+                if resp.code != 200:
+                    counts['errors'] += 1
+                    continue
+                now = time.time()
+                latency['get'].append(time.perf_counter() - t0)
+                latency['e2e'].append(
+                    now - float(resp.body.split(b' ', 1)[0]))
+                counts['consumed'] += 1
+                resp = yield client.fetch(
+                    '{}/messages/{}'.format(
+                        url, resp.headers['x-linger-msg-id']),
+                    method='DELETE', raise_error=False)
+                if resp.code != 204:
+                    counts['errors'] += 1
+
+        yield multi(
+            [producer() for _ in range(args.producers)] +
+            [publisher() for _ in range(args.publishers)] +
+            [consumer(channels[i % args.channels])
+             for i in range(args.consumers)])
+        elapsed = time.time() - t_start
+
+        res = {
+            'bench': 'http',
+            'engine': args.engine,
+            'subprocess': args.subprocess,
+            'workers': args.workers,
+            'producers': args.producers,
+            'consumers': args.consumers,
+            'publishers': args.publishers,
+            'channels': args.channels,
+            'fanout': args.fanout,
+            'priorities': args.priorities,
+            'size': args.size,
+            'nowait': args.nowait,
+            'duration-s': round(elapsed, 3),
+            'errors': counts['errors']
+        }
+        for key in ('added', 'published', 'consumed'):
+            res['{}-per-s'.format(key)] = round(counts[key] / elapsed, 1)
+        for kind, values in sorted(latency.items()):
+            res.update({'{}-{}-ms'.format(kind, k): (
+                None if v is None else round(v * 1e3, 3))
+                for k, v in percentiles(values).items()})
+        res['rss-kb'] = rss_kb(proc.pid if proc else None)
+        res['client-rss-kb'] = rss_kb() if proc else None
+        print(json.dumps(res), flush=True)
+        return res
+    finally:
+        stop()
+        if proc is not None:
+            proc.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Linger benchmarks')
+    sub = parser.add_subparsers(dest='bench')
+    p = sub.add_parser('backlog', help='request latency vs. backlog size')
+    p.add_argument('--sizes', default='10000,100000,1000000',
+                   help='comma separated backlog sizes, e.g. '
+                        '10000,100000,1000000,10000000')
+    p.add_argument('--ops', type=int, default=1000,
+                   help='number of add/get/delete operations per size')
+    p.add_argument('--dbfile', default=None,
+                   help='database file (default: a temporary file)')
+    p.add_argument('--engine', default='sqlite', choices=sorted(linger.engines),
+                   help='storage engine')
+    p = sub.add_parser('startup', help='startup time vs. database size')
+    p.add_argument('--sizes', default='1000,10000',
+                   help='comma separated database sizes (in MB)')
+    p.add_argument('--body-size', type=int, default=10000,
+                   help='message size (bytes)')
+    p.add_argument('--dbfile', default=None,
+                   help='database file (default: a temporary file)')
+    p.add_argument('--engine', default='sqlite',
+                   choices=sorted(linger.engines), help='storage engine')
+    p.add_argument('--full-vacuum', action='store_true',
+                   help='also measure the startup with a full vacuum')
+    p = sub.add_parser('lag', help='IOLoop lag during heavy writes')
+    p.add_argument('--rounds', type=int, default=20,
+                   help='number of add/drain rounds')
+    p.add_argument('--batch', type=int, default=20000,
+                   help='number of messages added per round')
+    p.add_argument('--dbfile', default=None,
+                   help='database file (default: a temporary file)')
+    p.add_argument('--engine', default='memory-heap',
+                   choices=sorted(linger.engines), help='storage engine')
+    p.add_argument('--db-thread', action='store_true',
+                   help='write from a dedicated database thread')
+    p = sub.add_parser('ingest', help='ingest, restart and consume times')
+    p.add_argument('--count', type=int, default=100000,
+                   help='number of messages')
+    p.add_argument('--batch', type=int, default=100,
+                   help='number of messages added (and consumed) per batch')
+    p.add_argument('--size', type=int, default=100,
+                   help='message size (bytes)')
+    p.add_argument('--engines', default='sqlite,memory-heap,memory-log',
+                   help='comma separated storage engines')
+    p.add_argument('--commit-interval-ms', type=int, default=0,
+                   help='group commit interval (ms)')
+    p.add_argument('--db-thread', action='store_true',
+                   help='write from a dedicated database thread')
+    p = sub.add_parser('http', help='throughput and latency over HTTP')
+    p.add_argument('--duration', type=float, default=10.0,
+                   help='benchmark duration (seconds)')
+    p.add_argument('--producers', type=int, default=4,
+                   help='number of concurrent producers (adding messages)')
+    p.add_argument('--consumers', type=int, default=4,
+                   help='number of concurrent consumers (getting and '
+                        'deleting messages)')
+    p.add_argument('--publishers', type=int, default=0,
+                   help='number of concurrent publishers (publishing '
+                        'messages on topics)')
+    p.add_argument('--channels', type=int, default=1,
+                   help='number of channels (and topics)')
+    p.add_argument('--fanout', type=int, default=1,
+                   help='number of channels subscribed to each topic')
+    p.add_argument('--priorities', type=int, default=1,
+                   help='number of message priorities (0..n-1)')
+    p.add_argument('--size', type=int, default=100,
+                   help='message size (bytes)')
+    p.add_argument('--nowait', action='store_true',
+                   help='consumers poll with nowait, instead of long-polling')
+    p.add_argument('--subprocess', action='store_true',
+                   help='run the server in a subprocess (default: in the '
+                        'benchmark process)')
+    p.add_argument('--workers', type=int, default=0,
+                   help='number of server worker processes (requires '
+                        '--subprocess)')
+    p.add_argument('--engine', default='sqlite',
+                   choices=sorted(linger.engines), help='storage engine')
+    p.add_argument('--dbfile', default=':memory:', help='database file')
+    p.add_argument('--commit-ack', default='durable',
+                   choices=('durable', 'queued'),
+                   help='acknowledge added messages when durable or queued')
+    p.add_argument('--commit-interval-ms', type=int, default=0,
+                   help='group commit interval (ms)')
+    p.add_argument('--db-thread', action='store_true',
+                   help='write from a dedicated database thread')
+    p.add_argument('--db-profile', default='default',
+                   choices=sorted(linger.SQLDB.profiles),
+                   help='database tuning profile')
+    args = parser.parse_args()
+
+    options.logging = None
+    if args.bench == 'http':
+        if args.channels < 1 or not 1 <= args.fanout <= args.channels:
+            parser.error('expected 1 <= fanout <= channels')
+        if args.workers and not args.subprocess:
+            parser.error('--workers requires --subprocess')
+        tornado.ioloop.IOLoop.current().run_sync(lambda: bench_http(args))
+    elif args.bench == 'ingest':
+        for engine in args.engines.split(','):
+            with tempfile.TemporaryDirectory() as tmpdir:
+                dbfile = os.path.join(tmpdir, 'bench.db')
+                tornado.ioloop.IOLoop.current().run_sync(
+                    lambda: bench_ingest(
+                        dbfile, engine, args.count, args.batch, args.size,
+                        args.commit_interval_ms, args.db_thread))
+    elif args.bench == 'startup':
+        sizes = sorted(int(s) for s in args.sizes.split(','))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dbfile = args.dbfile or os.path.join(tmpdir, 'bench.db')
+            bench_startup(sizes, dbfile, args.engine, args.body_size,
+                          args.full_vacuum)
+    elif args.bench == 'lag':
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dbfile = args.dbfile or os.path.join(tmpdir, 'bench.db')
+            tornado.ioloop.IOLoop.current().run_sync(
+                lambda: bench_lag(dbfile, args.engine, args.db_thread,
+                                  args.rounds, args.batch))
+    elif args.bench == 'backlog':
+        sizes = sorted(int(s) for s in args.sizes.split(','))
+        tmpdir = None
+        dbfile = args.dbfile
+        if dbfile is None:
+            tmpdir = tempfile.TemporaryDirectory()
+            dbfile = os.path.join(tmpdir.name, 'bench.db')
+        try:
+            tornado.ioloop.IOLoop.current().run_sync(
+                lambda: bench_backlog(sizes, args.ops, dbfile, args.engine))
+        finally:
+            if tmpdir is not None:
+                tmpdir.cleanup()
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -5,20 +5,38 @@ Copyright 2015-2018 Nephics AB
 Licensed under the Apache License, Version 2.0
 """
 
+import bisect
+import collections
+import concurrent.futures
+import functools
+import gzip
+import hashlib
+import heapq
+import itertools
 import logging
+import math
 import os
 import os.path
+import pickle
 import platform
+import re
+import shutil
 import sqlite3
+import struct
 import sys
+import tempfile
 import time
 import uuid
+import weakref
+import zlib
 
 import tornado.concurrent
 import tornado.ioloop
 import tornado.web
+import tornado.websocket
 
-from tornado.gen import coroutine
+from tornado.escape import json_decode, utf8
+from tornado.gen import coroutine, sleep
 from tornado.options import (define, options, parse_config_file)
 
 __version__ = '1.0.1'
@@ -31,16 +49,114 @@ define('debug', default=False, help='run in debug mode', type=bool,
        group='application')
 define('hlm', default=0, type=int, group='application',
        help='high-level mark, max number of messages to queue per channel')
+define('max_bytes_mb', default=0, type=int, group='application',
+       help='ceiling of the total size of the messages in the queue (in MB), '
+            'adding messages beyond it is refused (zero for no ceiling)')
+define('overflow', default='reject', type=str, group='application',
+       help='overflow policy of channels at the high-level mark (without '
+            'channel limits), "reject", "drop-oldest" or "drop-lowest" '
+            '(priority)')
+define('compress_min_size', default=0, type=int, group='application',
+       help='compress message bodies of at least this size (bytes) with gzip '
+            '(zero to not compress)')
+define('msg_max_size', default=256 * 1000, type=int, group='application',
+       help='max message size (bytes)')
+define('blob_min_size', default=0, type=int, group='application',
+       help='store message bodies of at least this size (bytes, after '
+            'compression) in blob files next to the database, and stream '
+            'them on delivery (zero to store all bodies in the database)')
+define('batch_max_size', default=1000, type=int, group='application',
+       help='max number of messages in a batch of a get request (larger '
+            'max values are clamped to it)')
 define('port', default=8989, help='run on the given port', type=int,
        group='application')
 define('dbfile', default=':memory:', type=str, help='database file',
        group='application')
+define('commit_interval_ms', default=0, type=int, group='application',
+       help='group commit database writes within the interval (in ms), '
+            'zero means commit every write')
+define('commit_max_ops', default=0, type=int, group='application',
+       help='commit a write group when reaching this number of writes '
+            '(zero means no limit)')
+define('commit_ack', default='durable', type=str, group='application',
+       help='acknowledge added messages when "durable" (committed) '
+            'or "queued"')
+define('engine', default='sqlite', type=str, group='application',
+       help='storage engine, "sqlite", "memory-heap" (in-memory queue '
+            'with the database as write-behind journal) or "memory-log" '
+            '(in-memory queue with an append-only log)')
+define('db_thread', default=False, type=bool, group='application',
+       help='execute the journal writes of the memory-heap and memory-log '
+            'engines in a dedicated thread (requires a database file)')
+define('workers', default=0, type=int, group='application',
+       help='serve HTTP from this number of worker processes (sharing the '
+            'port), with the queue in the main process')
+define('shards', default=0, type=int, group='application',
+       help='partition the channels across this number of queue processes '
+            '(the dbfile is then a directory, with a database per shard)')
+define('db_profile', default='default', type=str, group='application',
+       help='database tuning profile, "default" or "performance" (WAL, '
+            'synchronous=NORMAL, memory mapped reads, a larger cache, and '
+            'WAL checkpoints in a background thread)')
+define('vacuum_free_mb', default=64, type=int, group='application',
+       help='incrementally vacuum the database file when its free pages '
+            'exceed this size (in MB, zero to not vacuum)')
+define('vacuum_on_start', default=False, type=bool, group='application',
+       help='compact the database with a full vacuum on start (blocking, '
+            'enables incremental vacuum for older databases)')
+define('stats_check', default=False, type=bool, group='application',
+       help='recount the messages in the database on each stats request, '
+            'checking the maintained counts (slow, for testing)')
 
 
 class HighLevelMarkError(Exception):
     pass
 
 
+# select messages, with the body of messages sharing a body (published on
+# a topic to many channels) from the bodies table
+MSG_SELECT = (
+    'select m.id, coalesce(m.body, b.body) as body, m.mimetype, m.topic, '
+    'm.timeout, m.priority, m.channel, m.ts, m.linger, m.purge, m.deliver, '
+    'm.dcount, m.show, m.size, m.encoding, m.blob from messages m left join '
+    'bodies b on b.id=m.body_id')
+
+# select the meta data of messages, without the body
+MSG_META_SELECT = (
+    'select m.id, m.mimetype, m.topic, m.timeout, m.priority, m.channel, '
+    'm.ts, m.linger, m.purge, m.deliver, m.dcount, m.show, m.size, '
+    'm.encoding, m.blob from messages m')
+
+# insert a message
+MSG_INSERT = (
+    'insert into messages (id, body, mimetype, topic, timeout, priority, '
+    'channel, ts, linger, purge, deliver, dcount, show, size, encoding, '
+    'blob) values (:id, :body, :mimetype, :topic, :timeout, :priority, '
+    ':channel, :ts, :linger, :purge, :deliver, :dcount, :show, :size, '
+    ':encoding, :blob)')
+
+# insert a message sharing a body
+MSG_INSERT_SHARED = (
+    'insert into messages (id, body_id, mimetype, topic, timeout, priority, '
+    'channel, ts, linger, purge, deliver, dcount, show, size, encoding, '
+    'blob) values (:id, :body_id, :mimetype, :topic, :timeout, :priority, '
+    ':channel, :ts, :linger, :purge, :deliver, :dcount, :show, :size, '
+    ':encoding, :blob)')
+
+
+def decode_body(msg):
+    """Get the body of a message, read from its blob file, and
+    decompressed
+    """
+    body = msg['body']
+    if msg['blob'] is not None:
+        with open(msg['blob'], 'rb') as f:
+            body = f.read()
+    if msg['encoding'] == 'gzip':
+        return gzip.decompress(body)
+    return body
+
+
 class Listeners:
     """A class for notifying channel listeners."""
 
@@ -48,12 +164,9 @@ class Listeners:
     time_out = 120.0  # 2 mins
 
     def __init__(self):
-        self.futures = []
-
-        # the interval in ms between pruning callbacks (in ms)
-        self.periodic_callback = tornado.ioloop.PeriodicCallback(
-            self.heartbeat, 10000.0)
-        self.periodic_callback.start()
+        # futures in order of registration, the values tell if the future
+        # expects a list of messages (a batch)
+        self.futures = collections.OrderedDict()
         self.touch()
 
     def touch(self):
@@ -63,39 +176,25 @@ class Listeners:
         """Time in miliseconds"""
         return int(time.time() * 1000)
 
-    def stop(self):
-        """Stop the heartbeats"""
-        self.periodic_callback.stop()
-
-    def heartbeat(self):
-        """Prune expired callbacks"""
-        if not self.futures:
-            return
-        # expired callbacks get None
-        now = time.time()
-        keep = []
-        for future, ts in self.futures:
-            if future.done():
-                continue
-            elif ts < now:
-                future.set_result(None)
-            else:
-                keep.append((future, ts))
-        self.futures = keep
-
-    def add_future(self, future):
+    def add_future(self, future, batch=False):
         """Register a future for delivering a message to a listener"""
-        self.futures.append((future, time.time() + self.time_out))
+        self.futures[future] = batch
+        # remove the future when resolved (delivered, expired or cancelled)
+        future.add_done_callback(self.remove_future)
         self.touch()
 
+    def remove_future(self, future):
+        """Remove a registered future"""
+        self.futures.pop(future, None)
+
     def deliver(self, msg):
         """Deliver message to first listener"""
         self.touch()
         while self.futures:
-            future, _ = self.futures.pop(0)
+            future, batch = self.futures.popitem(last=False)
             if future.done():
                 continue
-            future.set_result(msg)
+            future.set_result([msg] if batch else msg)
             return True
         return False
 
@@ -106,47 +205,576 @@ class Listeners:
         return len(self.futures)
 
 
+class Deadlines:
+    """A min-heap of deadlines, with a single IOLoop timeout set for the
+    earliest deadline.
+
+    The callback is called with a list of (time, key) for the deadlines
+    reached, in order. Deadlines are not removed, the callback should ignore
+    deadlines that are no longer valid.
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.heap = []
+        self.counter = itertools.count()  # tie-breaker for equal deadlines
+        self.handle = None
+        self.when = None  # time of the scheduled timeout
+
+    def add(self, when, key):
+        """Add a deadline (a timestamp) for the key"""
+        heapq.heappush(self.heap, (when, next(self.counter), key))
+        if self.when is None or when < self.when:
+            self.schedule()
+
+    def schedule(self):
+        """Set the IOLoop timeout for the earliest deadline"""
+        io_loop = tornado.ioloop.IOLoop.current()
+        if self.handle is not None:
+            io_loop.remove_timeout(self.handle)
+            self.handle = None
+            self.when = None
+        if self.heap:
+            self.when = self.heap[0][0]
+            self.handle = io_loop.call_later(
+                max(self.when - time.time(), 0), self.run)
+
+    def run(self):
+        """Call back for all deadlines that have been reached"""
+        self.handle = None
+        self.when = None
+        now = time.time()
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            when, _, key = heapq.heappop(self.heap)
+            due.append((when, key))
+        if due:
+            self.callback(due)
+        self.schedule()
+
+    def stop(self):
+        """Stop the IOLoop timeout"""
+        if self.handle is not None:
+            tornado.ioloop.IOLoop.current().remove_timeout(self.handle)
+            self.handle = None
+            self.when = None
+
+    def __len__(self):
+        return len(self.heap)
+
+
+class MessageCounts:
+    """Message counts per channel and in total, maintained incrementally as
+    messages are added, hidden, shown and deleted.
+
+    The counts are mappings with the number of 'messages', and of messages
+    that are 'hidden' (in timeout), 'urgent' (priority<0) and 'niced'
+    (priority>0), and the 'bytes' of the message bodies.
+    """
+
+    fields = ('messages', 'hidden', 'urgent', 'niced', 'bytes')
+
+    def __init__(self):
+        self.channels = {}
+        self.total = dict.fromkeys(self.fields, 0)
+
+    def __eq__(self, other):
+        return self.channels == other.channels and self.total == other.total
+
+    def get(self, chan_name):
+        """Get the counts of a channel"""
+        return self.channels.get(chan_name) or dict.fromkeys(self.fields, 0)
+
+    def update(self, chan_name, **delta):
+        """Add the delta of counts to the channel (and total) counts"""
+        counts = self.channels.get(chan_name)
+        if counts is None:
+            counts = self.channels[chan_name] = dict.fromkeys(self.fields, 0)
+        for k, n in delta.items():
+            counts[k] += n
+            self.total[k] += n
+        if counts['messages'] == 0:
+            del self.channels[chan_name]
+
+    def add(self, msg, sign=1):
+        """Count a message added (or removed with sign=-1)"""
+        self.update(msg['channel'], messages=sign,
+                    hidden=sign * (msg['show'] > 0),
+                    urgent=sign * (msg['priority'] < 0),
+                    niced=sign * (msg['priority'] > 0),
+                    bytes=sign * msg['size'])
+
+    def remove(self, msg):
+        """Count a message removed"""
+        self.add(msg, -1)
+
+    def hide(self, msg, sign=1):
+        """Count a ready message hidden (or a hidden one shown with sign=-1)
+        """
+        self.update(msg['channel'], hidden=sign)
+
+    def show(self, msg):
+        """Count a hidden message shown"""
+        self.hide(msg, -1)
+
+    def drop(self, chan_name):
+        """Remove the counts of a channel"""
+        counts = self.channels.pop(chan_name, {})
+        for k, n in counts.items():
+            self.total[k] -= n
+
+
+class Histogram:
+    """A histogram with fixed buckets, given as the (sorted) upper bounds"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # one count per bucket, the last bucket is +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        """Add an observed value"""
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Metrics:
+    """Counters and histograms, with label values, exposed in the
+    Prometheus text format.
+
+    Metrics are defined up front, and updates only add to the counts of
+    preallocated buckets.
+    """
+
+    # histogram buckets, in seconds
+    buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+               0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0,
+               300.0)
+
+    def __init__(self):
+        # mapping of name -> (type, help, label names)
+        self.families = {}
+        # mapping of name -> label values -> count or Histogram
+        self.values = {}
+
+    def define(self, name, kind, help, labels=()):
+        """Define a 'counter' or 'histogram' metric, with label names"""
+        self.families[name] = (kind, help, labels)
+        self.values[name] = {}
+
+    def inc(self, name, *labels, n=1):
+        """Increment a counter, for the label values"""
+        values = self.values[name]
+        values[labels] = values.get(labels, 0) + n
+
+    def observe(self, name, value, *labels):
+        """Add an observed value to a histogram, for the label values"""
+        values = self.values[name]
+        histogram = values.get(labels)
+        if histogram is None:
+            histogram = values[labels] = Histogram(self.buckets)
+        histogram.observe(value)
+
+    def expose(self):
+        """Get the lines of the metrics in the text format"""
+        lines = []
+        for name, (kind, help, labels) in sorted(self.families.items()):
+            if not self.values[name]:
+                # no samples (allowing the family to be exposed elsewhere)
+                continue
+            if kind == 'histogram':
+                lines.extend(self.format_histograms(
+                    name, help, labels, self.values[name]))
+            else:
+                lines.extend(self.format(
+                    name, kind, help, labels, self.values[name].items()))
+        return lines
+
+    @staticmethod
+    def labels(names, values, extra=''):
+        """Format label names and values as {name="value",...}"""
+        pairs = ['{}="{}"'.format(k, str(v).replace('\\', '\\\\')
+                                  .replace('"', '\\"').replace('\n', '\\n'))
+                 for k, v in zip(names, values)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    @classmethod
+    def format(cls, name, kind, help, labels, samples):
+        """Format the samples (label values, value) of a counter or gauge"""
+        lines = ['# HELP {} {}'.format(name, help),
+                 '# TYPE {} {}'.format(name, kind)]
+        for values, value in samples:
+            lines.append('{}{} {}'.format(name, cls.labels(labels, values),
+                                          value))
+        return lines
+
+    @classmethod
+    def format_histograms(cls, name, help, labels, histograms):
+        lines = ['# HELP {} {}'.format(name, help),
+                 '# TYPE {} histogram'.format(name)]
+        for values, histogram in sorted(histograms.items()):
+            count = 0
+            bounds = histogram.buckets + ('+Inf',)
+            for bound, n in zip(bounds, histogram.counts):
+                count += n
+                lines.append('{}_bucket{} {}'.format(name, cls.labels(
+                    labels, values, 'le="{}"'.format(bound)), count))
+            label_str = cls.labels(labels, values)
+            lines.append('{}_sum{} {}'.format(name, label_str, histogram.sum))
+            lines.append('{}_count{} {}'.format(name, label_str, count))
+        return lines
+
+
+class TopicTrie:
+    """A trie of topic patterns, for matching topics with subscriptions.
+
+    Topics are split into segments separated by '.', and in a pattern the
+    segment '*' matches exactly one segment, and '**' matches any number of
+    segments (including none).
+    """
+
+    wildcards = ('*', '**')
+
+    def __init__(self):
+        # a node is a pair of (children, values) mappings
+        self.root = ({}, {})
+
+    @classmethod
+    def is_pattern(cls, topic):
+        """Check if the topic is a pattern (has wildcard segments)"""
+        return any(seg in cls.wildcards for seg in topic.split('.'))
+
+    def add(self, pattern, key, value):
+        """Add a value for the key to the pattern"""
+        node = self.root
+        for seg in pattern.split('.'):
+            node = node[0].setdefault(seg, ({}, {}))
+        node[1][key] = value
+
+    def remove(self, pattern, key):
+        """Remove the value for the key from the pattern"""
+        path = []
+        node = self.root
+        for seg in pattern.split('.'):
+            child = node[0].get(seg)
+            if child is None:
+                return
+            path.append((node, seg))
+            node = child
+        node[1].pop(key, None)
+        # prune nodes left without children and values
+        for parent, seg in reversed(path):
+            child = parent[0][seg]
+            if child[0] or child[1]:
+                break
+            del parent[0][seg]
+
+    def match(self, topic):
+        """Get the values of patterns matching the topic"""
+        values = []
+        self._match(self.root, topic.split('.'), 0, values)
+        return values
+
+    def _match(self, node, segs, i, values):
+        children = node[0]
+        multi = children.get('**')
+        if multi is not None:
+            # '**' consumes any number of the remaining segments
+            for j in range(i, len(segs) + 1):
+                self._match(multi, segs, j, values)
+        if i == len(segs):
+            values.extend(node[1].values())
+            return
+        for seg in (segs[i], '*'):
+            child = children.get(seg)
+            if child is not None:
+                self._match(child, segs, i + 1, values)
+
+
 class SQLDB:
-    """A lightweight wrapper for sqlite"""
+    """A lightweight wrapper for sqlite
+
+    With a commit interval (in ms), commits are grouped: writes are
+    collected in one transaction, which is committed from the IOLoop when
+    the interval has passed or when max_ops writes are pending.
+
+    With a writer thread, deferred writes are executed and committed in a
+    dedicated thread (with its own database connection), in the order they
+    were flushed, keeping the IOLoop free while writing to disk.
+    """
+
+    # seconds to wait for a lock held by another connection
+    busy_timeout = 30.0
+
+    # tuning profiles, with the pragmas set on each connection, and the
+    # size of the prepared statement cache of the connections
+    profiles = {
+        'default': {
+            'pragmas': (),
+            'cached_statements': 128,
+        },
+        # write-ahead log, synced on checkpoints (commits are durable
+        # across process crashes, but may be lost on power loss), with
+        # reads from a memory map and a larger page cache. The WAL is
+        # checkpointed by a checkpoint thread, off the request path.
+        'performance': {
+            'pragmas': (
+                ('journal_mode', 'WAL'),
+                ('synchronous', 'NORMAL'),
+                ('wal_autocheckpoint', 0),
+                ('mmap_size', 256 * 1024 * 1024),
+                ('cache_size', -64 * 1024),   # in KiB
+                ('temp_store', 'MEMORY'),
+            ),
+            'cached_statements': 1024,
+        },
+    }
 
-    def __init__(self, dbfile):
+    def __init__(self, dbfile, commit_interval=0, commit_max_ops=0,
+                 writer_thread=False, metrics=None, profile='default'):
         self.dbfile = dbfile
+        self.profile = self.profiles[profile]
+        self.metrics = metrics
+        if metrics is not None:
+            metrics.define('linger_sql_duration_seconds', 'histogram',
+                           'SQL statement execution time', ('statement',))
+        # mapping of sql -> statement label
+        self.statements = {}
+        self.commit_interval = commit_interval
+        self.commit_max_ops = commit_max_ops
+        self.pending = 0        # writes pending commit
+        self.deferred = []      # writes to execute with the next commit
+        self.flush_handle = None
+        self.waiters = []       # futures waiting for the pending commit
+        self.last_write = None  # future of the last write in the thread
         try:
-            self.conn = sqlite3.connect(dbfile)
+            self.conn = self.connect()
         except Exception as e:
             logging.error('Failed to open database file "{}". Error: {}'
                           .format(dbfile, e))
             sys.exit(1)
         self.conn.row_factory = sqlite3.Row
 
-    def table_names(self):
+        self.executor = None
+        if writer_thread:
+            if dbfile == ':memory:':
+                logging.warning('The database writer thread requires a '
+                                'database file, writing from the IOLoop')
+            else:
+                self.executor = concurrent.futures.ThreadPoolExecutor(1)
+                self.writer_conn = self.executor.submit(self.connect).result()
+
+        # the WAL is checkpointed from a thread, with its own connection
+        self.checkpointer = None
+        self.checkpointing = None
+        if self.dbfile != ':memory:' and self.conn.execute(
+                'PRAGMA journal_mode').fetchone()[0] == 'wal':
+            self.checkpointer = concurrent.futures.ThreadPoolExecutor(1)
+            self.checkpoint_conn = self.checkpointer.submit(
+                self.connect).result()
+
+    def connect(self):
+        """Open a database connection, with the pragmas of the profile"""
+        new = self.dbfile == ':memory:' or not os.path.exists(
+            self.dbfile) or os.path.getsize(self.dbfile) == 0
+        conn = sqlite3.connect(
+            self.dbfile, timeout=self.busy_timeout,
+            cached_statements=self.profile['cached_statements'])
+        if new:
+            # free pages are reclaimed with incremental vacuum (set before
+            # the journal mode, which is ignored once in WAL mode)
+            conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        for name, value in self.profile['pragmas']:
+            conn.execute('PRAGMA {}={}'.format(name, value)).fetchall()
+        return conn
+
+    def table_names(self, include_indexes=False):
         """Get the table names in the db (excluding sqlite internals and
-        index tables)
+        index tables, unless include_indexes is set)
         """
         cursor = self.conn.cursor()
         cursor.execute('SELECT name FROM sqlite_master')
         return [row[0] for row in cursor.fetchall()
                 if not row[0].startswith('sqlite') and
-                not row[0].startswith('idx_')]
+                (include_indexes or not row[0].startswith('idx_'))]
+
+    def schema_version(self):
+        """Get the schema version stored in the database"""
+        return self.conn.execute('PRAGMA user_version').fetchone()[0]
+
+    def set_schema_version(self, version):
+        """Set the schema version stored in the database"""
+        self.conn.execute('PRAGMA user_version={:d}'.format(version))
 
     def execute(self, *args):
         """Execute a SQL query"""
-        return self.conn.execute(*args)
+        if self.metrics is None:
+            return self.conn.execute(*args)
+        t0 = time.perf_counter()
+        c = self.conn.execute(*args)
+        self.observe(args[0], time.perf_counter() - t0)
+        return c
 
     def executemany(self, *args):
         """Execute a SQL query"""
-        return self.conn.executemany(*args)
+        if self.metrics is None:
+            return self.conn.executemany(*args)
+        t0 = time.perf_counter()
+        c = self.conn.executemany(*args)
+        self.observe(args[0], time.perf_counter() - t0)
+        return c
+
+    def observe(self, sql, seconds):
+        """Add the execution time of a statement to the metrics"""
+        statement = self.statements.get(sql)
+        if statement is None:
+            statement = self.statements[sql] = self.statement_label(sql)
+        self.metrics.observe('linger_sql_duration_seconds', seconds,
+                             statement)
+
+    @staticmethod
+    def statement_label(sql):
+        """Get a short label for a statement, e.g. "select messages" """
+        words = sql.lower().split()
+        m = re.search(r'\b(?:from|into|update|table|on)\s+(\w+)',
+                      ' '.join(words))
+        if m is None:
+            return ' '.join(words[:2])
+        return '{} {}'.format(words[0], m.group(1))
 
     def cursor(self):
         """Get a database connection cursor"""
         return self.conn.cursor()
 
+    def defer(self, sql, params):
+        """Queue a write to be executed with the next (group) commit"""
+        self.deferred.append((sql, params))
+        self.pending += 1
+        self.schedule_flush()
+
     def commit(self):
-        """Commit the database to disc"""
+        """Commit the database to disc (or schedule a group commit)"""
+        if self.executor is not None or (
+                self.commit_interval <= 0 and not self.deferred):
+            # only deferred writes are executed in the writer thread
+            self.conn.commit()
+            return
+        self.pending += 1
+        self.schedule_flush()
+
+    def schedule_flush(self):
+        """Flush when reaching max ops, otherwise schedule a flush"""
+        if self.commit_max_ops > 0 and self.pending >= self.commit_max_ops:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = tornado.ioloop.IOLoop.current().call_later(
+                max(self.commit_interval, 0) / 1000.0, self.flush)
+
+    def flush(self):
+        """Execute deferred writes, commit and notify waiters"""
+        if self.flush_handle is not None:
+            tornado.ioloop.IOLoop.current().remove_timeout(self.flush_handle)
+            self.flush_handle = None
+        deferred, self.deferred = self.deferred, []
+        waiters, self.waiters = self.waiters, []
+        self.pending = 0
+        if self.executor is None:
+            self.observe_writes(self.write(self.conn, deferred))
+            self.notify(waiters)
+            return
+
         self.conn.commit()
+        if deferred:
+            self.last_write = tornado.concurrent.Future()
+            write = self.executor.submit(self.write, self.writer_conn,
+                                         deferred)
+            tornado.ioloop.IOLoop.current().add_future(
+                write, functools.partial(self.written, self.last_write,
+                                         waiters))
+        else:
+            self.notify(waiters)
+
+    def write(self, conn, deferred):
+        """Execute the deferred writes and commit, returns a list of the
+        (sql, seconds) execution times
+        """
+        times = []
+        # consecutive writes with the same statement are executed together
+        for sql, ops in itertools.groupby(deferred, key=lambda op: op[0]):
+            t0 = time.perf_counter()
+            conn.executemany(sql, [params for _, params in ops])
+            times.append((sql, time.perf_counter() - t0))
+        t0 = time.perf_counter()
+        conn.commit()
+        times.append(('commit', time.perf_counter() - t0))
+        return times
+
+    def observe_writes(self, times):
+        """Add the execution times of written statements to the metrics"""
+        if self.metrics is not None:
+            for sql, seconds in times:
+                self.observe(sql, seconds)
+
+    def written(self, last_write, waiters, write):
+        """Notify waiters when the writer thread has written a group"""
+        error = write.exception()
+        if error is not None:
+            logging.error('Failed to write to the database. Error: {}'
+                          .format(error))
+        else:
+            self.observe_writes(write.result())
+        self.notify(waiters + [last_write], error)
+
+    def notify(self, waiters, error=None):
+        """Resolve the futures waiting for a commit"""
+        for future in waiters:
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+
+    def sync(self):
+        """Wait (blocking) for the writer thread to complete its writes"""
+        if self.executor is not None:
+            self.executor.submit(lambda: None).result()
+
+    def durable(self):
+        """Get a Future that resolves when the current writes are committed
+        """
+        future = tornado.concurrent.Future()
+        if self.pending:
+            self.waiters.append(future)
+        elif self.last_write is not None and not self.last_write.done():
+            tornado.concurrent.chain_future(self.last_write, future)
+        else:
+            future.set_result(None)
+        return future
+
+    def checkpoint(self):
+        """Checkpoint the WAL in the checkpoint thread (unless the previous
+        checkpoint is still running)
+        """
+        if self.checkpointer is None or (
+                self.checkpointing is not None and
+                not self.checkpointing.done()):
+            return
+        self.checkpointing = self.checkpointer.submit(
+            self.checkpoint_conn.execute, 'PRAGMA wal_checkpoint(PASSIVE)')
 
     def close(self):
         """Close the database connection"""
+        self.flush()
+        if self.executor is not None:
+            self.executor.submit(self.writer_conn.close)
+            self.executor.shutdown(wait=True)
+        if self.checkpointer is not None:
+            self.checkpointer.submit(self.checkpoint_conn.close)
+            self.checkpointer.shutdown(wait=True)
         self.conn.close()
 
     def size(self):
@@ -156,13 +784,382 @@ class SQLDB:
         return os.stat(self.dbfile).st_size
 
     def compact(self):
-        """Compact the database and return the number of bytes saved"""
+        """Compact the database (with incremental vacuum enabled) and
+        return the number of bytes saved
+        """
+        self.flush()
+        self.sync()
         before = self.size()
+        self.execute('PRAGMA auto_vacuum=INCREMENTAL')
         self.execute('VACUUM')
         self.commit()
         after = self.size()
         return before - after
 
+    def free_bytes(self):
+        """The size of the free pages in the database file"""
+        page_size = self.conn.execute('PRAGMA page_size').fetchone()[0]
+        return page_size * self.conn.execute(
+            'PRAGMA freelist_count').fetchone()[0]
+
+    def incremental_vacuum(self, max_pages):
+        """Free up to max_pages free pages from the database file (in the
+        writer thread, when there is one), if incremental vacuum is enabled
+        """
+        if self.conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            return False
+        if self.executor is None:
+            self.vacuum(self.conn, max_pages)
+        else:
+            self.executor.submit(self.vacuum, self.writer_conn, max_pages)
+        return True
+
+    def vacuum(self, conn, max_pages):
+        """Free up to max_pages free pages, and commit"""
+        t0 = time.perf_counter()
+        conn.execute('PRAGMA incremental_vacuum({:d})'.format(
+            max_pages)).fetchall()
+        conn.commit()
+        if self.metrics is not None and conn is self.conn:
+            self.observe('incremental vacuum', time.perf_counter() - t0)
+
+
+class BlobStore:
+    """A content-addressed store of message bodies, in files named by the
+    SHA-256 of the body (so a body added many times is stored once).
+
+    Messages refer to the blob file by its path, and files no longer
+    referenced by any message are removed by collect(). Without a path,
+    the files are kept in a temporary directory, removed on close. The
+    files are written (and synced) in a writer thread, off the IOLoop.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.tmpdir = None
+        # mapping of path -> number of puts of the blob files being written,
+        # kept from collect() until released
+        self.writing = {}
+        self.executor = None
+
+    def blob_path(self, data):
+        """Get the path of the blob file of the data (bytes)"""
+        if self.path is None:
+            self.tmpdir = self.path = tempfile.mkdtemp(prefix='linger-blobs-')
+        digest = hashlib.sha256(data).hexdigest()
+        return os.path.join(self.path, digest[:2], digest)
+
+    def put(self, blobs):
+        """Write the blob files of a mapping of path -> data (bytes) in the
+        writer thread, returns a Future resolving when written. The files
+        are kept from collect() until released with release().
+        """
+        for path in blobs:
+            self.writing[path] = self.writing.get(path, 0) + 1
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(1)
+        return tornado.ioloop.IOLoop.current().run_in_executor(
+            self.executor, self.write, blobs)
+
+    def release(self, paths):
+        """Release the blob files of a put (written, or failed)"""
+        for path in paths:
+            self.writing[path] -= 1
+            if not self.writing[path]:
+                del self.writing[path]
+
+    @staticmethod
+    def write(blobs):
+        """Write the blob files (a body added before is not written again)
+        """
+        for path, data in blobs.items():
+            if os.path.exists(path):
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # written to a temporary file, renamed when complete
+            tmp = '{}.{}.tmp'.format(path, os.getpid())
+            with open(tmp, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, path)
+
+    def collect(self, referenced):
+        """Remove the blob files not in the referenced set of paths,
+        returns the number of files removed
+        """
+        removed = 0
+        if self.path is None or not os.path.isdir(self.path):
+            return removed
+        for dirpath, _, filenames in os.walk(self.path):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                if path.endswith('.tmp') and \
+                        path.rsplit('.', 2)[0] in self.writing:
+                    continue
+                if path not in referenced and path not in self.writing:
+                    os.remove(path)
+                    removed += 1
+        return removed
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        if self.tmpdir is not None:
+            shutil.rmtree(self.tmpdir, ignore_errors=True)
+            self.tmpdir = self.path = None
+
+
+class MessageLog:
+    """An append-only log of message records, in segment files.
+
+    Records are pickled tuples, framed by the record length and a CRC32 of
+    the record, and appended to the current segment file in groups (the
+    same group commits as SQLDB, with fsync). A new segment is started when
+    the current segment exceeds segment_size bytes, and on open. Records
+    are ("seq", next_id), ("add", [messages]), ("set", id, {fields}) and
+    ("delete", [ids]).
+
+    The log keeps track of the segment where each live message was added,
+    and old segments are compacted (removed) when all messages added in
+    them are deleted. The live messages of the oldest segment may be
+    copied forward (added again in the current segment) to allow it to be
+    removed.
+    """
+
+    header = struct.Struct('!II')   # record length and crc32
+
+    segment_size = 64 * 1024 * 1024  # 64 MB
+
+    def __init__(self, path, commit_interval=0, commit_max_ops=0,
+                 writer_thread=False):
+        # a None path keeps no log (for a queue in memory only)
+        self.path = path
+        self.commit_interval = commit_interval
+        self.commit_max_ops = commit_max_ops
+        self.buffer = []        # framed records to write with the next flush
+        self.pending = 0        # records pending commit
+        self.flush_handle = None
+        self.waiters = []       # futures waiting for the pending commit
+        self.last_write = None  # future of the last write in the thread
+        self.segment = 0        # number of the current segment
+        self.segment_bytes = 0  # bytes appended to the current segment
+        self.fh = None          # the file written to (by the writer)
+        self.fh_segment = None
+        self.next_id = 1        # the next message id (after the logged ids)
+        # mapping of segment number -> set of ids of live messages added
+        # in the segment, and of message id -> segment number
+        self.segments = {}
+        self.msg_segment = {}
+
+        self.executor = None
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+            if writer_thread:
+                self.executor = concurrent.futures.ThreadPoolExecutor(1)
+
+    def segment_path(self, segment):
+        return os.path.join(self.path, '{:010d}.log'.format(segment))
+
+    def segment_numbers(self):
+        """Get the numbers of the segment files, in order"""
+        if self.path is None:
+            return []
+        return sorted(int(name[:-4]) for name in os.listdir(self.path)
+                      if name.endswith('.log') and name[:-4].isdigit())
+
+    def replay(self):
+        """Read the records of all segments, in order, and start a new
+        segment. A torn or corrupt record ends the replay of a segment.
+        """
+        numbers = self.segment_numbers()
+        for segment in numbers:
+            path = self.segment_path(segment)
+            with open(path, 'rb') as fh:
+                data = fh.read()
+            offset = 0
+            while offset < len(data):
+                record = self.decode(data, offset)
+                if record is None:
+                    if segment == numbers[-1]:
+                        # a torn write, when the log was last written
+                        logging.warning('Truncating log segment {} at a '
+                                        'torn record at offset {}'
+                                        .format(path, offset))
+                        os.truncate(path, offset)
+                    else:
+                        logging.error('Corrupt record in log segment {} at '
+                                      'offset {}, ignoring the rest of the '
+                                      'segment'.format(path, offset))
+                    break
+                offset, record = record
+                self.track(segment, record)
+                yield record
+            self.segments.setdefault(segment, set())
+        self.segment = numbers[-1] + 1 if numbers else 0
+        self.segments.setdefault(self.segment, set())
+
+    def decode(self, data, offset):
+        """Get the (next offset, record) of the record at the offset, or
+        None for a torn or corrupt record
+        """
+        end = offset + self.header.size
+        if end > len(data):
+            return None
+        length, crc = self.header.unpack_from(data, offset)
+        payload = data[end:end + length]
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            return None
+        try:
+            return end + length, pickle.loads(payload)
+        except Exception:
+            return None
+
+    def track(self, segment, record):
+        """Track the segment of live messages, and the next message id"""
+        if record[0] == 'seq':
+            self.next_id = max(self.next_id, record[1])
+        elif record[0] == 'add':
+            for msg in record[1]:
+                self.next_id = max(self.next_id, msg['id'] + 1)
+                old = self.msg_segment.get(msg['id'])
+                if old is not None:
+                    # copied forward
+                    self.segments[old].discard(msg['id'])
+                self.msg_segment[msg['id']] = segment
+                self.segments.setdefault(segment, set()).add(msg['id'])
+        elif record[0] == 'delete':
+            for msg_id in record[1]:
+                old = self.msg_segment.pop(msg_id, None)
+                if old is not None:
+                    self.segments[old].discard(msg_id)
+
+    def append(self, record):
+        """Append a record to the log (written with the next commit)"""
+        if self.path is None:
+            return
+        if self.segment_bytes == 0:
+            # each segment starts with the next message id
+            self.segment_bytes = 1
+            self.append(('seq', self.next_id))
+        payload = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        self.buffer.append(self.header.pack(len(payload),
+                                            zlib.crc32(payload)) + payload)
+        self.segment_bytes += self.header.size + len(payload)
+        self.track(self.segment, record)
+        self.pending += 1
+        if self.commit_max_ops > 0 and self.pending >= self.commit_max_ops:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = tornado.ioloop.IOLoop.current().call_later(
+                max(self.commit_interval, 0) / 1000.0, self.flush)
+
+    def flush(self):
+        """Write the appended records to the segment file (with fsync),
+        and notify waiters
+        """
+        if self.flush_handle is not None:
+            tornado.ioloop.IOLoop.current().remove_timeout(self.flush_handle)
+            self.flush_handle = None
+        data, self.buffer = b''.join(self.buffer), []
+        waiters, self.waiters = self.waiters, []
+        self.pending = 0
+        segment = self.segment
+        if self.segment_bytes > self.segment_size:
+            # the next records are appended to a new segment
+            self.segment += 1
+            self.segment_bytes = 0
+            self.segments.setdefault(self.segment, set())
+        if not data:
+            self.notify(waiters)
+            return
+        if self.executor is None:
+            self.write(segment, data)
+            self.notify(waiters)
+            return
+        self.last_write = tornado.concurrent.Future()
+        write = self.executor.submit(self.write, segment, data)
+        tornado.ioloop.IOLoop.current().add_future(
+            write, functools.partial(self.written, self.last_write, waiters))
+
+    def write(self, segment, data):
+        """Write data to the end of a segment file, and sync to disk"""
+        if self.fh_segment != segment:
+            if self.fh is not None:
+                self.fh.close()
+            self.fh = open(self.segment_path(segment), 'ab')
+            self.fh_segment = segment
+        self.fh.write(data)
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+
+    def written(self, last_write, waiters, write):
+        """Notify waiters when the writer thread has written a group"""
+        error = write.exception()
+        if error is not None:
+            logging.error('Failed to write to the log. Error: {}'
+                          .format(error))
+        self.notify(waiters + [last_write], error)
+
+    notify = SQLDB.notify
+
+    def sync(self):
+        """Wait (blocking) for the writer thread to complete its writes"""
+        if self.executor is not None:
+            self.executor.submit(lambda: None).result()
+
+    def durable(self):
+        """Get a Future that resolves when the current records are written
+        """
+        future = tornado.concurrent.Future()
+        if self.pending:
+            self.waiters.append(future)
+        elif self.last_write is not None and not self.last_write.done():
+            tornado.concurrent.chain_future(self.last_write, future)
+        else:
+            future.set_result(None)
+        return future
+
+    def close(self):
+        """Write the appended records, and close the segment file"""
+        self.flush()
+        self.sync()
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
+
+    def size(self):
+        """The total size of the segment files"""
+        return sum(os.stat(self.segment_path(segment)).st_size
+                   for segment in self.segment_numbers())
+
+    def oldest_segment(self):
+        """Get the number of the oldest segment before the current segment
+        (or None), with the set of ids of its live messages
+        """
+        for segment in sorted(self.segments):
+            if segment >= self.segment:
+                return None, None
+            return segment, self.segments[segment]
+        return None, None
+
+    def remove_segment(self, segment):
+        """Remove an old segment, without live messages, after the records
+        appended so far are written
+        """
+        del self.segments[segment]
+        self.flush()
+        path = self.segment_path(segment)
+        if self.executor is not None:
+            # removed by the writer thread, after the pending writes
+            self.executor.submit(os.remove, path)
+        elif os.path.exists(path):
+            os.remove(path)
+        logging.debug('Removed log segment {}'.format(path))
+
 
 class LingerQueue:
 
@@ -171,10 +1168,90 @@ class LingerQueue:
 
     msg_max_size = 256 * 1000  # 256 KB in bytes
 
+    # gzip compression level of compressed message bodies
+    compress_level = 6
+
+    # interval between removing unused blob files (seconds)
+    blob_collect_interval = 60.0
+
+    # max number of free database pages to vacuum per heartbeat
+    vacuum_pages = 2048
+
+    # what to do when adding messages to a channel at its limits
+    overflow_policies = ('reject', 'drop-oldest', 'drop-lowest')
+
     # recognized configuration keys
     _config_keys = ('server_id',)
 
-    def __init__(self, dbfile=':memory:', hlm=0):
+    # whether the database is a write-behind journal (with deferred writes)
+    write_behind = False
+
+    # metrics (name, type, help, label names), in addition to the metrics
+    # from the stats and message counts
+    _metrics = (
+        ('linger_channel_added_total', 'counter',
+         'Messages added to the channel', ('channel',)),
+        ('linger_channel_delivered_total', 'counter',
+         'Message deliveries from the channel', ('channel',)),
+        ('linger_channel_deleted_total', 'counter',
+         'Messages deleted or purged from the channel', ('channel',)),
+        ('linger_channel_dead_lettered_total', 'counter',
+         'Messages moved from the channel to its dead-letter channel',
+         ('channel',)),
+        ('linger_delivery_latency_seconds', 'histogram',
+         'Time from adding a message to its delivery', ('channel',)),
+        ('linger_longpoll_wait_seconds', 'histogram',
+         'Time waiting for a message, when long-polling', ('channel',)),
+        ('linger_request_duration_seconds', 'histogram',
+         'HTTP request handling time', ('handler', 'method')),
+        ('linger_heartbeat_duration_seconds', 'histogram',
+         'Heartbeat and deadline handling time', ('task',)),
+    )
+
+    # schema migrations, the schema version of a database is the number of
+    # migrations applied to it (stored as the sqlite user_version)
+    _migrations = (
+        # 1: indexes for message lookup, heartbeat scans and counting
+        ('create index idx_messages_channel on messages '
+         '(channel, show, priority, id)',
+         'create index idx_messages_purge on messages (purge)',
+         'create index idx_messages_show on messages (show)'),
+        # 2: bodies shared by messages published to many channels, deleted
+        #    with the last message referencing the body
+        ('alter table messages add column body_id',
+         'create table bodies (id integer primary key autoincrement, body, '
+         'refs)',
+         'create trigger trg_messages_delete after delete on messages '
+         'when old.body_id is not null begin '
+         'update bodies set refs=refs-1 where id=old.body_id; '
+         'delete from bodies where id=old.body_id and refs<=0; end'),
+        # 3: message body sizes (in bytes), for the byte quotas, and the
+        #    channel limits (quotas)
+        ('alter table messages add column size',
+         'update messages set size=length(cast(coalesce(body, (select '
+         'b.body from bodies b where b.id=body_id)) as blob))',
+         'create table limits (channel primary key, max_messages, max_bytes, '
+         'overflow)'),
+        # 4: delay of the messages published to a subscription (seconds)
+        ('alter table subscriptions add column delay default 0',),
+        # 5: dead-letter channels, of channels and of subscriptions
+        ('alter table subscriptions add column dead_letter',
+         'create table dead_letters (channel primary key, target)'),
+        # 6: encoding of compressed message bodies ('gzip', or null)
+        ('alter table messages add column encoding',),
+        # 7: path of the blob file of message bodies stored in a file
+        ('alter table messages add column blob',
+         'create index idx_messages_blob on messages (blob) '
+         'where blob is not null'),
+        # 8: indexes for the messages dropped on overflow, in order
+        ('create index idx_messages_oldest on messages (channel, id)',
+         'create index idx_messages_lowest on messages '
+         '(channel, priority desc, id)'),
+    )
+
+    def __init__(self, dbfile=':memory:', hlm=0, commit_interval=0,
+                 commit_max_ops=0, db_thread=False, vacuum=False,
+                 db_profile='default'):
         self.dbfile = dbfile
         self.hlm = hlm
         self.stats = {'start': int(time.time())}
@@ -183,14 +1260,78 @@ class LingerQueue:
         # for channels that have active listeners
         self.channels = {}
 
-        self.db = SQLDB(dbfile)
+        # mapping of topic -> channel -> subscription (cache of the
+        # subscriptions table), and trie of subscription topic patterns
+        self.subscriptions = {}
+        self.topic_trie = TopicTrie()
+
+        # with shards, mapping of topic -> subscribed channels (of all the
+        # shards), and trie of the subscribed topic patterns, for routing
+        # publishes to the shards of the channels (kept in memory only,
+        # added by the workers on start)
+        self.routes = {}
+        self.route_trie = TopicTrie()
+
+        # message counts, maintained as messages are added, hidden, etc.
+        self.counts = MessageCounts()
+
+        # mapping of channel name -> limits (cache of the limits table),
+        # channels without limits have the high-level mark and the default
+        # overflow policy, and a ceiling of the bytes of all messages (zero
+        # for no ceiling)
+        self.limits = {}
+        self.overflow = 'reject'
+        self.max_bytes = 0
+
+        # mapping of channel name -> dead-letter channel (cache of the
+        # dead_letters table), for messages exceeding the delivery limit or
+        # the retention
+        self.dead_letters = {}
+
+        # message bodies of at least this size (bytes) are compressed (zero
+        # to not compress)
+        self.compress_min_size = 0
+
+        # message bodies of at least this size (bytes, after compression)
+        # are stored in blob files (zero to store them in the database)
+        self.blob_min_size = 0
+        self.blobs = BlobStore(None if dbfile == ':memory:' else
+                               os.path.abspath(dbfile + '-blobs'))
+        self.blobs_collected = time.time()
+        # recompute the counts from the database on server_stats, logging
+        # (and correcting) differences from the maintained counts
+        self.check_counts = False
+
+        # visibility timeout and retention deadlines
+        self.deadlines = Deadlines(self.expire)
+        # mapping of message id -> due time of scheduled messages, until
+        # their first show deadline (counted as due, when not touched)
+        self.scheduled = {}
+        # long-polling deadlines for listener futures (weak references)
+        self.listener_deadlines = Deadlines(self.expire_listeners)
+
+        self.metrics = Metrics()
+        for name, kind, help, labels in self._metrics:
+            self.metrics.define(name, kind, help, labels)
+
+        self.db = SQLDB(dbfile, commit_interval, commit_max_ops,
+                        writer_thread=db_thread and self.write_behind,
+                        metrics=self.metrics, profile=db_profile)
+
+        # free pages are vacuumed incrementally from the heartbeat, when
+        # exceeding this number of bytes (zero to not vacuum)
+        self.vacuum_free_bytes = 64 * 1024 * 1024
+        self.vacuuming = False
 
         if 'config' not in self.db.table_names():
             self.init_db()
         else:
-            if dbfile != ':memory:':
+            if vacuum and dbfile != ':memory:':
                 bts = self.db.compact()
                 logging.info('Compacted database, saved {} bytes'.format(bts))
+            elif self.db.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+                logging.info('Incremental vacuum is not enabled for the '
+                             'database (enabled with a full vacuum on start)')
             self.restore_from_db()
 
         self.periodic_callback = tornado.ioloop.PeriodicCallback(
@@ -202,6 +1343,7 @@ class LingerQueue:
         self.config = {
             'server_id': uuid.uuid4().hex  # a random server_id
         }
+        # (incremental vacuum is enabled when connecting to a new database)
         # create tables
         self.db.execute('create table config (key unique,value)')
         # columns of table 'messages'
@@ -239,93 +1381,341 @@ class LingerQueue:
             'insert or replace into config (key,value) values (?,?)',
             [(k, self.config[k]) for k in self._config_keys])
         self.db.commit()
+        self.migrate_db()
+
+    def migrate_db(self):
+        """Upgrade the database schema to the current version"""
+        version = self.db.schema_version()
+        if version > len(self._migrations):
+            logging.error('Database schema version {} is newer than the '
+                          'supported version {}'.format(
+                              version, len(self._migrations)))
+            sys.exit(1)
+        for i, statements in enumerate(self._migrations[version:], version):
+            logging.info('Migrating database schema to version {}'
+                         .format(i + 1))
+            for sql in statements:
+                self.db.execute(sql)
+            self.db.set_schema_version(i + 1)
+            self.db.flush()
 
     def restore_from_db(self):
+        # upgrade existing databases
+        self.migrate_db()
         # load config
         self.config = {r['key']: r['value'] for r in
                        self.db.execute('select * from config')
                        if r['key'] in self._config_keys}
+        self.restore_subscriptions()
+        self.restore_limits()
+        self.restore_dead_letters()
+        self.restore_messages()
+
+    def restore_limits(self):
+        """Load the channel limits"""
+        for row in self.db.execute('select * from limits'):
+            self.limits[row['channel']] = {
+                k: row[k] for k in ('max_messages', 'max_bytes', 'overflow')}
+
+    def restore_dead_letters(self):
+        """Load the dead-letter channels"""
+        for row in self.db.execute('select * from dead_letters'):
+            self.dead_letters[row['channel']] = row['target']
+
+    def restore_subscriptions(self):
+        """Load the subscriptions into the routing cache"""
+        for row in self.db.execute('select * from subscriptions'):
+            self.cache_subscription({k: row[k] for k in row.keys()})
+
+    def restore_messages(self):
+        """Restore the message counts, and the visibility timeout and
+        retention deadlines
+        """
+        self.counts = self.count_messages()
+        for r in self.db.execute('select id, show, purge, dcount from '
+                                 'messages where show>0 or purge>0'):
+            if r['show'] > 0:
+                self.deadlines.add(r['show'], ('show', r['id']))
+                if r['dcount'] == 0:
+                    self.scheduled[r['id']] = r['show']
+            if r['purge'] > 0:
+                self.deadlines.add(r['purge'], ('purge', r['id']))
 
     def stop(self):
         self.periodic_callback.stop()
-        for listeners in self.channels.values():
-            listeners.stop()
+        self.deadlines.stop()
+        self.listener_deadlines.stop()
         self.db.close()
+        self.blobs.close()
 
     def heartbeat(self):
         """Heartbeat function, called periodically from the IOLoop."""
-
+        # visibility timeouts and retention are handled at their deadlines
+        t0 = time.perf_counter()
         now = time.time()
-
-        # purge messages that have exceed their rentention time
-        purge = [r['id'] for r in self.db.execute(
-                    'select id from messages where purge>0 and purge<?',
-                    (now,))]
-        for msg_id in purge:
-            logging.debug('Exceeded retention on msg {}'.format(msg_id))
-            self.stats['msg-retention'] = (
-                self.stats.get('msg-retention', 0) + 1)
-            self.count_deleted(msg_id)
-
-        # try to deliver messages that exceeds the visibility timeout
-        visible = (dict((k, r[k]) for k in r.keys()) for r in self.db.execute(
-                   'select * from messages where show>0 and show<=? and not '
-                   '(purge>0 and purge<?) order by priority', (now, now)))
+        self.remove_unused_channels(now)
+        self.vacuum()
+        self.db.checkpoint()
+        if now - self.blobs_collected >= self.blob_collect_interval:
+            self.blobs_collected = now
+            self.collect_blobs()
+        self.metrics.observe('linger_heartbeat_duration_seconds',
+                             time.perf_counter() - t0, 'heartbeat')
+
+    def collect_blobs(self):
+        """Remove the blob files no longer referenced by any message"""
+        removed = self.blobs.collect(self.referenced_blobs())
+        if removed:
+            logging.debug('Removed {} blob files'.format(removed))
+            self.stats['blob-remove'] = (
+                self.stats.get('blob-remove', 0) + removed)
+
+    def referenced_blobs(self):
+        """Get the set of blob file paths referenced by messages"""
+        return {r[0] for r in self.db.execute(
+            'select distinct blob from messages where blob is not null')}
+
+    def vacuum(self):
+        """Free some of the free pages of the database file (a step of at
+        most vacuum_pages), when they exceed vacuum_free_bytes
+        """
+        if self.vacuum_free_bytes <= 0 or self.dbfile == ':memory:':
+            return
+        free = self.db.free_bytes()
+        # once started, vacuum until there are no free pages
+        self.vacuuming = free > (0 if self.vacuuming else
+                                 self.vacuum_free_bytes)
+        if self.vacuuming and self.db.incremental_vacuum(self.vacuum_pages):
+            self.stats['db-vacuum'] = self.stats.get('db-vacuum', 0) + 1
+
+    def expire(self, deadlines):
+        """Handle visibility timeout and retention deadlines, called from
+        the IOLoop when the deadlines are reached.
+        """
+        t0 = time.perf_counter()
+        now = time.time()
+        purge = []
+        expired = []
         undelivered = []
-        for msg in visible:
-            logging.debug('Exceeded timeout on msg {}'.format(msg['id']))
-            self.stats['msg-timeouts'] = self.stats.get('msg-timeouts', 0) + 1
+        for when, (kind, msg_id) in deadlines:
+            # (the first show deadline of a scheduled message, or of a
+            # touch before it was due)
+            due = kind == 'show' and self.scheduled.pop(msg_id, None) == when
+            msg = self.find_message(msg_id, body=False)
+            if msg is None or msg[kind] != when:
+                # message deleted, or deadline changed (touched)
+                continue
+            if kind == 'purge':
+                # purge message that has exceeded its retention time
+                logging.debug('Exceeded retention on msg {}'.format(msg_id))
+                self.stats['msg-retention'] = (
+                    self.stats.get('msg-retention', 0) + 1)
+                expired.append(msg)
+                continue
+            if msg['purge'] > 0 and msg['purge'] <= now:
+                # message is purged at its retention deadline
+                continue
+
+            if due:
+                # scheduled message is due, deliver it
+                logging.debug('Scheduled msg {} is due'.format(msg_id))
+                self.stats['msg-due'] = self.stats.get('msg-due', 0) + 1
+            else:
+                # try to deliver message that exceeded the visibility timeout
+                logging.debug('Exceeded timeout on msg {}'.format(msg_id))
+                self.stats['msg-timeouts'] = (
+                    self.stats.get('msg-timeouts', 0) + 1)
             if msg['deliver'] == 0 or msg['dcount'] < msg['deliver']:
-                # try to deliver the message
-                if not self.deliver_message(msg):
+                msg['show'] = 0.0
+                self.counts.show(msg)
+                if 'body' not in msg and self.channels.get(msg['channel']):
+                    # (the body is only read for a waiting listener)
+                    msg = dict(self.find_message(msg_id), show=0.0)
+                if not self.deliver_message(dict(msg)):
                     # count it as shown
                     self.stats['msg-show'] = self.stats.get('msg-show', 0) + 1
-                    undelivered.append(msg['id'])
+                    undelivered.append(msg)
             else:
                 # message delivered to many times, purge it
-                purge.append(msg['id'])
-                self.count_deleted(msg['id'])
+                expired.append(msg)
 
         if undelivered:
-            # set messages to be visible (out of timeout)
-            self.db.executemany('update messages set show=0.0 where id=?',
-                                ((i,) for i in undelivered))
+            self.show_messages(undelivered)
+
+        # expired messages are moved to their dead-letter channels (within
+        # the limits of those), or purged
+        moved = []
+        dropped = set()  # ids of messages dropped from the channels
+        for msg in expired:
+            if msg['id'] in dropped:
+                continue
+            target = self.dead_letter_channel(msg)
+            if target is not None:
+                try:
+                    # (the message is already counted in the queue bytes)
+                    dropped.update(m['id'] for m in self.check_limits(
+                        target, [msg], pending=-msg['size']))
+                except HighLevelMarkError as e:
+                    logging.warning(e)
+                else:
+                    self.move_messages([(msg, target)])
+                    moved.append(msg)
+                    continue
+            purge.append(msg)
+            self.count_deleted(msg)
+        moved = [msg for msg in moved if msg['id'] not in dropped]
+
         if purge:
-            self.db.executemany('delete from messages where id=?',
-                                ((i,) for i in purge))
-        if purge or undelivered:
+            self.delete_messages(purge)
+        if purge or undelivered or expired:
             self.db.commit()
+        for msg in moved:
+            if 'body' not in msg and self.channels.get(msg['channel']):
+                msg = self.find_message(msg['id'])
+            if not self.deliver_message(dict(msg)):
+                self.stats['msg-show'] = self.stats.get('msg-show', 0) + 1
+        self.metrics.observe('linger_heartbeat_duration_seconds',
+                             time.perf_counter() - t0, 'deadlines')
+
+    def dead_letter_channel(self, msg):
+        """Get the dead-letter channel for an expired message, of the
+        subscription the message was published to, or of the channel (None
+        if neither has one)
+        """
+        if msg['topic']:
+            for sub in self.route_topic(msg['topic']):
+                if sub['channel'] == msg['channel'] and sub['dead_letter']:
+                    return sub['dead_letter']
+        target = self.dead_letters.get(msg['channel'])
+        return target if target != msg['channel'] else None
+
+    def move_messages(self, moves):
+        """Move messages, a list of (msg, channel), to other channels as
+        ready messages, without a delivery limit or retention (commit is left
+        to the caller)
+        """
+        for msg, chan_name in moves:
+            self.count_dead_lettered(msg)
+            self.counts.remove(msg)
+            msg.update(channel=chan_name, show=0.0, purge=0, deliver=0,
+                       dcount=0)
+            self.counts.add(msg)
+        self.db.executemany(
+            'update messages set channel=:channel, show=0.0, purge=0, '
+            'deliver=0, dcount=0 where id=:id', (msg for msg, _ in moves))
+
+    def expire_listeners(self, deadlines):
+        """End long-polling for listeners that have waited too long"""
+        for _, ref in deadlines:
+            future = ref()
+            if future is not None and not future.done():
+                # expired listeners get None
+                future.set_result(None)
 
-        # check if channel has listeners, otherwise remove it when timed out
+    def find_message(self, msg_id, body=True):
+        """Get a message from the id, or None (without the body, for only
+        the meta data)
+        """
+        row = self.db.execute(
+            (MSG_SELECT if body else MSG_META_SELECT) + ' where m.id=?',
+            (msg_id,)).fetchone()
+        if row is None:
+            return None
+        return {k: row[k] for k in row.keys()}
+
+    def show_messages(self, msgs):
+        """Set messages to be visible (out of timeout)"""
+        self.db.executemany('update messages set show=0.0 where id=?',
+                            ((msg['id'],) for msg in msgs))
+
+    def delete_messages(self, msgs):
+        """Delete messages (commit is left to the caller)"""
+        self.db.executemany('delete from messages where id=?',
+                            ((msg['id'],) for msg in msgs))
+        for msg in msgs:
+            self.counts.remove(msg)
+
+    def remove_unused_channels(self, now):
+        """Remove channels without listeners, when timed out"""
         unused = [(ch, lst) for ch, lst in self.channels.items()
                   if not lst and lst.ts + self.channel_ttl < now]
         for channel, listeners in unused:
             # channel is no longer in use
             logging.debug('Removing empty channel {}'.format(channel))
-            listeners.stop()
             del self.channels[channel]
             self.stats['channel-remove'] = (
                 self.stats.get('channel-remove', 0) + 1)
 
+    def durable(self, chan_names=None):
+        """Get a Future that resolves when the writes made so far are
+        committed to the database (the names of the channels written are
+        only used with shards, to wait for the shards of the channels)
+        """
+        return self.db.durable()
+
+    def call(self, method, *args, **kwargs):
+        """Call a method, returns a Future of the result.
+
+        This is the interface used by the request handlers, shared with
+        QueueProxy (for a queue owned by another process). A Future returned
+        by the method is returned as is, so that it can be resolved by the
+        caller (ending a long-poll).
+        """
+        future = tornado.concurrent.Future()
+        try:
+            result = getattr(self, method)(*args, **kwargs)
+        except Exception as e:
+            future.set_exception(e)
+            return future
+        if tornado.concurrent.is_future(result):
+            return result
+        future.set_result(result)
+        return future
+
+    def message_counts(self):
+        """Get the message counts and max message id"""
+        counts = self.counts.total
+        total, urgent, niced = (counts['messages'], counts['urgent'],
+                                counts['niced'])
+        normal = total - urgent - niced
+        return total, urgent, normal, counts['hidden'], self.max_message_id()
+
+    def max_message_id(self):
+        """Get the largest message id in the queue (or None)"""
+        return self.db.execute('select max(id) from messages').fetchone()[0]
+
+    def count_messages(self):
+        """Count the messages in the database (a full scan)"""
+        counts = MessageCounts()
+        for row in self.db.execute(
+                'select channel, count(*), sum(show>0), sum(priority<0), '
+                'sum(priority>0), sum(size) from messages group by channel'):
+            counts.update(row[0], **dict(zip(MessageCounts.fields, row[1:])))
+        return counts
+
+    def verify_counts(self):
+        """Recompute the message counts from the database, and correct the
+        maintained counts. Returns False if the counts differed.
+        """
+        self.db.flush()
+        self.db.sync()
+        counts = self.count_messages()
+        if counts == self.counts:
+            return True
+        logging.error('Message counts {} differ from the database {}'.format(
+            self.counts.total, counts.total))
+        self.counts = counts
+        return False
+
     def server_stats(self):
+        if self.check_counts:
+            self.verify_counts()
         s = self.stats.copy()
         times = os.times()
-        total = self.db.execute('select count(*) from messages').fetchone()[0]
-        urgent = self.db.execute(
-            'select count(*) from messages where priority<0').fetchone()[0]
-        normal = self.db.execute(
-            'select count(*) from messages where priority=0').fetchone()[0]
-        now = time.time()
-        hidden = self.db.execute(
-            'select count(*) from messages where ts>0 and ts>?',
-            (now,)).fetchone()[0]
-        topic_count = self.db.execute(
-            'select count(distinct topic) from subscriptions').fetchone()[0]
-        sub_count = self.db.execute(
-            'select count(*) from subscriptions').fetchone()[0]
+        total, urgent, normal, hidden, msg_max_no = self.message_counts()
+        topic_count = len(self.subscriptions)
+        sub_count = sum(len(subs) for subs in self.subscriptions.values())
         chan_count = len(self.list_channels())
-        msg_max_no = self.db.execute(
-            'select max(id) from messages').fetchone()[0]
         s.update({
             'current-topics': topic_count,
             'current-subscriptions': sub_count,
@@ -335,6 +1725,7 @@ class LingerQueue:
             'current-messages-hidden': hidden,
             'current-messages-urgent': urgent,
             'current-messages-niced': total - normal - urgent,
+            'current-messages-bytes': self.counts.total['bytes'],
             'current-uptime': int(time.time() - self.stats['start']),
             'db-file': self.dbfile,
             'db-size': self.db.size(),
@@ -349,30 +1740,132 @@ class LingerQueue:
         })
         return s
 
+    def metrics_text(self):
+        """Get the metrics in the Prometheus text format"""
+        lines = []
+        counters = sorted((k, v) for k, v in self.stats.items()
+                          if k != 'start' and isinstance(v, int))
+        for k, v in counters:
+            name = 'linger_{}_total'.format(k.replace('-', '_'))
+            lines.extend(Metrics.format(
+                name, 'counter', 'The {} count in /stats'.format(k), (),
+                [((), v)]))
+        lines.extend(Metrics.format(
+            'linger_start_time_seconds', 'gauge', 'Server start time', (),
+            [((), self.stats['start'])]))
+        lines.extend(Metrics.format(
+            'linger_messages', 'gauge', 'Messages in the queue', ('state',),
+            [(('ready',), self.counts.total['messages'] -
+              self.counts.total['hidden']),
+             (('hidden',), self.counts.total['hidden'])]))
+        channels = sorted(self.counts.channels.items())
+        lines.extend(Metrics.format(
+            'linger_channel_messages', 'gauge', 'Messages in the channel',
+            ('channel', 'state'),
+            [((ch, state), n) for ch, counts in channels for state, n in (
+                ('ready', counts['messages'] - counts['hidden']),
+                ('hidden', counts['hidden']))]))
+        lines.extend(Metrics.format(
+            'linger_channel_bytes', 'gauge',
+            'Size of the messages in the channel (bytes)', ('channel',),
+            [((ch,), counts['bytes']) for ch, counts in channels]))
+        lines.extend(Metrics.format(
+            'linger_channel_listeners', 'gauge',
+            'Listeners waiting for messages from the channel', ('channel',),
+            [((ch,), len(listeners))
+             for ch, listeners in sorted(self.channels.items())]))
+        lines.extend(Metrics.format(
+            'linger_subscriptions', 'gauge', 'Topic subscriptions', (),
+            [((), sum(len(subs) for subs in self.subscriptions.values()))]))
+        lines.extend(self.metrics.expose())
+        return '\n'.join(lines) + '\n'
+
     #
     #  channel and message functions
 
     def add_message(self, chan_name, body, mime_type, priority, timeout,
-                    deliver, linger, topic=''):
-        """Add message to the queue"""
-        msg_size = len(body)
-        if msg_size == 0:
-            raise ValueError('Message is empty.')
-        if msg_size > self.msg_max_size:
-            raise ValueError('The message size {} bytes exceeed the maximum '
-                             'allowed {} bytes.'.format(
-                                 msg_size, self.msg_max_size))
-        msgs_count = self.db.execute(
-            'select count(*) from messages where channel=?',
-            (chan_name,)).fetchone()[0]
-        if self.hlm > 0 and msgs_count >= self.hlm:
-            raise HighLevelMarkError(
-                'Channel {} is at the high-level mark with {} messages'
-                .format(chan_name, msgs_count))
+                    deliver, linger, topic='', delay=0, not_before=0):
+        """Add message to the queue, scheduled messages (with a delay in
+        seconds, or a not_before timestamp) are hidden until due. Returns
+        the message id (or a Future of it, for a body written to a blob
+        file first).
+        """
+        msg = self.new_message(chan_name, body, mime_type, priority, timeout,
+                               deliver, linger, topic, delay, not_before)
+        self.check_limits(chan_name, [msg])
+        if msg['blob'] is not None:
+            return self.write_blobs(
+                [msg], lambda msgs: self.add_written(chan_name, msgs)[0])
+
+        # queue message for delivery
+        self.store_message(msg)
+        self.queue_message(msg)
+        return msg['id']
+
+    def add_messages(self, chan_name, msgs):
+        """Add a batch of messages to the queue, in one transaction.
+
+        The msgs is a list of dicts with the add_message keyword arguments
+        (except chan_name). Returns the list of message ids (or a Future of
+        it, for bodies written to blob files first).
+        """
+        msgs = [self.new_message(chan_name, **kwargs) for kwargs in msgs]
+        if not msgs:
+            return []
+        self.check_limits(chan_name, msgs)
+        if any(msg['blob'] is not None for msg in msgs):
+            return self.write_blobs(
+                msgs, functools.partial(self.add_written, chan_name))
+
+        # queue messages for delivery
+        self.store_messages(msgs)
+        for msg in msgs:
+            self.queue_message(msg)
+        return [msg['id'] for msg in msgs]
+
+    def add_written(self, chan_name, msgs):
+        """Add messages with the bodies written to blob files, checking the
+        limits again (for the messages added while writing)
+        """
+        self.check_limits(chan_name, msgs)
+        self.store_messages(msgs)
+        for msg in msgs:
+            self.queue_message(msg)
+        return [msg['id'] for msg in msgs]
+
+    @coroutine
+    def write_blobs(self, msgs, add):
+        """Write the bodies of the (accepted) messages stored in blob files,
+        off the IOLoop, then add the messages with add(msgs), returning its
+        result. The files of messages rejected by add() are left to
+        collect_blobs().
+        """
+        blobs = {}
+        for msg in msgs:
+            if msg['blob'] is not None:
+                blobs[msg['blob']] = msg['body']
+                msg['body'] = None
+        self.stats['msg-blob'] = self.stats.get('msg-blob', 0) + len(blobs)
+        try:
+            yield self.blobs.put(blobs)
+            return add(msgs)
+        finally:
+            self.blobs.release(blobs)
+
+    def new_message(self, chan_name, body, mime_type, priority, timeout,
+                    deliver, linger, topic='', delay=0, not_before=0,
+                    encoded=None):
+        """Create a new message, with the (body, encoding, size, blob) from
+        encode_body() in encoded, or encoding the body
+        """
+        body, encoding, msg_size, blob = encoded or self.encode_body(body)
         now = time.time()
-        purge = now + linger if linger > 0 else 0
+        # scheduled messages are hidden until due, and retained from then
+        show = max(now + delay, not_before)
+        show = show if show > now else 0.0
+        purge = max(show, now) + linger if linger > 0 else 0
 
-        msg = {
+        return {
             'body': body,           # message body
             'mimetype': mime_type,  # mime-type
             'topic': topic,         # message topic
@@ -384,56 +1877,272 @@ class LingerQueue:
             'purge': purge,         # when to purge the message (timestamp)
             'deliver': deliver,     # max delivery count
             'dcount': 0,            # delivered count
-            'show': 0.0             # timestamp when message should be shown
+            'show': show,           # timestamp when message should be shown
+            'size': msg_size,       # body size (bytes)
+            'encoding': encoding,   # body compression ('gzip' or None)
+            'blob': blob            # path of the body file (or None)
         }
 
-        # queue message for delivery
-        c = self.db.execute(
-            'insert into messages (body, mimetype, topic, timeout, priority,'
-            'channel , ts, linger, purge, deliver, dcount, show) values '
-            '(:body, :mimetype, :topic, :timeout, :priority, :channel, :ts, '
-            ':linger, :purge, :deliver, :dcount, :show)', msg)
-        msg['id'] = c.lastrowid     # set message id
+    def encode_body(self, body):
+        """Check the message size, compress the body (when at least
+        compress_min_size bytes, and smaller compressed), and get the path
+        of its blob file (when at least blob_min_size bytes). Returns (body,
+        encoding, size, blob), with the size of the uncompressed body. The
+        body of a message with a blob file is written by write_blobs().
+        """
+        msg_size = len(utf8(body))
+        if msg_size == 0:
+            raise ValueError('Message is empty.')
+        if msg_size > self.msg_max_size:
+            raise ValueError('The message size {} bytes exceeed the maximum '
+                             'allowed {} bytes.'.format(
+                                 msg_size, self.msg_max_size))
+        encoding = None
+        if 0 < self.compress_min_size <= msg_size:
+            compressed = gzip.compress(utf8(body), self.compress_level)
+            if len(compressed) < msg_size:
+                self.stats['msg-compress'] = (
+                    self.stats.get('msg-compress', 0) + 1)
+                body, encoding = compressed, 'gzip'
+        if 0 < self.blob_min_size <= len(utf8(body)):
+            body = utf8(body)
+            return body, encoding, msg_size, self.blobs.blob_path(body)
+        return body, encoding, msg_size, None
+
+    def check_limits(self, chan_name, msgs, pending=0):
+        """Check the channel limits, and the bytes ceiling, for adding the
+        messages to the channel. Raise HighLevelMarkError if they do not
+        fit, or drop messages from the channel to make room for them (with
+        a drop overflow policy). The pending bytes of other messages to be
+        added count towards the ceiling. Returns the dropped messages.
+        """
+        size = sum(msg['size'] for msg in msgs)
+        if 0 < self.max_bytes < self.counts.total['bytes'] + pending + size:
+            raise HighLevelMarkError(
+                'The queue is at the ceiling of {} bytes of messages'
+                .format(self.max_bytes))
+        limits = self.limits.get(chan_name)
+        if limits is None:
+            max_messages, max_bytes, overflow = self.hlm, 0, self.overflow
+        else:
+            max_messages, max_bytes, overflow = (
+                limits['max_messages'], limits['max_bytes'],
+                limits['overflow'])
+        counts = self.counts.get(chan_name)
+        excess = max(counts['messages'] + len(msgs) - max_messages, 0) \
+            if max_messages > 0 else 0
+        excess_bytes = max(counts['bytes'] + size - max_bytes, 0) \
+            if max_bytes > 0 else 0
+        if not excess and not excess_bytes:
+            return []
+        if overflow == 'reject' or excess > counts['messages'] or \
+                excess_bytes > counts['bytes']:
+            if excess and counts['messages'] >= max_messages:
+                raise HighLevelMarkError(
+                    'Channel {} is at the high-level mark with {} messages'
+                    .format(chan_name, counts['messages']))
+            if excess:
+                raise HighLevelMarkError(
+                    'Channel {} has {} messages, adding {} messages exceeds '
+                    'the high-level mark'.format(
+                        chan_name, counts['messages'], len(msgs)))
+            raise HighLevelMarkError(
+                'Channel {} has {} bytes of messages, adding {} bytes '
+                'exceeds the limit of {} bytes'.format(
+                    chan_name, counts['bytes'], size, max_bytes))
+        return self.drop_messages(chan_name, excess, excess_bytes,
+                                  lowest=overflow == 'drop-lowest')
+
+    def drop_messages(self, chan_name, count, size, lowest=False):
+        """Drop at least count messages, and size bytes of messages, from
+        the channel, the oldest (or the lowest priority) first. Returns the
+        dropped messages.
+        """
+        dropped = []
+        candidates = self.overflow_candidates(chan_name, lowest)
+        for msg in candidates:
+            if count <= 0 and size <= 0:
+                break
+            dropped.append(msg)
+            count -= 1
+            size -= msg['size']
+        candidates.close()
+        self.delete_messages(dropped)
+        for msg in dropped:
+            self.count_deleted(msg)
+        self.stats['msg-dropped'] = (
+            self.stats.get('msg-dropped', 0) + len(dropped))
+        logging.debug('Dropped {} messages from channel {}'.format(
+            len(dropped), chan_name))
+        return dropped
+
+    def overflow_candidates(self, chan_name, lowest):
+        """Get the messages of the channel, in the order they are dropped on
+        overflow
+        """
+        for row in self.db.execute(
+                'select id, channel, show, priority, size from messages '
+                'where channel=? order by ' +
+                ('priority desc, id' if lowest else 'id'), (chan_name,)):
+            yield {k: row[k] for k in row.keys()}
+
+    def set_channel_limits(self, chan_name, max_messages, max_bytes,
+                           overflow):
+        """Set the limits of a channel (zero for no limit)"""
+        if overflow not in self.overflow_policies:
+            raise ValueError('Invalid overflow policy.')
+        limits = {'max_messages': max_messages, 'max_bytes': max_bytes,
+                  'overflow': overflow}
+        self.db.execute('insert or replace into limits values (?,?,?,?)',
+                        (chan_name, max_messages, max_bytes, overflow))
+        self.db.commit()
+        self.limits[chan_name] = limits
+
+    def delete_channel_limits(self, chan_name):
+        """Remove the limits of a channel (back to the defaults)"""
+        self.db.execute('delete from limits where channel=?', (chan_name,))
+        self.db.commit()
+        self.limits.pop(chan_name, None)
+
+    def channel_limits(self, chan_name):
+        """Get the limits of a channel, and the current usage"""
+        limits = self.limits.get(chan_name) or {
+            'max_messages': self.hlm, 'max_bytes': 0,
+            'overflow': self.overflow}
+        counts = self.counts.get(chan_name)
+        return {
+            'max-messages': limits['max_messages'],
+            'max-bytes': limits['max_bytes'],
+            'overflow': limits['overflow'],
+            'default': chan_name not in self.limits,
+            'messages': counts['messages'],
+            'bytes': counts['bytes']
+        }
+
+    def set_dead_letter(self, chan_name, target):
+        """Set the dead-letter channel of a channel"""
+        if target == chan_name:
+            raise ValueError('A channel can not be its own dead-letter '
+                             'channel.')
+        self.db.execute('insert or replace into dead_letters values (?,?)',
+                        (chan_name, target))
+        self.db.commit()
+        self.dead_letters[chan_name] = target
+
+    def delete_dead_letter(self, chan_name):
+        """Remove the dead-letter channel of a channel"""
+        self.db.execute('delete from dead_letters where channel=?',
+                        (chan_name,))
         self.db.commit()
+        self.dead_letters.pop(chan_name, None)
+
+    def get_dead_letter(self, chan_name):
+        """Get the dead-letter channel of a channel (or None)"""
+        return self.dead_letters.get(chan_name)
+
+    def queue_message(self, msg):
+        """Queue a stored message for delivery (or schedule it)"""
+        if msg['purge'] > 0:
+            self.deadlines.add(msg['purge'], ('purge', msg['id']))
 
         logging.debug('Adding message {}'.format(msg['id']))
         self.stats['msg-add'] = self.stats.get('msg-add', 0) + 1
+        self.metrics.inc('linger_channel_added_total', msg['channel'])
+
+        if msg['show'] > 0:
+            # scheduled, delivered when due
+            self.deadlines.add(msg['show'], ('show', msg['id']))
+            self.scheduled[msg['id']] = msg['show']
+            self.stats['msg-schedule'] = self.stats.get('msg-schedule', 0) + 1
+            return
 
         if not self.deliver_message(msg):
             # count it as shown (but not deliveried)
             self.stats['msg-show'] = self.stats.get('msg-show', 0) + 1
 
-        return msg['id']
+    def store_message(self, msg):
+        """Store a new message, and set the message id"""
+        c = self.db.execute(
+            'insert into messages (body, mimetype, topic, timeout, priority,'
+            'channel , ts, linger, purge, deliver, dcount, show, size, '
+            'encoding, blob) values (:body, :mimetype, :topic, :timeout, '
+            ':priority, :channel, :ts, :linger, :purge, :deliver, :dcount, '
+            ':show, :size, :encoding, :blob)', msg)
+        msg['id'] = c.lastrowid     # set message id
+        self.db.commit()
+        self.counts.add(msg)
+
+    def store_messages(self, msgs, shared_body=False):
+        """Store new messages, and set the message ids.
+
+        With shared_body, the messages have the same body, which is stored
+        once and referenced by the messages.
+        """
+        # ids are assigned up front, as autoincrement would have done
+        last_id = self.db.execute(
+            "select max(coalesce((select seq from sqlite_sequence where "
+            "name='messages'), 0), coalesce((select max(id) from messages), "
+            "0))").fetchone()[0]
+        for msg_id, msg in enumerate(msgs, last_id + 1):
+            msg['id'] = msg_id
+        if shared_body and len(msgs) > 1 and msgs[0]['blob'] is None:
+            body_id = self.db.execute(
+                'insert into bodies (body, refs) values (?,?)',
+                (msgs[0]['body'], len(msgs))).lastrowid
+            self.db.executemany(MSG_INSERT_SHARED, (
+                dict(msg, body_id=body_id) for msg in msgs))
+        else:
+            self.db.executemany(MSG_INSERT, msgs)
+        self.db.commit()
+        for msg in msgs:
+            self.counts.add(msg)
 
     def deliver_message(self, msg):
         """Attempt to deliver message to current listeners"""
         listeners = self.channels.get(msg['channel'])
         if listeners is not None and listeners.deliver(msg):
             # message is delivered right away
-            self.count_delivered(msg['id'])
+            self.count_delivered(msg)
             self.hide_message(msg)
             return True
         return False
 
     def hide_message(self, msg):
         """Hide message (timeout from queue) after delivery"""
-        msg['show'] = time.time() + msg['timeout']
-        msg['dcount'] += 1
-        self.db.execute('update messages set show=:show, dcount=:dcount '
-                        'where id=:id', msg)
+        self.hide_messages([msg])
+
+    def hide_messages(self, msgs):
+        """Hide messages (timeout from queue) after delivery"""
+        now = time.time()
+        for msg in msgs:
+            if msg['show'] == 0:
+                self.counts.hide(msg)
+            msg['show'] = now + msg['timeout']
+            msg['dcount'] += 1
+            self.deadlines.add(msg['show'], ('show', msg['id']))
+        self.db.executemany('update messages set show=:show, dcount=:dcount '
+                            'where id=:id', msgs)
         self.db.commit()
-        self.stats['msg-hide'] = self.stats.get('msg-hide', 0) + 1
+        self.stats['msg-hide'] = self.stats.get('msg-hide', 0) + len(msgs)
 
     def get_message(self, chan_name, nowait=False):
         """Get message from channel, returns a Future"""
+        return self.wait_messages(chan_name, 1, nowait, batch=False)
+
+    def get_messages(self, chan_name, count, nowait=False):
+        """Get up to count messages from channel, returns a Future resolving
+        to a list of messages (or None when there are no messages)
+        """
+        return self.wait_messages(chan_name, count, nowait, batch=True)
+
+    def wait_messages(self, chan_name, count, nowait, batch):
+        """Take messages from channel, or wait for a message"""
         self.stats['msg-get'] = self.stats.get('msg-get', 0) + 1
         future = tornado.concurrent.Future()
 
-        row = self.db.execute(
-            'select * from messages where channel=? and show<=? '
-            'order by priority', (chan_name, time.time())).fetchone()
+        msgs = self.take_messages(chan_name, count)
 
-        if not row:
+        if not msgs:
             # no messages
             if nowait:
                 # empty reply, right away
@@ -447,16 +2156,44 @@ class LingerQueue:
                     self.channels[chan_name] = channel
                     self.stats['channel-create'] = (
                         self.stats.get('channel-create', 0) + 1)
-                channel.add_future(future)
+                channel.add_future(future, batch)
+                self.listener_deadlines.add(time.time() + channel.time_out,
+                                            weakref.ref(future))
+                future.add_done_callback(functools.partial(
+                    self.count_waited, chan_name, time.perf_counter()))
         else:
-            # a message is ready for delivery
-            msg = {k: row[k] for k in row.keys()}
-            self.count_delivered(msg['id'])
-            self.hide_message(msg)
-            future.set_result(msg)
+            # messages are ready for delivery
+            future.set_result(msgs if batch else msgs[0])
 
         return future
 
+    def take_messages(self, chan_name, count):
+        """Take up to count messages ready for delivery from a channel,
+        hiding them in one transaction
+        """
+        msgs = self.next_messages(chan_name, count)
+        if msgs:
+            for msg in msgs:
+                self.count_delivered(msg)
+            self.hide_messages(msgs)
+        return msgs
+
+    def next_messages(self, chan_name, count=1):
+        """Get the next messages ready for delivery in a channel, in
+        priority order
+        """
+        # ready messages (show=0) and messages with an expired visibility
+        # timeout (not yet shown by the heartbeat) are looked up separately,
+        # to allow both to be served from idx_messages_channel
+        rows = self.db.execute(
+            'select * from (' + MSG_SELECT + ' where m.channel=? and '
+            'm.show=0 order by m.priority, m.id limit ?) union all '
+            'select * from (' + MSG_SELECT + ' where m.channel=? and '
+            'm.show>0 and m.show<=? order by m.priority, m.id limit ?) '
+            'order by priority, id limit ?',
+            (chan_name, count, chan_name, time.time(), count, count))
+        return [{k: row[k] for k in row.keys()} for row in rows]
+
     def drain_channel(self, chan_name):
         self.stats['channel-drain'] = self.stats.get('channel-drain', 0) + 1
         c = self.db.execute('delete from messages where channel=?',
@@ -464,50 +2201,115 @@ class LingerQueue:
         logging.debug('Drained {} messages from channel {}'
                       .format(c, chan_name))
         self.db.commit()
+        self.counts.drop(chan_name)
 
     def channel_stats(self, chan_name):
-        ready_count = self.db.execute(
-                'select count(*) from messages where channel=? and show=0',
-                (chan_name,)
-            ).fetchone()[0]
-        hidden_count = self.db.execute(
-                'select count(*) from messages where channel=? and show>0',
-                (chan_name,)
-            ).fetchone()[0]
-        return {'ready': ready_count, 'hidden': hidden_count}
-
-    def count_delivered(self, msg_id):
-        logging.debug('Delivering message {}'.format(msg_id))
+        counts = self.counts.get(chan_name)
+        return {'ready': counts['messages'] - counts['hidden'],
+                'hidden': counts['hidden']}
+
+    def count_waited(self, chan_name, t0, future):
+        self.metrics.observe('linger_longpoll_wait_seconds',
+                             time.perf_counter() - t0, chan_name)
+
+    def count_delivered(self, msg):
+        logging.debug('Delivering message {}'.format(msg['id']))
         self.stats['delivered'] = self.stats.get('delivered', 0) + 1
+        self.metrics.inc('linger_channel_delivered_total', msg['channel'])
+        self.metrics.observe('linger_delivery_latency_seconds',
+                             time.time() - msg['ts'], msg['channel'])
 
-    def count_deleted(self, msg_id):
-        logging.debug('Deleting message {}'.format(msg_id))
+    def count_deleted(self, msg):
+        logging.debug('Deleting message {}'.format(msg['id']))
         self.stats['msg-delete'] = self.stats.get('msg-delete', 0) + 1
+        self.metrics.inc('linger_channel_deleted_total', msg['channel'])
+
+    def count_dead_lettered(self, msg):
+        logging.debug('Moving message {} to the dead-letter channel'
+                      .format(msg['id']))
+        self.stats['msg-dead-letter'] = (
+            self.stats.get('msg-dead-letter', 0) + 1)
+        self.metrics.inc('linger_channel_dead_lettered_total', msg['channel'])
 
     def touch_message_from_id(self, msg_id):
-        row = self.db.execute('select show, timeout from messages where id=?',
-                              (msg_id,)).fetchone()
+        row = self.db.execute('select channel, show, timeout from messages '
+                              'where id=?', (msg_id,)).fetchone()
         if row is None:
             return False
         show = time.time() + row['timeout']
         self.db.execute('update messages set show=? where id=?', (show, msg_id))
         self.db.commit()
+        if row['show'] == 0:
+            self.counts.hide(row)
+        self.deadlines.add(show, ('show', msg_id))
         self.stats['msg-touch'] = self.stats.get('msg-touch', 0) + 1
         return True
 
     def delete_message_from_id(self, msg_id):
-        delete_count = self.db.execute(
-            'delete from messages where id=?', (msg_id,)).rowcount
-        self.db.commit()
-        if delete_count != 1:
+        row = self.db.execute('select id, channel, show, priority, size from '
+                              'messages where id=?', (msg_id,)).fetchone()
+        if row is None:
             logging.debug('Attempt at deleting non-existent message {}'
                           .format(msg_id))
             return False
-        self.count_deleted(msg_id)
+        self.db.execute('delete from messages where id=?', (msg_id,))
+        self.db.commit()
+        self.counts.remove(row)
+        self.count_deleted(row)
         return True
 
+    def find_message_states(self, msg_ids):
+        """Get a mapping of message id -> row of (id, channel, show,
+        priority, timeout, size), for the messages that exist
+        """
+        msg_ids = list(msg_ids)
+        rows = {}
+        # keep within the limit of variables in a sqlite statement
+        for i in range(0, len(msg_ids), 500):
+            chunk = msg_ids[i:i + 500]
+            rows.update((row['id'], row) for row in self.db.execute(
+                'select id, channel, show, priority, timeout, size from '
+                'messages where id in ({})'.format(
+                    ','.join('?' * len(chunk))), chunk))
+        return rows
+
+    def touch_messages_from_ids(self, msg_ids):
+        """Touch messages (reset timeout) in one transaction, returns the
+        list of touched message ids
+        """
+        rows = self.find_message_states(msg_ids)
+        if not rows:
+            return []
+        now = time.time()
+        params = [(now + row['timeout'], msg_id)
+                  for msg_id, row in rows.items()]
+        self.db.executemany('update messages set show=? where id=?', params)
+        self.db.commit()
+        for show, msg_id in params:
+            self.deadlines.add(show, ('show', msg_id))
+            if rows[msg_id]['show'] == 0:
+                self.counts.hide(rows[msg_id])
+        self.stats['msg-touch'] = (
+            self.stats.get('msg-touch', 0) + len(params))
+        return list(rows)
+
+    def delete_messages_from_ids(self, msg_ids):
+        """Delete messages in one transaction, returns the list of deleted
+        message ids
+        """
+        rows = self.find_message_states(msg_ids)
+        if not rows:
+            return []
+        self.db.executemany('delete from messages where id=?',
+                            ((msg_id,) for msg_id in rows))
+        self.db.commit()
+        for msg_id, row in rows.items():
+            self.counts.remove(row)
+            self.count_deleted(row)
+        return list(rows)
+
     def add_subscription(self, chan_name, topic, priority, timeout, deliver,
-                         linger):
+                         linger, delay=0, dead_letter=None):
         sub = {
             'channel': chan_name,  # channel name
             'topic': topic,        # topic name
@@ -515,13 +2317,17 @@ class LingerQueue:
             'priority': priority,  # message priority
             'linger': linger,      # message retention (seconds)
             'deliver': deliver,    # max delivery count
-            'ts': time.time()      # timestamp (when created)
+            'ts': time.time(),     # timestamp (when created)
+            'delay': delay,        # delay of published messages (seconds)
+            'dead_letter': dead_letter  # dead-letter channel (or None)
         }
 
         self.db.execute(
             'insert or replace into subscriptions values (:topic,:channel,'
-            ':timeout,:priority,:linger,:deliver,:ts)', sub)
+            ':timeout,:priority,:linger,:deliver,:ts,:delay,:dead_letter)',
+            sub)
         self.db.commit()
+        self.cache_subscription(sub)
 
         self.stats['subscription-add'] = self.stats.get('sub-add', 0) + 1
         logging.debug('Subscribing {} -> {}'.format(chan_name, topic))
@@ -531,14 +2337,71 @@ class LingerQueue:
             'delete from subscriptions where topic=? and channel=?',
             (topic, chan_name))
         self.db.commit()
+        self.uncache_subscription(chan_name, topic)
 
         self.stats['subscription-delete'] = self.stats.get('sub-delete', 0) + 1
         logging.debug('Unsubscribing {} -> {}'.format(chan_name, topic))
 
+    def cache_subscription(self, sub):
+        """Add (or replace) a subscription in the routing cache"""
+        self.subscriptions.setdefault(sub['topic'], {})[sub['channel']] = sub
+        if TopicTrie.is_pattern(sub['topic']):
+            self.topic_trie.add(sub['topic'], sub['channel'], sub)
+
+    def uncache_subscription(self, chan_name, topic):
+        """Remove a subscription from the routing cache"""
+        subs = self.subscriptions.get(topic)
+        if subs is not None:
+            subs.pop(chan_name, None)
+            if not subs:
+                del self.subscriptions[topic]
+        if TopicTrie.is_pattern(topic):
+            self.topic_trie.remove(topic, chan_name)
+
+    def route_topic(self, topic):
+        """Get the subscriptions for a topic, one per channel (an exact
+        topic subscription is preferred over a pattern subscription)
+        """
+        routes = dict(self.subscriptions.get(topic, ()))
+        for sub in sorted(self.topic_trie.match(topic),
+                          key=lambda sub: sub['topic']):
+            routes.setdefault(sub['channel'], sub)
+        return list(routes.values())
+
+    def list_subscriptions(self):
+        """Get the (topic, channel) of all subscriptions"""
+        return [(topic, chan_name)
+                for topic, subs in sorted(self.subscriptions.items())
+                for chan_name in sorted(subs)]
+
+    def add_routes(self, routes):
+        """Add (topic, channel) routes of subscriptions, in any shard"""
+        for topic, chan_name in routes:
+            self.routes.setdefault(topic, set()).add(chan_name)
+            if TopicTrie.is_pattern(topic):
+                self.route_trie.add(topic, chan_name, chan_name)
+
+    def delete_routes(self, routes):
+        """Delete (topic, channel) routes of subscriptions"""
+        for topic, chan_name in routes:
+            chans = self.routes.get(topic)
+            if chans is not None:
+                chans.discard(chan_name)
+                if not chans:
+                    del self.routes[topic]
+            if TopicTrie.is_pattern(topic):
+                self.route_trie.remove(topic, chan_name)
+
+    def route_channels(self, topic):
+        """Get the channels, in any shard, subscribed to the topic"""
+        chans = set(self.routes.get(topic, ()))
+        chans.update(self.route_trie.match(topic))
+        return sorted(chans)
+
     def list_channels(self):
-        channels = set(r[0] for r in self.db.execute(
-            'select distinct channel from messages union '
-            'select distinct channel from subscriptions'))
+        channels = set(self.counts.channels)
+        for subs in self.subscriptions.values():
+            channels.update(subs)
         channels.update(self.channels.keys())
         return list(sorted(channels))
 
@@ -554,18 +2417,20 @@ class LingerQueue:
         return topics
 
     def list_topic_subscribers(self, topic):
-        channels = [r[0] for r in self.db.execute(
-            'select channel from subscriptions where topic=? '
-            'order by channel', (topic,))]
-        return channels
+        """Get the channels a publish on the topic is routed to (including
+        pattern subscriptions), or subscribed to the topic pattern
+        """
+        if TopicTrie.is_pattern(topic):
+            return sorted(self.subscriptions.get(topic, ()))
+        return sorted(sub['channel'] for sub in self.route_topic(topic))
 
     def publish_message(self, topic, body, mime_type):
         """Publish a message on a topic"""
         published = {}
 
-        subscriptions = [
-            {k: row[k] for k in row.keys()} for row in self.db.execute(
-                'select * from subscriptions where topic=?', (topic,))]
+        if TopicTrie.is_pattern(topic):
+            raise ValueError('Can not publish on a topic pattern.')
+        subscriptions = self.route_topic(topic)
 
         if not subscriptions:
             logging.debug('Publishing on {}, no subscribers'.format(topic))
@@ -573,21 +2438,455 @@ class LingerQueue:
 
         logging.debug('Publishing on {}, {} subscribers'.format(
             topic, len(subscriptions)))
-        mpk = ('timeout', 'priority', 'linger', 'deliver')
-        for sub in subscriptions:
-            chan_name = sub['channel']
-            params = {k: sub[k] for k in mpk}
+        mpk = ('timeout', 'priority', 'linger', 'deliver', 'delay')
+        encoded = self.encode_body(body)
+        msgs = self.accept_copies([
+            self.new_message(sub['channel'], body, mime_type, topic=topic,
+                             encoded=encoded, **{k: sub[k] for k in mpk})
+            for sub in subscriptions])
+        if msgs and msgs[0]['blob'] is not None:
+            # (the limits are checked again, once the body is written)
+            return self.write_blobs(msgs, lambda msgs: self.publish_copies(
+                self.accept_copies(msgs)))
+        return self.publish_copies(msgs)
+
+    def accept_copies(self, msgs):
+        """Get the copies of a published message within the limits of their
+        channels
+        """
+        accepted = []
+        for msg in msgs:
             try:
-                msg_id = self.add_message(chan_name, body, mime_type,
-                                          topic=topic, **params)
+                # (with the copies accepted so far, not yet stored)
+                self.check_limits(msg['channel'], [msg],
+                                  pending=len(accepted) * msg['size'])
             except HighLevelMarkError as e:
                 logging.warning(e)
             else:
-                published[chan_name] = msg_id
-                self.stats['publish'] = self.stats.get('publish', 0) + 1
+                accepted.append(msg)
+        return accepted
+
+    def publish_copies(self, msgs):
+        """Store and queue the copies of a published message, returns the
+        mapping of channel -> message id
+        """
+        published = {}
+        if not msgs:
+            return published
+
+        # store the messages in one transaction, sharing the body
+        self.store_messages(msgs, shared_body=True)
+        for msg in msgs:
+            self.queue_message(msg)
+            published[msg['channel']] = msg['id']
+            self.stats['publish'] = self.stats.get('publish', 0) + 1
         return published
 
 
+class HeapLingerQueue(LingerQueue):
+    """A LingerQueue keeping the messages in memory.
+
+    Ready messages are kept in per-channel heaps ordered by priority and
+    message id, and visibility timeouts and retention are handled at their
+    deadlines. The database is only used as a write-behind journal, with
+    writes executed on (group) commit, and for restoring the queue on
+    restart.
+    """
+
+    write_behind = True
+
+    def __init__(self, *args, **kwargs):
+        # mapping of message id -> message
+        self.messages = {}
+        # mapping of channel name -> message ids (a dict with None values,
+        # in the order added to the channel)
+        self.channel_msgs = {}
+        # mapping of channel name -> heap of (-priority, id) of the
+        # messages, for dropping the lowest priority message on overflow
+        # (lazily pruned, and rebuilt when mostly stale)
+        self.overflow_heaps = {}
+        # mapping of channel name -> heap of (priority, id) for messages
+        # that are ready (or have been, the heaps are lazily pruned)
+        self.ready = {}
+        # message ids in the ready heaps
+        self.queued = set()
+        self.next_id = 1
+        self.next_body_id = 1
+        super().__init__(*args, **kwargs)
+
+    def restore_messages(self):
+        seq = dict(self.db.execute('select name, seq from sqlite_sequence'))
+        self.next_id = seq.get('messages', 0) + 1
+        self.next_body_id = seq.get('bodies', 0) + 1
+        for row in self.db.execute(MSG_SELECT + ' order by m.id'):
+            self.restore_record({k: row[k] for k in row.keys()})
+        logging.info('Restored {} messages'.format(len(self.messages)))
+
+    def restore_record(self, msg):
+        """Add a restored message, with its deadlines"""
+        self.next_id = max(self.next_id, msg['id'] + 1)
+        self.add_record(msg)
+        if msg['show'] > 0:
+            self.deadlines.add(msg['show'], ('show', msg['id']))
+            if msg['dcount'] == 0:
+                self.scheduled[msg['id']] = msg['show']
+        else:
+            self.push_ready(msg)
+        if msg['purge'] > 0:
+            self.deadlines.add(msg['purge'], ('purge', msg['id']))
+
+    def find_message(self, msg_id, body=True):
+        return self.messages.get(msg_id)
+
+    def referenced_blobs(self):
+        return {msg['blob'] for msg in self.messages.values()
+                if msg['blob'] is not None}
+
+    def show_messages(self, msgs):
+        for msg in msgs:
+            self.journal_update(msg, 'show')
+            self.push_ready(msg)
+
+    def delete_messages(self, msgs):
+        for msg in msgs:
+            self.remove_record(msg)
+
+    def move_messages(self, moves):
+        for msg, chan_name in moves:
+            self.count_dead_lettered(msg)
+            self.unindex_record(msg)
+            self.counts.remove(msg)
+            msg.update(channel=chan_name, show=0.0, purge=0, deliver=0,
+                       dcount=0)
+            self.index_record(msg)
+            self.counts.add(msg)
+            self.journal_update(msg, 'channel', 'show', 'purge', 'deliver',
+                                'dcount')
+            self.queued.discard(msg['id'])
+            self.push_ready(msg)
+
+    def add_record(self, msg):
+        """Add a message to the in-memory indexes"""
+        self.messages[msg['id']] = msg
+        self.index_record(msg)
+        self.counts.add(msg)
+
+    def remove_record(self, msg):
+        """Remove a message from memory and the database"""
+        del self.messages[msg['id']]
+        self.unindex_record(msg)
+        self.counts.remove(msg)
+        self.journal_delete([msg['id']])
+
+    def index_record(self, msg):
+        """Add a message to the indexes of its channel"""
+        ids = self.channel_msgs.setdefault(msg['channel'], {})
+        ids[msg['id']] = None
+        heap = self.overflow_heaps.setdefault(msg['channel'], [])
+        heapq.heappush(heap, (-msg['priority'], msg['id']))
+        if len(heap) > 2 * len(ids) + 64:
+            # mostly deleted messages, rebuild the heap
+            heap[:] = [(-self.messages[msg_id]['priority'], msg_id)
+                       for msg_id in ids]
+            heapq.heapify(heap)
+
+    def unindex_record(self, msg):
+        """Remove a message from the indexes of its channel (the overflow
+        heap is pruned lazily)
+        """
+        ids = self.channel_msgs[msg['channel']]
+        del ids[msg['id']]
+        if not ids:
+            del self.channel_msgs[msg['channel']]
+            self.overflow_heaps.pop(msg['channel'], None)
+
+    def journal_add(self, records, shared_body=False):
+        """Write new messages to the journal (with a shared body, the
+        messages have the same body, which is written once, unless in a
+        blob file)
+        """
+        if not shared_body or len(records) < 2 or \
+                records[0]['blob'] is not None:
+            for record in records:
+                self.db.defer(MSG_INSERT, record)
+            return
+        body_id = self.next_body_id
+        self.next_body_id += 1
+        self.db.defer('insert into bodies (id, body, refs) values (?,?,?)',
+                      (body_id, records[0]['body'], len(records)))
+        for record in records:
+            self.db.defer(MSG_INSERT_SHARED, dict(record, body_id=body_id))
+
+    def journal_update(self, record, *keys):
+        """Write changed fields of a message to the journal"""
+        self.db.defer('update messages set {} where id=?'.format(
+            ', '.join('{}=?'.format(k) for k in keys)),
+            [record[k] for k in keys] + [record['id']])
+
+    def journal_delete(self, msg_ids):
+        """Write deleted messages to the journal"""
+        for msg_id in msg_ids:
+            self.db.defer('delete from messages where id=?', (msg_id,))
+
+    def journal_drain(self, chan_name, msg_ids):
+        """Write a drained channel to the journal"""
+        self.db.defer('delete from messages where channel=?', (chan_name,))
+
+    def push_ready(self, msg):
+        """Add a message to the ready heap of the channel"""
+        if msg['id'] not in self.queued:
+            self.queued.add(msg['id'])
+            heapq.heappush(self.ready.setdefault(msg['channel'], []),
+                           (msg['priority'], msg['id']))
+
+    def max_message_id(self):
+        # messages are added in id order
+        return next(reversed(self.messages), None)
+
+    def store_message(self, msg):
+        msg['id'] = self.next_id
+        self.next_id += 1
+        # the stored record is kept separate from the message delivered
+        record = dict(msg)
+        self.journal_add([record])
+        self.add_record(record)
+        if record['show'] == 0:
+            self.push_ready(record)
+
+    def store_messages(self, msgs, shared_body=False):
+        records = []
+        for msg in msgs:
+            msg['id'] = self.next_id
+            self.next_id += 1
+            records.append(dict(msg))
+        self.journal_add(records, shared_body)
+        for record in records:
+            self.add_record(record)
+            if record['show'] == 0:
+                self.push_ready(record)
+
+    def hide_messages(self, msgs):
+        now = time.time()
+        for msg in msgs:
+            record = self.messages[msg['id']]
+            if record['show'] == 0:
+                self.counts.hide(record)
+            msg['show'] = record['show'] = now + record['timeout']
+            msg['dcount'] = record['dcount'] = record['dcount'] + 1
+            self.journal_update(record, 'show', 'dcount')
+            self.deadlines.add(record['show'], ('show', record['id']))
+        self.stats['msg-hide'] = self.stats.get('msg-hide', 0) + len(msgs)
+
+    def next_messages(self, chan_name, count=1):
+        msgs = []
+        heap = self.ready.get(chan_name)
+        while heap and len(msgs) < count:
+            _, msg_id = heapq.heappop(heap)
+            self.queued.discard(msg_id)
+            msg = self.messages.get(msg_id)
+            # (moved messages are left in the heap of their old channel)
+            if msg is not None and msg['show'] == 0 and \
+                    msg['channel'] == chan_name:
+                msgs.append(dict(msg))
+        if heap is not None and not heap:
+            del self.ready[chan_name]
+        return msgs
+
+    def overflow_candidates(self, chan_name, lowest):
+        # (the candidates are dropped after the generator is closed)
+        if not lowest:
+            for msg_id in self.channel_msgs.get(chan_name, ()):
+                yield self.messages[msg_id]
+            return
+        heap = self.overflow_heaps.get(chan_name, [])
+        while heap:
+            msg = self.messages.get(heap[0][1])
+            if msg is not None and msg['channel'] == chan_name:
+                yield msg
+            # popped when taken, or deleted (or moved)
+            heapq.heappop(heap)
+
+    def drain_channel(self, chan_name):
+        self.stats['channel-drain'] = self.stats.get('channel-drain', 0) + 1
+        ids = self.channel_msgs.pop(chan_name, {})
+        self.overflow_heaps.pop(chan_name, None)
+        for msg_id in ids:
+            del self.messages[msg_id]
+        self.queued.difference_update(ids)
+        self.ready.pop(chan_name, None)
+        self.counts.drop(chan_name)
+        self.journal_drain(chan_name, ids)
+        logging.debug('Drained {} messages from channel {}'
+                      .format(len(ids), chan_name))
+
+    def touch_message_from_id(self, msg_id):
+        msg = self.messages.get(msg_id)
+        if msg is None:
+            return False
+        if msg['show'] == 0:
+            self.counts.hide(msg)
+        msg['show'] = time.time() + msg['timeout']
+        self.journal_update(msg, 'show')
+        self.deadlines.add(msg['show'], ('show', msg_id))
+        self.stats['msg-touch'] = self.stats.get('msg-touch', 0) + 1
+        return True
+
+    def delete_message_from_id(self, msg_id):
+        msg = self.messages.get(msg_id)
+        if msg is None:
+            logging.debug('Attempt at deleting non-existent message {}'
+                          .format(msg_id))
+            return False
+        self.remove_record(msg)
+        self.count_deleted(msg)
+        return True
+
+    def touch_messages_from_ids(self, msg_ids):
+        return [msg_id for msg_id in msg_ids
+                if self.touch_message_from_id(msg_id)]
+
+    def delete_messages_from_ids(self, msg_ids):
+        deleted = []
+        for msg_id in msg_ids:
+            msg = self.messages.get(msg_id)
+            if msg is not None:
+                self.remove_record(msg)
+                self.count_deleted(msg)
+                deleted.append(msg_id)
+        return deleted
+
+
+class LogLingerQueue(HeapLingerQueue):
+    """A LingerQueue keeping the messages in memory, as HeapLingerQueue,
+    with the messages written to an append-only log (a MessageLog in the
+    directory <dbfile>-log) instead of the database, which keeps the
+    configuration and subscriptions. The messages are restored by
+    replaying the log, and old log segments are compacted from the
+    heartbeat.
+    """
+
+    write_behind = False
+
+    # copy the live messages of the oldest log segment forward, to remove
+    # the segment, when at most this number of messages remain
+    compact_max_copy = 1000
+
+    def __init__(self, dbfile=':memory:', hlm=0, commit_interval=0,
+                 commit_max_ops=0, db_thread=False, vacuum=False,
+                 db_profile='default'):
+        self.log = MessageLog(
+            None if dbfile == ':memory:' else dbfile + '-log',
+            commit_interval, commit_max_ops, writer_thread=db_thread)
+        super().__init__(dbfile, hlm, commit_interval, commit_max_ops,
+                         db_thread, vacuum, db_profile)
+
+    def init_db(self):
+        super().init_db()
+        # start the log (restoring the messages of a log without database)
+        self.restore_messages()
+
+    def restore_messages(self):
+        msgs = {}
+        for record in self.log.replay():
+            if record[0] == 'add':
+                msgs.update((msg['id'], msg) for msg in record[1])
+            elif record[0] == 'set':
+                if record[1] in msgs:
+                    msgs[record[1]].update(record[2])
+            elif record[0] == 'delete':
+                for msg_id in record[1]:
+                    msgs.pop(msg_id, None)
+
+        # messages in the database (stored by another engine) are moved to
+        # the log
+        rows = self.db.execute(MSG_SELECT + ' order by m.id').fetchall()
+        if rows:
+            moved = [{k: row[k] for k in row.keys()} for row in rows]
+            self.log.append(('add', moved))
+            self.log.flush()
+            self.log.sync()
+            msgs.update((msg['id'], msg) for msg in moved)
+            self.db.execute('delete from messages')
+            self.db.execute('delete from bodies')
+            self.db.commit()
+            logging.info('Moved {} messages from the database to the log'
+                         .format(len(moved)))
+
+        seq = dict(self.db.execute('select name, seq from sqlite_sequence'))
+        self.next_id = max(self.log.next_id, seq.get('messages', 0) + 1)
+        for msg_id in sorted(msgs):
+            msg = msgs[msg_id]
+            # (logged before messages had an encoding, blob or size)
+            msg.setdefault('encoding', None)
+            msg.setdefault('blob', None)
+            if 'size' not in msg:
+                msg['size'] = len(utf8(decode_body(msg)))
+            self.restore_record(msg)
+        logging.info('Restored {} messages'.format(len(self.messages)))
+
+    def stop(self):
+        self.log.close()
+        super().stop()
+
+    def heartbeat(self):
+        super().heartbeat()
+        self.compact_log()
+
+    def compact_log(self):
+        """Remove the oldest log segment when all messages added in it are
+        deleted, or copy its messages forward when few remain
+        """
+        segment, msg_ids = self.log.oldest_segment()
+        if segment is None:
+            return
+        if not msg_ids:
+            self.log.remove_segment(segment)
+            self.stats['log-segment-remove'] = (
+                self.stats.get('log-segment-remove', 0) + 1)
+        elif len(msg_ids) <= self.compact_max_copy:
+            self.stats['log-msg-copy'] = (
+                self.stats.get('log-msg-copy', 0) + len(msg_ids))
+            # (the ids are moved to the current segment)
+            self.log.append(('add', [self.messages[msg_id]
+                                     for msg_id in sorted(msg_ids)]))
+
+    def durable(self, chan_names=None):
+        return self.log.durable()
+
+    def count_messages(self):
+        """Count the messages in memory"""
+        counts = MessageCounts()
+        for msg in self.messages.values():
+            counts.add(msg)
+        return counts
+
+    def server_stats(self):
+        s = super().server_stats()
+        s['log-size'] = self.log.size()
+        return s
+
+    def journal_add(self, records, shared_body=False):
+        # records sharing a body object are pickled with the body once
+        self.log.append(('add', records))
+
+    def journal_update(self, record, *keys):
+        self.log.append(('set', record['id'], {k: record[k] for k in keys}))
+
+    def journal_delete(self, msg_ids):
+        self.log.append(('delete', list(msg_ids)))
+
+    def journal_drain(self, chan_name, msg_ids):
+        self.log.append(('delete', list(msg_ids)))
+
+
+# storage engines, selectable with the engine option
+engines = {
+    'sqlite': LingerQueue,
+    'memory-heap': HeapLingerQueue,
+    'memory-log': LogLingerQueue
+}
+
+
 class RequestHandler(tornado.web.RequestHandler):
 
     @property
@@ -609,63 +2908,104 @@ class RequestHandler(tornado.web.RequestHandler):
         else:
             self.finish('HTTP {} {}\n'.format(status_code, self._reason))
 
+    def on_finish(self):
+        self.queue.metrics.observe(
+            'linger_request_duration_seconds', self.request.request_time(),
+            type(self).__name__, self.request.method)
+
 
 class ReqParamMixin:
 
-    def req_params(self):
+    def req_params(self, args=None):
+        """Get the message parameters from the request arguments, or from the
+        args mapping, with the request arguments as defaults
+        """
+        if args is None:
+            get = self.get_argument
+        else:
+            def get(name, default):
+                return args.get(name, self.get_argument(name, default))
+
         try:
-            priority = int(self.get_argument('priority', 0))
-        except ValueError:
+            priority = int(get('priority', 0))
+        except (ValueError, TypeError):
             self.send_error(400, reason='Invalid message priority.')
             return
 
         try:
-            timeout = int(self.get_argument('timeout', 30))
+            timeout = int(get('timeout', 30))
             if timeout < 1:
                 raise ValueError()
-        except ValueError:
+        except (ValueError, TypeError):
             self.send_error(400, reason='Invalid message visibility timeout.')
             return
 
         try:
-            deliver = int(self.get_argument('deliver', 0))
+            deliver = int(get('deliver', 0))
             if deliver < 0:
                 raise ValueError()
-        except ValueError:
+        except (ValueError, TypeError):
             self.send_error(400, reason='Invalid message delivery limit.')
             return
 
         try:
-            linger = int(self.get_argument('linger', 0))
+            linger = int(get('linger', 0))
             if linger < 0:
                 raise ValueError()
-        except ValueError:
+        except (ValueError, TypeError):
             self.send_error(400, reason='Invalid message delivery limit.')
             return
 
+        try:
+            delay = float(get('delay', 0))
+            not_before = float(get('not_before', 0))
+            if not (0 <= delay < math.inf and 0 <= not_before < math.inf):
+                raise ValueError()
+        except (ValueError, TypeError):
+            self.send_error(400, reason='Invalid message schedule.')
+            return
+
         return dict(priority=priority, timeout=timeout, deliver=deliver,
-                    linger=linger)
+                    linger=linger, delay=delay, not_before=not_before)
 
 
 class ChannelListHandler(RequestHandler):
 
+    @coroutine
     def get(self):
         """/channels - list channels"""
-        channels = self.queue.list_channels()
+        channels = yield self.queue.call('list_channels')
         self.finish({'channels': channels})
 
 
 class ChannelMessagesHandler(RequestHandler, ReqParamMixin):
 
+    blob_chunk_size = 64 * 1024
+    fill_interval = 0.05
+
     def prepare(self):
         self.future = None
+        self.closed = False
 
     @coroutine
     def get(self, chan_name):
         """/channels/<channel> - get message from channel"""
         nowait = self.get_argument('nowait', None) is not None
+        try:
+            max_count = int(self.get_argument('max', 0))
+            fill = float(self.get_argument('fill', 0))
+            if max_count < 0 or not 0 <= fill <= 10:
+                raise ValueError()
+        except ValueError:
+            self.send_error(400, reason='Invalid batch size or fill time.')
+            return
+        max_count = min(max_count, self.settings.get('batch_max_size', 1000))
 
-        self.future = self.queue.get_message(chan_name, nowait)
+        if max_count:
+            yield self.get_batch(chan_name, nowait, max_count, fill)
+            return
+
+        self.future = self.queue.call('get_message', chan_name, nowait)
         msg = yield self.future
 
         self.set_header('x-linger-channel', chan_name)
@@ -676,24 +3016,124 @@ class ChannelMessagesHandler(RequestHandler, ReqParamMixin):
             return
 
         # set response headers
-        self.set_header('Content-Type', msg['mimetype'])
-        self.set_header('x-linger-msg-id', msg['id'])
-        self.set_header('x-linger-priority', msg['priority'])
-        self.set_header('x-linger-timeout', msg['timeout'])
-        self.set_header('x-linger-deliver', msg['deliver'])
-        self.set_header('x-linger-delivered', msg['dcount'])
-        self.set_header('x-linger-received', int(time.time() - msg['ts']))
-        self.set_header('x-linger-linger', int(msg['linger']))
-        self.set_header('x-linger-topic', msg['topic'])
-
-        # deliver the message
-        self.finish(msg['body'])
+        for name, value in self.msg_headers(msg):
+            self.set_header(name, value)
+
+        # deliver the message, a compressed body as is to consumers
+        # accepting it
+        self.add_header('Vary', 'Accept-Encoding')
+        encoded = msg['encoding'] is not None and self.accepts(
+            msg['encoding'])
+        if encoded:
+            self.set_header('Content-Encoding', msg['encoding'])
+        if msg['blob'] is not None:
+            yield self.send_blob(msg, encoded)
+        elif encoded:
+            self.finish(msg['body'])
+        else:
+            self.finish(decode_body(msg))
+
+    @coroutine
+    def send_blob(self, msg, encoded):
+        """Stream the body of a message from its blob file, in chunks (of
+        at most blob_chunk_size bytes before decompression)
+        """
+        decompressor = None
+        if encoded:
+            self.set_header('Content-Length', os.path.getsize(msg['blob']))
+        else:
+            self.set_header('Content-Length', msg['size'])
+            if msg['encoding'] == 'gzip':
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        with open(msg['blob'], 'rb') as f:
+            while True:
+                chunk = f.read(self.blob_chunk_size)
+                if not chunk:
+                    break
+                if decompressor is not None:
+                    chunk = decompressor.decompress(chunk)
+                self.write(chunk)
+                yield self.flush()
+        self.finish()
+
+    @coroutine
+    def get_batch(self, chan_name, nowait, max_count, fill):
+        """Get up to max_count messages, and deliver them in a
+        multipart/mixed response (with the message meta data as headers
+        of each part)
+        """
+        self.future = self.queue.call('get_messages', chan_name, max_count,
+                                      nowait)
+        msgs = yield self.future
+
+        self.set_header('x-linger-channel', chan_name)
+
+        if msgs is None:
+            self.set_status(204)
+            self.finish()
+            return
+
+        if fill and len(msgs) < max_count:
+            # wait for more messages to fill the batch, taking them every
+            # fill_interval seconds until the batch is full
+            deadline = time.time() + fill
+            while len(msgs) < max_count:
+                yield sleep(min(self.fill_interval,
+                                max(deadline - time.time(), 0)))
+                if self.closed:
+                    # (the messages taken are shown again after their
+                    # visibility timeout)
+                    return
+                more = yield self.queue.call('take_messages', chan_name,
+                                             max_count - len(msgs))
+                msgs.extend(more)
+                if time.time() >= deadline:
+                    break
+
+        boundary = uuid.uuid4().hex
+        self.set_header('Content-Type',
+                        'multipart/mixed; boundary={}'.format(boundary))
+        self.set_header('x-linger-count', len(msgs))
+        delimiter = utf8('--{}\r\n'.format(boundary))
+        for msg in msgs:
+            headers = ''.join('{}: {}\r\n'.format(name, value)
+                              for name, value in self.msg_headers(msg))
+            self.write(delimiter + utf8(headers) + b'\r\n' +
+                       utf8(decode_body(msg)) + b'\r\n')
+        self.finish(utf8('--{}--\r\n'.format(boundary)))
+
+    def accepts(self, encoding):
+        """Whether the client accepts the content encoding"""
+        for value in self.request.headers.get('Accept-Encoding', '').split(
+                ','):
+            name, _, params = value.partition(';')
+            if name.strip() == encoding:
+                # (the encoding is refused with a zero quality value)
+                return params.replace(' ', '') not in ('q=0', 'q=0.0')
+        return False
+
+    @staticmethod
+    def msg_headers(msg):
+        """Get the response headers with the message meta data"""
+        return [
+            ('Content-Type', msg['mimetype']),
+            ('x-linger-msg-id', msg['id']),
+            ('x-linger-priority', msg['priority']),
+            ('x-linger-timeout', msg['timeout']),
+            ('x-linger-deliver', msg['deliver']),
+            ('x-linger-delivered', msg['dcount']),
+            ('x-linger-received', int(time.time() - msg['ts'])),
+            ('x-linger-linger', int(msg['linger'])),
+            ('x-linger-topic', msg['topic'])
+        ]
 
     def on_connection_close(self):
+        self.closed = True
         if self.future and not self.future.done():
             logging.debug('Connection closed prematurely')
             self.future.set_result(None)
 
+    @coroutine
     def post(self, chan_name):
         """/channels/<channel> - add message to channel"""
         body = self.get_argument('msg', None)
@@ -708,8 +3148,8 @@ class ChannelMessagesHandler(RequestHandler, ReqParamMixin):
             return
 
         try:
-            msg_id = self.queue.add_message(
-                chan_name, body, mime_type, **params)
+            msg_id = yield self.queue.call(
+                'add_message', chan_name, body, mime_type, **params)
         except ValueError as e:
             self.send_error(400, reason=e.args[0])
             return
@@ -717,60 +3157,297 @@ class ChannelMessagesHandler(RequestHandler, ReqParamMixin):
             self.send_error(507, reason=e.args[0])
             return
 
+        if self.settings.get('commit_ack') == 'durable':
+            yield self.queue.call('durable', [chan_name])
+
         self.set_status(202)
         self.finish({'id': msg_id})
 
+    @coroutine
     def delete(self, chan_name):
         """/channels/<channel> - drain the channel"""
-        self.queue.drain_channel(chan_name)
+        yield self.queue.call('drain_channel', chan_name)
         self.set_status(204)
 
 
+class ChannelStreamHandler(tornado.websocket.WebSocketHandler):
+    """/channels/<channel>/stream - stream messages from the channel
+
+    Messages are pushed as binary frames, with the message meta data as
+    headers before the body (as the parts of a batch), with up to prefetch
+    delivered messages not yet acked (deleted) by the consumer. The
+    consumer sends text frames with a JSON object with a list of message
+    ids to ack (delete), {"ack": [...]}, or to touch (reset timeout),
+    {"touch": [...]}, and gets a text frame with the result (as for
+    /messages/delete and /messages/touch).
+    """
+
+    @property
+    def queue(self):
+        return self.settings['queue']
+
+    def check_origin(self, origin):
+        return True
+
+    @coroutine
+    def get(self, chan_name):
+        try:
+            self.prefetch = int(self.get_argument('prefetch', 10))
+            if not 1 <= self.prefetch <= 1000:
+                raise ValueError()
+        except ValueError:
+            self.set_status(400, reason='Invalid prefetch count.')
+            self.finish('HTTP 400 Invalid prefetch count.\n')
+            return
+        yield super().get(chan_name)
+
+    def open(self, chan_name):
+        self.chan_name = chan_name
+        self.closed = False
+        self.in_flight = set()
+        self.future = None
+        self.credit = None
+        tornado.ioloop.IOLoop.current().spawn_callback(self.deliver)
+
+    @coroutine
+    def deliver(self):
+        """Deliver messages while there are credits (fewer than prefetch
+        messages in flight)
+        """
+        while not self.closed:
+            count = self.prefetch - len(self.in_flight)
+            if count <= 0:
+                self.credit = tornado.concurrent.Future()
+                yield self.credit
+                continue
+            self.future = self.queue.call('get_messages', self.chan_name,
+                                          count)
+            msgs = yield self.future
+            for msg in msgs or []:
+                self.in_flight.add(msg['id'])
+                headers = ''.join(
+                    '{}: {}\r\n'.format(name, value) for name, value in
+                    ChannelMessagesHandler.msg_headers(msg))
+                try:
+                    self.write_message(utf8(headers) + b'\r\n' +
+                                       utf8(decode_body(msg)), binary=True)
+                except tornado.websocket.WebSocketClosedError:
+                    return
+
+    @coroutine
+    def on_message(self, message):
+        try:
+            req = json_decode(message)
+            action = 'ack' if 'ack' in req else 'touch'
+            msg_ids = req[action]
+            if not isinstance(msg_ids, list) or not all(
+                    type(i) is int and i >= 0 for i in msg_ids):
+                raise ValueError()
+        except (ValueError, KeyError, TypeError):
+            self.close(1003, 'Invalid list of message numbers.')
+            return
+
+        msg_ids = list(collections.OrderedDict.fromkeys(msg_ids))
+        done = yield self.queue.call(
+            'delete_messages_from_ids' if action == 'ack'
+            else 'touch_messages_from_ids', msg_ids)
+        if action == 'ack':
+            # acked messages are no longer in flight, also when not found
+            # (deleted elsewhere, or delivered again after a timeout)
+            self.in_flight.difference_update(msg_ids)
+            if self.credit is not None and not self.credit.done():
+                self.credit.set_result(None)
+        done_set = set(done)
+        if not self.closed:
+            self.write_message({
+                'deleted' if action == 'ack' else 'touched': [
+                    i for i in msg_ids if i in done_set],
+                'not-found': [i for i in msg_ids if i not in done_set]
+            })
+
+    def on_close(self):
+        logging.debug('Stream closed')
+        self.closed = True
+        for future in (self.future, self.credit):
+            if future is not None and not future.done():
+                future.set_result(None)
+
+
+class ChannelBatchHandler(RequestHandler, ReqParamMixin):
+
+    @coroutine
+    def post(self, chan_name):
+        """/channels/<channel>/batch - add a batch of messages to channel
+
+        The request body has one JSON object per line (NDJSON), with the
+        message in "msg", and optionally "mimetype", "priority", "timeout",
+        "deliver", "linger", "delay" and "not_before" (the query parameters
+        are the defaults).
+        """
+        msgs = []
+        for line_no, line in enumerate(self.request.body.splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                item = json_decode(line)
+                body = item['msg']
+                mime_type = item.get('mimetype', 'text/plain')
+                if not isinstance(body, str) or not isinstance(mime_type, str):
+                    raise TypeError()
+            except (ValueError, KeyError, TypeError, AttributeError):
+                self.send_error(400, reason='Invalid message on line {}.'
+                                .format(line_no))
+                return
+            params = self.req_params(item)
+            if not params:
+                return
+            msgs.append(dict(body=body, mime_type=mime_type, **params))
+
+        try:
+            msg_ids = yield self.queue.call('add_messages', chan_name, msgs)
+        except ValueError as e:
+            self.send_error(400, reason=e.args[0])
+            return
+        except HighLevelMarkError as e:
+            self.send_error(507, reason=e.args[0])
+            return
+
+        if self.settings.get('commit_ack') == 'durable':
+            yield self.queue.call('durable', [chan_name])
+
+        self.set_status(202)
+        self.finish({'ids': msg_ids})
+
+
 class ChannelStatsHandler(RequestHandler):
 
+    @coroutine
     def get(self, chan_name):
         """/channels/<channel>/stats - get channel stats"""
-        chan_stats = self.queue.channel_stats(chan_name)
+        chan_stats = yield self.queue.call('channel_stats', chan_name)
         self.finish(chan_stats)
 
 
+class ChannelLimitsHandler(RequestHandler):
+
+    @coroutine
+    def get(self, chan_name):
+        """/channels/<channel>/limits - get the channel limits and usage"""
+        limits = yield self.queue.call('channel_limits', chan_name)
+        self.finish(limits)
+
+    @coroutine
+    def put(self, chan_name):
+        """/channels/<channel>/limits - set the channel limits"""
+        try:
+            max_messages = int(self.get_argument('max_messages', 0))
+            max_bytes = int(self.get_argument('max_bytes', 0))
+            if max_messages < 0 or max_bytes < 0:
+                raise ValueError()
+        except ValueError:
+            self.send_error(400, reason='Invalid channel limits.')
+            return
+
+        try:
+            yield self.queue.call(
+                'set_channel_limits', chan_name, max_messages, max_bytes,
+                self.get_argument('overflow', 'reject'))
+        except ValueError as e:
+            self.send_error(400, reason=e.args[0])
+            return
+        self.set_status(204)
+
+    @coroutine
+    def delete(self, chan_name):
+        """/channels/<channel>/limits - remove the channel limits"""
+        yield self.queue.call('delete_channel_limits', chan_name)
+        self.set_status(204)
+
+
+class ChannelDeadLetterHandler(RequestHandler):
+
+    @coroutine
+    def get(self, chan_name):
+        """/channels/<channel>/dead-letter - get the dead-letter channel"""
+        target = yield self.queue.call('get_dead_letter', chan_name)
+        self.finish({'channel': target})
+
+    @coroutine
+    def put(self, chan_name):
+        """/channels/<channel>/dead-letter - set the dead-letter channel"""
+        target = self.get_argument('channel', '')
+        if not target:
+            self.send_error(400, reason='Invalid dead-letter channel.')
+            return
+        try:
+            yield self.queue.call('set_dead_letter', chan_name, target)
+        except ValueError as e:
+            self.send_error(400, reason=e.args[0])
+            return
+        self.set_status(204)
+
+    @coroutine
+    def delete(self, chan_name):
+        """/channels/<channel>/dead-letter - remove the dead-letter channel"""
+        yield self.queue.call('delete_dead_letter', chan_name)
+        self.set_status(204)
+
+
 class ChannelTopicListHandler(RequestHandler):
 
+    @coroutine
     def get(self, chan_name):
         """/channels/<channel>/topics - list topics a channel is subscribed to
         """
-        topics = self.queue.list_topics_for_channel(chan_name)
+        topics = yield self.queue.call('list_topics_for_channel', chan_name)
         self.finish({'topics': topics})
 
 
 class ChannelTopicSubHandler(RequestHandler, ReqParamMixin):
 
+    @coroutine
     def put(self, chan_name, topic_name):
         """/channels/<channel>/topics/<topic> - subscribe channel to a topic"""
         params = self.req_params()
         if not params:
             return
+        if params.pop('not_before'):
+            self.send_error(400, reason='Subscriptions are scheduled with a '
+                                        'delay, not with not_before.')
+            return
+        dead_letter = self.get_argument('dead_letter', None)
+        if dead_letter is not None and dead_letter in ('', chan_name):
+            self.send_error(400, reason='Invalid dead-letter channel.')
+            return
 
-        self.queue.add_subscription(chan_name, topic_name, **params)
+        try:
+            yield self.queue.call('add_subscription', chan_name, topic_name,
+                                  dead_letter=dead_letter, **params)
+        except ValueError as e:
+            self.send_error(400, reason=e.args[0])
+            return
         self.set_status(204)
 
+    @coroutine
     def delete(self, chan_name, topic_name):
         """/channels/<channel>/topics/<topic> - unsubscribe channel from topic
         """
-        self.queue.delete_subscription(chan_name, topic_name)
+        yield self.queue.call('delete_subscription', chan_name, topic_name)
         self.set_status(204)
 
 
 class TopicListHandler(RequestHandler):
 
+    @coroutine
     def get(self):
         """/topics - list topics"""
-        topics = self.queue.list_topics()
+        topics = yield self.queue.call('list_topics')
         self.finish({'topics': topics})
 
 
 class TopicHandler(RequestHandler):
 
+    @coroutine
     def post(self, topic):
         """/topics/<topic> - publish message on topic"""
         body = self.get_argument('msg', None)
@@ -781,25 +3458,31 @@ class TopicHandler(RequestHandler):
             mime_type = 'text/plain'
 
         try:
-            published = self.queue.publish_message(topic, body, mime_type)
+            published = yield self.queue.call('publish_message', topic, body,
+                                              mime_type)
         except ValueError as e:
             self.send_error(400, reason=e.args[0])
             return
 
+        if self.settings.get('commit_ack') == 'durable':
+            yield self.queue.call('durable', list(published))
+
         self.set_status(202)
         self.finish(published)
 
 
 class TopicChannelListHandler(RequestHandler):
 
+    @coroutine
     def get(self, topic):
         """/topics/<topic>/channels - list channels subscribed to topic"""
-        channels = self.queue.list_topic_subscribers(topic)
+        channels = yield self.queue.call('list_topic_subscribers', topic)
         self.finish({'channels': channels})
 
 
 class MessageTouchHandler(RequestHandler):
 
+    @coroutine
     def post(self, msg_id):
         """/messages/<msg-id>/touch - touch message (reset timeout)"""
         try:
@@ -809,7 +3492,8 @@ class MessageTouchHandler(RequestHandler):
         except ValueError:
             self.send_error(400, reason='Invalid message number.')
 
-        if self.queue.touch_message_from_id(msg_id):
+        touched = yield self.queue.call('touch_message_from_id', msg_id)
+        if touched:
             self.set_status(204)
         else:
             self.set_status(404, reason='Message not found.')
@@ -817,6 +3501,7 @@ class MessageTouchHandler(RequestHandler):
 
 class MessageHandler(RequestHandler):
 
+    @coroutine
     def delete(self, msg_id):
         """/messages/<msg-id> - delete message"""
         try:
@@ -826,17 +3511,61 @@ class MessageHandler(RequestHandler):
         except ValueError:
             self.send_error(400, reason='Invalid message number.')
 
-        if self.queue.delete_message_from_id(msg_id):
+        deleted = yield self.queue.call('delete_message_from_id', msg_id)
+        if deleted:
             self.set_status(204)
         else:
             self.set_status(404, reason='Message not found.')
 
 
+class MessageBulkHandler(RequestHandler):
+
+    @coroutine
+    def post(self, action):
+        """/messages/delete - delete messages
+        /messages/touch - touch messages (reset timeout)
+
+        The request body is a JSON object with the list of message ids in
+        "ids".
+        """
+        try:
+            msg_ids = json_decode(self.request.body)['ids']
+            if not isinstance(msg_ids, list) or not all(
+                    type(i) is int and i >= 0 for i in msg_ids):
+                raise ValueError()
+        except (ValueError, KeyError, TypeError):
+            self.send_error(400, reason='Invalid list of message numbers.')
+            return
+
+        msg_ids = list(collections.OrderedDict.fromkeys(msg_ids))
+        done = yield self.queue.call(
+            'delete_messages_from_ids' if action == 'delete'
+            else 'touch_messages_from_ids', msg_ids)
+        done_set = set(done)
+        self.finish({
+            'deleted' if action == 'delete' else 'touched': [
+                i for i in msg_ids if i in done_set],
+            'not-found': [i for i in msg_ids if i not in done_set]
+        })
+
+
 class StatsHandler(RequestHandler):
 
+    @coroutine
     def get(self):
         """/stats - get server stats"""
-        self.finish(self.queue.server_stats())
+        stats = yield self.queue.call('server_stats')
+        self.finish(stats)
+
+
+class MetricsHandler(RequestHandler):
+
+    @coroutine
+    def get(self):
+        """/metrics - get metrics in the Prometheus text format"""
+        text = yield self.queue.call('metrics_text')
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.finish(text)
 
 
 class HomeHandler(RequestHandler):
@@ -847,28 +3576,84 @@ class HomeHandler(RequestHandler):
                      'hostname': platform.uname()[1]})
 
 
-def make_app():
-    linger_queue = LingerQueue(options.dbfile, options.hlm)
+def check_options():
+    """Exit if the options are invalid"""
+    if options.engine not in engines:
+        logging.error('Invalid engine option "{}", expected one of: {}'
+                      .format(options.engine, ', '.join(sorted(engines))))
+        sys.exit(1)
+    if options.commit_ack not in ('durable', 'queued'):
+        logging.error('Invalid commit_ack option "{}", expected "durable" or '
+                      '"queued"'.format(options.commit_ack))
+        sys.exit(1)
+    if options.overflow not in LingerQueue.overflow_policies:
+        logging.error('Invalid overflow option "{}", expected one of: {}'
+                      .format(options.overflow,
+                              ', '.join(LingerQueue.overflow_policies)))
+        sys.exit(1)
+    if options.db_profile not in SQLDB.profiles:
+        logging.error('Invalid db_profile option "{}", expected one of: {}'
+                      .format(options.db_profile,
+                              ', '.join(sorted(SQLDB.profiles))))
+        sys.exit(1)
+    if options.batch_max_size < 1:
+        logging.error('Invalid batch_max_size option {}, expected at least 1'
+                      .format(options.batch_max_size))
+        sys.exit(1)
+
+
+def make_queue():
+    """Create the queue from the options"""
+    check_options()
+    linger_queue = engines[options.engine](
+        options.dbfile, options.hlm, options.commit_interval_ms,
+        options.commit_max_ops, options.db_thread, options.vacuum_on_start,
+        options.db_profile)
+    linger_queue.check_counts = options.stats_check
+    linger_queue.vacuum_free_bytes = options.vacuum_free_mb * 1024 * 1024
+    linger_queue.max_bytes = options.max_bytes_mb * 1024 * 1024
+    linger_queue.overflow = options.overflow
+    linger_queue.compress_min_size = options.compress_min_size
+    linger_queue.blob_min_size = options.blob_min_size
+    linger_queue.msg_max_size = options.msg_max_size
+    return linger_queue
+
+
+def make_app(linger_queue=None):
+    """Create the application, serving the queue (or a QueueProxy of the
+    queue in another process), created from the options if not given
+    """
+    check_options()
+    if linger_queue is None:
+        linger_queue = make_queue()
 
     settings = {
         'debug': options.debug,
         'queue': linger_queue,
+        'commit_ack': options.commit_ack,
+        'batch_max_size': options.batch_max_size,
         'shutdown_callback': linger_queue.stop,
     }
 
     handlers = {
         (r'/', HomeHandler),
         (r'/channels/([\w%-]+)/stats', ChannelStatsHandler),
-        (r'/channels/([\w%-]+)/topics/([\w%-]+)', ChannelTopicSubHandler),
+        (r'/channels/([\w%-]+)/batch', ChannelBatchHandler),
+        (r'/channels/([\w%-]+)/stream', ChannelStreamHandler),
+        (r'/channels/([\w%-]+)/limits', ChannelLimitsHandler),
+        (r'/channels/([\w%-]+)/dead-letter', ChannelDeadLetterHandler),
+        (r'/channels/([\w%-]+)/topics/([\w%.*-]+)', ChannelTopicSubHandler),
         (r'/channels/([\w%-]+)/topics', ChannelTopicListHandler),
         (r'/channels/([\w%-]+)', ChannelMessagesHandler),
         (r'/channels', ChannelListHandler),
-        (r'/topics/([\w%-]+)/channels', TopicChannelListHandler),
-        (r'/topics/([\w%-]+)', TopicHandler),
+        (r'/topics/([\w%.*-]+)/channels', TopicChannelListHandler),
+        (r'/topics/([\w%.*-]+)', TopicHandler),
         (r'/topics', TopicListHandler),
         (r'/messages/(\d+)/touch', MessageTouchHandler),
         (r'/messages/(\d+)', MessageHandler),
-        (r'/stats', StatsHandler)
+        (r'/messages/(delete|touch)', MessageBulkHandler),
+        (r'/stats', StatsHandler),
+        (r'/metrics', MetricsHandler)
     }
 
     application = tornado.web.Application(handlers, **settings)
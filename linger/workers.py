@@ -0,0 +1,494 @@
+"""Linger - Queue owner and worker processes
+
+Copyright 2015-2018 Nephics AB
+Licensed under the Apache License, Version 2.0
+
+With multiple worker processes, the queue is owned by the main process,
+serving the queue methods over a Unix socket to the worker processes,
+which serve the HTTP API (sharing the port with SO_REUSEPORT). With shards,
+the channels are partitioned across queues owned by shard processes.
+"""
+
+import functools
+import itertools
+import pickle
+import socket
+import struct
+import time
+import zlib
+
+import tornado.concurrent
+import tornado.ioloop
+import tornado.iostream
+import tornado.tcpserver
+
+from tornado.gen import coroutine, multi, sleep
+
+from . import linger
+
+# frames are a 4 byte length, followed by a pickled tuple
+HEADER = struct.Struct('!I')
+
+
+@coroutine
+def read_frame(stream):
+    """Read a frame from the stream"""
+    header = yield stream.read_bytes(HEADER.size)
+    data = yield stream.read_bytes(HEADER.unpack(header)[0])
+    return pickle.loads(data)
+
+
+def write_frame(stream, obj):
+    """Write a frame to the stream"""
+    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    return stream.write(HEADER.pack(len(data)) + data)
+
+
+class QueueServer(tornado.tcpserver.TCPServer):
+    """Serve the queue methods to worker processes.
+
+    On connect the queue config is sent, then requests are (request id,
+    method, args, kwargs), and responses are (request id, exception,
+    result), sent when the result is ready. A request with method None
+    cancels a pending request (a long-poll), resolving it with None.
+    """
+
+    # queue methods callable by the workers
+    methods = frozenset((
+        'add_message', 'add_messages', 'add_routes', 'add_subscription',
+        'channel_limits', 'channel_stats', 'delete_channel_limits',
+        'delete_dead_letter', 'delete_message_from_id',
+        'delete_messages_from_ids', 'delete_routes', 'delete_subscription',
+        'drain_channel', 'durable', 'get_dead_letter', 'get_message',
+        'get_messages', 'list_channels', 'list_subscriptions',
+        'list_topic_subscribers', 'list_topics', 'list_topics_for_channel',
+        'metrics_text', 'publish_message', 'route_channels', 'server_stats',
+        'set_channel_limits', 'set_dead_letter', 'take_messages',
+        'touch_message_from_id', 'touch_messages_from_ids'))
+
+    def __init__(self, queue):
+        super().__init__()
+        self.queue = queue
+
+    @coroutine
+    def handle_stream(self, stream, address):
+        # mapping of request id -> Future, for requests in progress
+        pending = {}
+        write_frame(stream, self.queue.config)
+        try:
+            while True:
+                req_id, method, args, kwargs = yield read_frame(stream)
+                if method is None:
+                    future = pending.pop(req_id, None)
+                    if future is not None and not future.done():
+                        future.set_result(None)
+                    continue
+                if method in self.methods:
+                    future = self.queue.call(method, *args, **kwargs)
+                else:
+                    future = tornado.concurrent.Future()
+                    future.set_exception(AttributeError(
+                        'Method {} is not available'.format(method)))
+                pending[req_id] = future
+                future.add_done_callback(functools.partial(
+                    self.respond, stream, pending, req_id))
+        except tornado.iostream.StreamClosedError:
+            # the worker is gone, end its long-polls
+            for future in pending.values():
+                if not future.done():
+                    future.set_result(None)
+
+    def respond(self, stream, pending, req_id, future):
+        """Send the result of a request"""
+        pending.pop(req_id, None)
+        if stream.closed():
+            return
+        error = future.exception()
+        response = (req_id, error, None if error else future.result())
+        try:
+            write_frame(stream, response)
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            write_frame(stream, (req_id, RuntimeError(str(e)), None))
+
+
+class QueueProxy:
+    """A proxy of the queue owned by another process (served by a
+    QueueServer), with the call() interface of LingerQueue
+    """
+
+    def __init__(self, path, on_close=None):
+        self.path = path
+        self.on_close = on_close
+        self.stream = None
+        self.config = None
+        # mapping of request id -> Future, for requests in progress
+        self.pending = {}
+        self.req_ids = itertools.count()
+        # metrics of the requests served by this process
+        self.metrics = linger.Metrics()
+        for name, kind, help, labels in linger.LingerQueue._metrics:
+            if name == 'linger_request_duration_seconds':
+                self.metrics.define(name, kind, help, labels)
+
+    @coroutine
+    def connect(self, timeout=10.0):
+        """Connect to the queue server (waiting for it to start listening)
+        """
+        deadline = time.time() + timeout
+        while True:
+            stream = tornado.iostream.IOStream(
+                socket.socket(socket.AF_UNIX, socket.SOCK_STREAM))
+            try:
+                yield stream.connect(self.path)
+                break
+            except (OSError, tornado.iostream.StreamClosedError):
+                if time.time() > deadline:
+                    raise
+                yield sleep(0.05)
+        self.stream = stream
+        self.config = yield read_frame(stream)
+        tornado.ioloop.IOLoop.current().add_future(
+            self.read_responses(), lambda future: future.result())
+
+    @coroutine
+    def read_responses(self):
+        """Resolve the requests with the responses from the server"""
+        try:
+            while True:
+                req_id, error, result = yield read_frame(self.stream)
+                future = self.pending.pop(req_id, None)
+                if future is None or future.done():
+                    continue
+                if error is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(error)
+        except tornado.iostream.StreamClosedError:
+            pending, self.pending = self.pending, {}
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(
+                        ConnectionError('Lost the connection to the queue'))
+            if self.on_close is not None:
+                self.on_close()
+
+    def call(self, method, *args, **kwargs):
+        """Call a method of the queue, returns a Future of the result"""
+        if method == 'metrics_text':
+            return self.metrics_text()
+        return self.request(method, args, kwargs)
+
+    def request(self, method, args=(), kwargs=None):
+        """Send a request to the server, returns a Future of the result"""
+        future = tornado.concurrent.Future()
+        if self.stream.closed():
+            future.set_exception(
+                ConnectionError('Lost the connection to the queue'))
+            return future
+        req_id = next(self.req_ids)
+        self.pending[req_id] = future
+        future.add_done_callback(functools.partial(self.cancel, req_id))
+        write_frame(self.stream, (req_id, method, args, kwargs or {}))
+        return future
+
+    def cancel(self, req_id, future):
+        """Cancel the request in the server, when the future is resolved
+        before the response (ending a long-poll)
+        """
+        if self.pending.pop(req_id, None) is not None and \
+                not self.stream.closed():
+            write_frame(self.stream, (req_id, None, None, None))
+
+    @coroutine
+    def metrics_text(self):
+        """Get the queue metrics, and the request metrics of this process"""
+        text = yield self.request('metrics_text')
+        lines = self.metrics.expose()
+        return text + ''.join(line + '\n' for line in lines)
+
+    def stop(self):
+        """Close the connection to the server"""
+        self.on_close = None
+        if self.stream is not None:
+            self.stream.close()
+
+
+def map_future(future, fn):
+    """Get a Future of fn(result) of the future, resolving the future with
+    None if the returned Future is resolved first (ending a long-poll)
+    """
+    mapped = tornado.concurrent.Future()
+
+    def done(future):
+        if mapped.done():
+            return
+        if future.exception() is not None:
+            mapped.set_exception(future.exception())
+        else:
+            mapped.set_result(fn(future.result()))
+
+    def cancel(mapped):
+        if not future.done():
+            future.set_result(None)
+
+    future.add_done_callback(done)
+    mapped.add_done_callback(cancel)
+    return mapped
+
+
+class ShardedQueue:
+    """A queue with the channels partitioned across shards (by a hash of
+    the channel name), each a queue owned by another process, with the
+    call() interface of LingerQueue.
+
+    Message ids are unique across the shards, the id of a message is the
+    id in the shard times the number of shards, plus the shard index.
+    Topic publishes are sent to the shards of the subscribed channels only,
+    found in the routes of the topic, kept in the shard of the topic (or
+    in all shards, for topic patterns).
+    """
+
+    # stats that are not summed across the shards
+    first_stats = ('db-file', 'hostname', 'id', 'msg-max-id', 'msg-max-size',
+                   'pid', 'version')
+
+    def __init__(self, shards):
+        self.shards = shards
+        self.config = shards[0].config
+        # metrics of the requests served by this process
+        self.metrics = shards[0].metrics
+
+    def shard_index(self, chan_name):
+        """Get the index of the shard owning the channel (or the routes of
+        the topic)
+        """
+        return zlib.crc32(chan_name.encode('utf-8')) % len(self.shards)
+
+    def route_shards(self, topic):
+        """Get the shards keeping the routes of the topic (pattern)"""
+        if linger.TopicTrie.is_pattern(topic):
+            return self.shards
+        return [self.shards[self.shard_index(topic)]]
+
+    @coroutine
+    def sync_routes(self):
+        """Add the routes of the subscriptions in all shards (on start, the
+        routes are only kept in memory)
+        """
+        results = yield self.broadcast('list_subscriptions')
+        routes = {}
+        for topic, chan_name in itertools.chain(*results):
+            for shard in self.route_shards(topic):
+                routes.setdefault(shard, []).append((topic, chan_name))
+        yield multi([shard.call('add_routes', shard_routes)
+                     for shard, shard_routes in routes.items()])
+
+    def encode(self, index, msg_id):
+        """Get the global message id of a message id in a shard"""
+        return msg_id * len(self.shards) + index
+
+    def decode(self, msg_id):
+        """Get the (shard index, message id in the shard) of a message id
+        """
+        return msg_id % len(self.shards), msg_id // len(self.shards)
+
+    def encode_msgs(self, index, msgs):
+        """Set the global message ids of messages (or a message) from a
+        shard
+        """
+        if msgs is None:
+            return None
+        for msg in msgs if isinstance(msgs, list) else [msgs]:
+            msg['id'] = self.encode(index, msg['id'])
+        return msgs
+
+    def call(self, method, *args, **kwargs):
+        """Call a method of the queue, returns a Future of the result"""
+        call = getattr(self, 'call_' + method, None)
+        if call is not None:
+            return call(*args, **kwargs)
+        # channel methods, in the shard of the channel
+        index = self.shard_index(args[0])
+        future = self.shards[index].call(method, *args, **kwargs)
+        if method == 'add_message':
+            return map_future(
+                future, functools.partial(self.encode, index))
+        if method == 'add_messages':
+            return map_future(future, lambda msg_ids: [
+                self.encode(index, msg_id) for msg_id in msg_ids])
+        if method in ('get_message', 'get_messages', 'take_messages'):
+            return map_future(
+                future, functools.partial(self.encode_msgs, index))
+        return future
+
+    def broadcast(self, method, *args):
+        """Call the method in all shards, returns a Future of the list of
+        results
+        """
+        return multi([shard.call(method, *args) for shard in self.shards])
+
+    def call_touch_message_from_id(self, msg_id):
+        index, msg_id = self.decode(msg_id)
+        return self.shards[index].call('touch_message_from_id', msg_id)
+
+    def call_delete_message_from_id(self, msg_id):
+        index, msg_id = self.decode(msg_id)
+        return self.shards[index].call('delete_message_from_id', msg_id)
+
+    @coroutine
+    def bulk(self, method, msg_ids):
+        """Call a bulk method with the message ids of each shard"""
+        ids = {}
+        for msg_id in msg_ids:
+            index, shard_id = self.decode(msg_id)
+            ids.setdefault(index, []).append(shard_id)
+        results = yield multi({
+            index: self.shards[index].call(method, shard_ids)
+            for index, shard_ids in ids.items()})
+        return [self.encode(index, msg_id)
+                for index, done in results.items() for msg_id in done]
+
+    def call_touch_messages_from_ids(self, msg_ids):
+        return self.bulk('touch_messages_from_ids', msg_ids)
+
+    def call_delete_messages_from_ids(self, msg_ids):
+        return self.bulk('delete_messages_from_ids', msg_ids)
+
+    @coroutine
+    def merge(self, method, *args):
+        """Get the sorted union of the lists from all shards"""
+        results = yield self.broadcast(method, *args)
+        return sorted(set().union(*results))
+
+    def call_list_channels(self):
+        return self.merge('list_channels')
+
+    def call_list_topics(self):
+        return self.merge('list_topics')
+
+    def call_list_topic_subscribers(self, topic):
+        return self.merge('list_topic_subscribers', topic)
+
+    @coroutine
+    def call_publish_message(self, topic, body, mime_type):
+        if linger.TopicTrie.is_pattern(topic):
+            raise ValueError('Can not publish on a topic pattern.')
+        chan_names = yield self.shards[self.shard_index(topic)].call(
+            'route_channels', topic)
+        indexes = sorted(set(self.shard_index(chan_name)
+                             for chan_name in chan_names))
+        results = yield multi([
+            self.shards[index].call('publish_message', topic, body,
+                                    mime_type)
+            for index in indexes])
+        published = {}
+        for index, result in zip(indexes, results):
+            published.update((chan_name, self.encode(index, msg_id))
+                             for chan_name, msg_id in result.items())
+        return published
+
+    def call_durable(self, chan_names=None):
+        if chan_names is None:
+            return self.broadcast('durable')
+        indexes = set(self.shard_index(chan_name) for chan_name in chan_names)
+        return multi([self.shards[index].call('durable')
+                      for index in sorted(indexes)])
+
+    def check_dead_letter(self, chan_name, target):
+        """Raise ValueError if the dead-letter channel is in another shard
+        (messages are moved to it within the shard)
+        """
+        if target is not None and \
+                self.shard_index(target) != self.shard_index(chan_name):
+            raise ValueError('The dead-letter channel is in another shard.')
+
+    def call_set_dead_letter(self, chan_name, target):
+        self.check_dead_letter(chan_name, target)
+        return self.shards[self.shard_index(chan_name)].call(
+            'set_dead_letter', chan_name, target)
+
+    @coroutine
+    def call_add_subscription(self, chan_name, topic, *args,
+                              dead_letter=None, **kwargs):
+        self.check_dead_letter(chan_name, dead_letter)
+        # (the route is added first, a publish may not miss the channel)
+        yield multi([shard.call('add_routes', [(topic, chan_name)])
+                     for shard in self.route_shards(topic)])
+        yield self.shards[self.shard_index(chan_name)].call(
+            'add_subscription', chan_name, topic, *args,
+            dead_letter=dead_letter, **kwargs)
+
+    @coroutine
+    def call_delete_subscription(self, chan_name, topic):
+        yield self.shards[self.shard_index(chan_name)].call(
+            'delete_subscription', chan_name, topic)
+        yield multi([shard.call('delete_routes', [(topic, chan_name)])
+                     for shard in self.route_shards(topic)])
+
+    @coroutine
+    def call_server_stats(self):
+        results = yield self.broadcast('server_stats')
+        stats = {}
+        for result in results:
+            for k, v in result.items():
+                if k in self.first_stats or k not in stats:
+                    stats.setdefault(k, v)
+                elif k == 'start':
+                    stats[k] = min(stats[k], v)
+                elif k == 'current-uptime':
+                    stats[k] = max(stats[k], v)
+                elif isinstance(v, (int, float)):
+                    stats[k] += v
+        stats['msg-max-id'] = max(
+            [self.encode(index, result['msg-max-id'])
+             for index, result in enumerate(results)
+             if result['msg-max-id'] is not None] or [None])
+        topics = yield self.merge('list_topics')
+        stats['current-topics'] = len(topics)
+        stats['shards'] = len(self.shards)
+        return stats
+
+    @coroutine
+    def call_metrics_text(self):
+        texts = yield multi([shard.request('metrics_text')
+                             for shard in self.shards])
+        lines = merge_metrics(texts)
+        lines.extend(self.metrics.expose())
+        return ''.join(line + '\n' for line in lines)
+
+    def stop(self):
+        """Close the connections to the shards"""
+        for shard in self.shards:
+            shard.stop()
+
+
+def merge_metrics(texts):
+    """Merge metrics in the text format, summing the samples of the same
+    series (the start time is the earliest)
+    """
+    families = {}   # name -> [help and type lines, {series -> value}]
+    for text in texts:
+        name = None
+        for line in text.splitlines():
+            if line.startswith('#'):
+                name = line.split()[2]
+                family = families.setdefault(name, [[], {}])
+                if len(family[0]) < 2:
+                    family[0].append(line)
+                continue
+            series, value = line.rsplit(' ', 1)
+            samples = families[name][1]
+            value = float(value)
+            if series not in samples:
+                samples[series] = value
+            elif name == 'linger_start_time_seconds':
+                samples[series] = min(samples[series], value)
+            else:
+                samples[series] += value
+    lines = []
+    for name, (header, samples) in families.items():
+        lines.extend(header)
+        lines.extend('{} {}'.format(series, int(value) if value.is_integer()
+                                    else value)
+                     for series, value in samples.items())
+    return lines
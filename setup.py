@@ -16,7 +16,8 @@ setup(name='linger',
       packages=['linger'],
       entry_points={
         'console_scripts': [
-          'linger = linger.__main__:main'
+          'linger = linger.__main__:main',
+          'linger-bench = linger.bench:main'
         ],
       },
       install_requires=['tornado>=4.5.2'],
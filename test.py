@@ -1,22 +1,33 @@
+import base64
+import os.path
+import sqlite3
+import tempfile
 import time
 import unittest
 
-from tornado.escape import url_escape, json_decode
-from tornado.gen import sleep
+from datetime import timedelta
+
+from tornado.escape import url_escape, json_decode, json_encode, utf8
+from tornado.gen import sleep, with_timeout
+from tornado.httpclient import HTTPClientError
 from tornado.testing import (AsyncTestCase, AsyncHTTPTestCase, gen_test,
                              main as testing_main)
 from tornado.options import options
 
-from linger import linger
+from tornado.netutil import bind_unix_socket
+from tornado.websocket import websocket_connect
+from linger import linger, workers
 
 options.logging = None
 
 
 class UnitTestMethods(AsyncTestCase):
 
+    queue_class = linger.LingerQueue
+
     def setUp(self):
         super().setUp()
-        self.q = linger.LingerQueue()
+        self.q = self.queue_class()
         self.kwargs = {  # default add_message kwargs
             'chan_name': 'test',
             'body': 'test msg',
@@ -28,6 +39,12 @@ class UnitTestMethods(AsyncTestCase):
             'topic': ''
         }
 
+    def tearDown(self):
+        # the maintained message counts match a recount of the database
+        self.assertTrue(self.q.verify_counts())
+        self.q.stop()
+        super().tearDown()
+
     def check_msg(self, msg, orig, delay=0.1):
         """Check that msg match the original"""
         now = time.time()
@@ -92,6 +109,153 @@ class UnitTestMethods(AsyncTestCase):
         stats = self.q.channel_stats(chan_name)
         self.assertEqual(sum(stats.values()), 0)
 
+    @gen_test
+    def test_add_messages(self):
+        """Add a batch of msgs, get them in priority order"""
+        chan_name = self.kwargs.pop('chan_name')
+        del self.kwargs['topic']
+        msgs = []
+        for i in range(3):
+            kwargs = dict(self.kwargs, body=str(i), priority=-i)
+            msgs.append(kwargs)
+        msg_ids = self.q.add_messages(chan_name, msgs)
+        self.assertEqual(len(set(msg_ids)), 3)
+        self.assertEqual(self.q.channel_stats(chan_name),
+                         {'ready': 3, 'hidden': 0})
+        for i in reversed(range(3)):
+            msg = yield self.q.get_message(chan_name, nowait=True)
+            self.assertEqual(msg['body'], str(i))
+            self.assertEqual(msg['id'], msg_ids[i])
+        # ids continue after the batch
+        self.assertTrue(self.q.add_message(chan_name, **self.kwargs) >
+                        max(msg_ids))
+
+        # the high-level mark applies to the whole batch
+        self.q.hlm = 5
+        with self.assertRaises(linger.HighLevelMarkError):
+            self.q.add_messages(chan_name, msgs)
+
+    @gen_test
+    def test_channel_limits(self):
+        """Reject, or drop messages, at the channel limits"""
+        chan_name = self.kwargs['chan_name']
+        self.q.set_channel_limits(chan_name, 3, 0, 'drop-oldest')
+        for body in '1234':
+            self.q.add_message(**dict(self.kwargs, body=body))
+        msg = yield self.q.get_message(chan_name, nowait=True)
+        self.assertEqual(msg['body'], '2')
+        self.assertEqual(self.q.server_stats()['msg-dropped'], 1)
+
+        # drop the lowest priority messages first
+        self.q.set_channel_limits(chan_name, 3, 0, 'drop-lowest')
+        self.q.add_message(**dict(self.kwargs, body='5', priority=1))
+        self.q.add_message(**dict(self.kwargs, body='6', priority=-1))
+        msgs = yield self.q.get_messages(chan_name, 3, nowait=True)
+        self.assertEqual([msg['body'] for msg in msgs], ['6', '3', '4'])
+
+        # reject at the byte limit, or with a batch over the limits
+        self.q.set_channel_limits('other', 0, 10, 'drop-oldest')
+        self.q.add_message(**dict(self.kwargs, chan_name='other',
+                                  body='12345678'))
+        with self.assertRaises(linger.HighLevelMarkError):
+            batch = dict(self.kwargs, body='123456')
+            del batch['chan_name']
+            self.q.add_messages('other', [batch, batch])
+        self.q.set_channel_limits('other', 0, 10, 'reject')
+        with self.assertRaises(linger.HighLevelMarkError):
+            self.q.add_message(**dict(self.kwargs, chan_name='other',
+                                      body='123'))
+        self.assertEqual(self.q.channel_limits('other'), {
+            'max-messages': 0, 'max-bytes': 10, 'overflow': 'reject',
+            'default': False, 'messages': 1, 'bytes': 8})
+        with self.assertRaises(ValueError):
+            self.q.set_channel_limits('other', 0, 10, 'unknown')
+
+        # the ceiling of the bytes of all messages
+        self.q.delete_channel_limits('other')
+        self.q.max_bytes = 20
+        with self.assertRaises(linger.HighLevelMarkError):
+            self.q.add_message(**dict(self.kwargs, chan_name='other',
+                                      body='x' * 20))
+        self.assertTrue(self.q.channel_limits('other')['default'])
+
+        # the copies of a published message count towards the ceiling
+        self.q.drain_channel(chan_name)
+        self.q.drain_channel('other')
+        for chan in ('a', 'b', 'c'):
+            self.q.add_subscription(chan, 'some-topic', 0, 30, 0, 0)
+        with self.assertLogs(level='WARNING'):
+            published = self.q.publish_message('some-topic', 'x' * 8,
+                                               'text/plain')
+        self.assertEqual(len(published), 2)
+        self.assertEqual(self.q.server_stats()['current-messages-bytes'], 16)
+
+    @gen_test
+    def test_get_messages(self):
+        """Get a batch of msgs, and wait for a batch"""
+        chan_name = self.kwargs['chan_name']
+        for _ in range(3):
+            self.q.add_message(**self.kwargs)
+        msgs = yield self.q.get_messages(chan_name, 2, nowait=True)
+        self.assertEqual(len(msgs), 2)
+        for msg in msgs:
+            self.check_msg(msg, self.kwargs)
+        msgs = yield self.q.get_messages(chan_name, 2, nowait=True)
+        self.assertEqual(len(msgs), 1)
+        self.assertEqual(self.q.channel_stats(chan_name),
+                         {'ready': 0, 'hidden': 3})
+        msgs = yield self.q.get_messages(chan_name, 2, nowait=True)
+        self.assertIsNone(msgs)
+
+        # wait for a message
+        future = self.q.get_messages(chan_name, 2)
+        self.q.add_message(**self.kwargs)
+        msgs = yield future
+        self.assertEqual(len(msgs), 1)
+        self.check_msg(msgs[0], self.kwargs)
+
+    @gen_test
+    def test_counts(self):
+        """Maintain message counts, check them against the database"""
+        chan_name = self.kwargs['chan_name']
+        for priority in (-1, 0, 1):
+            self.q.add_message(**dict(self.kwargs, priority=priority))
+        yield self.q.get_message(chan_name, nowait=True)
+        stats = self.q.server_stats()
+        self.assertEqual(
+            [stats['current-messages' + k] for k in (
+                '', '-ready', '-hidden', '-urgent', '-niced')],
+            [3, 2, 1, 1, 1])
+
+        # a differing count is corrected from the database
+        self.q.counts.hide(self.q.find_message(1))
+        with self.assertLogs(level='ERROR'):
+            self.assertFalse(self.q.verify_counts())
+        self.assertEqual(self.q.channel_stats(chan_name),
+                         {'ready': 2, 'hidden': 1})
+
+    @gen_test
+    def test_bulk_touch_delete(self):
+        """Touch and delete a batch of msgs"""
+        chan_name = self.kwargs['chan_name']
+        self.kwargs['timeout'] = 1
+        msg_ids = [self.q.add_message(**self.kwargs) for _ in range(3)]
+        msgs = yield self.q.get_messages(chan_name, 3, nowait=True)
+        yield sleep(0.7)
+        touched = self.q.touch_messages_from_ids(msg_ids[:2] + [1000])
+        self.assertEqual(sorted(touched), msg_ids[:2])
+        yield sleep(0.5)
+        # only the untouched message is shown again
+        self.assertEqual(self.q.channel_stats(chan_name),
+                         {'ready': 1, 'hidden': 2})
+
+        deleted = self.q.delete_messages_from_ids(
+            [m['id'] for m in msgs] + [1000])
+        self.assertEqual(sorted(deleted), msg_ids)
+        self.assertEqual(self.q.channel_stats(chan_name),
+                         {'ready': 0, 'hidden': 0})
+        self.assertEqual(self.q.delete_messages_from_ids(msg_ids), [])
+
     @gen_test
     def test_subscribe_unsubscribe(self):
         """Subscribe and unsubscribe topic"""
@@ -207,6 +371,60 @@ class UnitTestMethods(AsyncTestCase):
         msg2 = yield self.q.get_message(self.kwargs['chan_name'], nowait=True)
         self.assertIsNone(msg2)
 
+    @gen_test
+    def test_publish_shared_body(self):
+        """Publish to many channels, storing the body once"""
+        channels = ['a', 'b', 'c']
+        for chan_name in channels:
+            self.q.add_subscription(chan_name, 'some-topic', priority=0,
+                                    timeout=30, deliver=0, linger=0)
+        published = self.q.publish_message('some-topic', 'shared', 'text/plain')
+        self.assertEqual(sorted(published), channels)
+        yield self.q.durable()
+        self.assertEqual([tuple(r) for r in self.q.db.execute(
+            'select body, refs from bodies')], [('shared', 3)])
+
+        for chan_name in channels:
+            msg = yield self.q.get_message(chan_name, nowait=True)
+            self.assertEqual(msg['body'], 'shared')
+            self.assertEqual(msg['id'], published[chan_name])
+            self.q.delete_message_from_id(msg['id'])
+        yield self.q.durable()
+        self.assertEqual(self.q.db.execute(
+            'select count(*) from bodies').fetchone()[0], 0)
+
+    def test_topic_patterns(self):
+        """Route publishes through exact and wildcard subscriptions"""
+        kw = dict(priority=0, timeout=30, deliver=0, linger=0)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dbfile = os.path.join(tmpdir, 'linger.db')
+            q = self.queue_class(dbfile)
+            q.add_subscription('a', 'orders.*', **kw)
+            q.add_subscription('a', 'orders.new', **kw)
+            q.add_subscription('b', 'orders.**', **kw)
+            q.add_subscription('c', 'orders.new', **kw)
+            self.assertEqual(q.list_topic_subscribers('orders.new'),
+                             ['a', 'b', 'c'])
+            self.assertEqual(q.list_topic_subscribers('orders.**'), ['b'])
+            published = q.publish_message('orders.new', 'x', 'text/plain')
+            self.assertEqual(sorted(published), ['a', 'b', 'c'])
+            self.assertEqual(q.channel_stats('a'), {'ready': 1, 'hidden': 0})
+            published = q.publish_message('orders.eu.new', 'x', 'text/plain')
+            self.assertEqual(sorted(published), ['b'])
+            published = q.publish_message('orders', 'x', 'text/plain')
+            self.assertEqual(sorted(published), ['b'])
+            q.delete_subscription('b', 'orders.**')
+            q.delete_subscription('c', 'orders.new')
+            q.stop()
+
+            # the routing table is rebuilt on restart
+            q = self.queue_class(dbfile)
+            published = q.publish_message('orders.old', 'x', 'text/plain')
+            self.assertEqual(sorted(published), ['a'])
+            with self.assertRaises(ValueError):
+                q.publish_message('orders.*', 'x', 'text/plain')
+            q.stop()
+
     @gen_test
     def test_timeout(self):
         """Timeout test"""
@@ -233,6 +451,206 @@ class UnitTestMethods(AsyncTestCase):
         del msg3['show']
         self.assertEqual(msg, msg3)
 
+    @gen_test
+    def test_timeout_redeliver(self):
+        """Timed out message is redelivered to a waiting listener at the
+        deadline"""
+        self.kwargs['timeout'] = 0.2
+        self.q.add_message(**self.kwargs)
+        msg = yield self.q.get_message(self.kwargs['chan_name'], nowait=True)
+        t0 = time.time()
+        msg2 = yield with_timeout(
+            timedelta(seconds=1), self.q.get_message(self.kwargs['chan_name']))
+        self.assertTrue(time.time() - t0 < 0.5)
+        self.assertEqual(msg['id'], msg2['id'])
+        self.assertEqual(msg2['dcount'], 2)
+
+    @gen_test
+    def test_schedule(self):
+        """Scheduled messages are hidden until due, then delivered to a
+        waiting listener at the deadline"""
+        chan_name = self.kwargs['chan_name']
+        self.q.add_message(**dict(self.kwargs, body='later', delay=0.2))
+        self.q.add_message(**dict(self.kwargs, body='much later',
+                                  not_before=time.time() + 60))
+        self.assertEqual(self.q.channel_stats(chan_name),
+                         {'ready': 0, 'hidden': 2})
+        msg = yield self.q.get_message(chan_name, nowait=True)
+        self.assertIsNone(msg)
+        t0 = time.time()
+        msg = yield with_timeout(
+            timedelta(seconds=1), self.q.get_message(chan_name))
+        self.assertTrue(0.1 < time.time() - t0 < 0.5)
+        self.assertEqual((msg['body'], msg['dcount']), ('later', 1))
+        stats = self.q.server_stats()
+        self.assertEqual((stats['msg-schedule'], stats['msg-due']), (2, 1))
+        self.assertNotIn('msg-timeouts', stats)
+
+        # messages published to a subscription with a delay
+        self.q.add_subscription(chan_name, 'some-topic', 0, 30, 0, 0,
+                                delay=0.1)
+        self.q.publish_message('some-topic', 'published', 'text/plain')
+        msg = yield self.q.get_message(chan_name, nowait=True)
+        self.assertIsNone(msg)
+        msg = yield with_timeout(
+            timedelta(seconds=1), self.q.get_message(chan_name))
+        self.assertEqual(msg['body'], 'published')
+
+        # a touched message is not due when shown again
+        msg_id = self.q.add_message(**dict(self.kwargs, timeout=0.1))
+        self.assertTrue(self.q.touch_message_from_id(msg_id))
+        msg = yield with_timeout(
+            timedelta(seconds=1), self.q.get_message(chan_name))
+        self.assertEqual(msg['id'], msg_id)
+        stats = self.q.server_stats()
+        self.assertEqual((stats['msg-due'], stats['msg-timeouts']), (2, 1))
+
+    @gen_test
+    def test_dead_letter(self):
+        """Messages over the delivery limit, or retention, are moved to the
+        dead-letter channel"""
+        chan_name = self.kwargs['chan_name']
+        self.q.set_dead_letter(chan_name, 'dlq')
+        self.assertEqual(self.q.get_dead_letter(chan_name), 'dlq')
+        with self.assertRaises(ValueError):
+            self.q.set_dead_letter(chan_name, chan_name)
+        msg_id = self.q.add_message(**dict(self.kwargs, timeout=0.1,
+                                           deliver=1))
+        msg = yield self.q.get_message(chan_name, nowait=True)
+        self.assertEqual(msg['id'], msg_id)
+        msg = yield with_timeout(
+            timedelta(seconds=1), self.q.get_message('dlq'))
+        self.assertEqual((msg['id'], msg['channel'], msg['body']),
+                         (msg_id, 'dlq', self.kwargs['body']))
+
+        # the dead-letter channel of the subscription of a published message
+        # (a message without a dead-letter channel is purged)
+        self.q.add_subscription(chan_name, 'some-topic', 0, 30, 0, 0.1,
+                                dead_letter='sub-dlq')
+        self.q.delete_dead_letter(chan_name)
+        self.q.add_message(**dict(self.kwargs, linger=0.1))
+        published = self.q.publish_message('some-topic', 'published',
+                                           'text/plain')
+        msg = yield with_timeout(
+            timedelta(seconds=1), self.q.get_message('sub-dlq'))
+        self.assertEqual(msg['id'], published[chan_name])
+        self.assertEqual(self.q.channel_stats('sub-dlq'),
+                         {'ready': 0, 'hidden': 1})
+        self.assertEqual(self.q.server_stats()['msg-dead-letter'], 2)
+        msg = yield self.q.get_message(chan_name, nowait=True)
+        self.assertIsNone(msg)
+
+    @gen_test
+    def test_dead_letter_limits(self):
+        """The limits of the dead-letter channel apply to moved messages"""
+        chan_name = self.kwargs['chan_name']
+        self.q.set_dead_letter(chan_name, 'dlq')
+        self.q.set_channel_limits('dlq', 1, 0, 'reject')
+        msg_ids = [self.q.add_message(**dict(self.kwargs, linger=0.1))
+                   for _ in range(2)]
+        with self.assertLogs(level='WARNING'):
+            yield sleep(0.5)
+        # the message over the limit is purged
+        self.assertEqual(self.q.channel_stats('dlq'),
+                         {'ready': 1, 'hidden': 0})
+        self.assertEqual(self.q.channel_stats(chan_name),
+                         {'ready': 0, 'hidden': 0})
+
+        # messages are dropped from the dead-letter channel to make room
+        self.q.set_channel_limits('dlq', 1, 0, 'drop-oldest')
+        msg_id = self.q.add_message(**dict(self.kwargs, linger=0.1))
+        yield sleep(0.5)
+        msg = yield self.q.get_message('dlq', nowait=True)
+        self.assertEqual(msg['id'], msg_id)
+        self.assertNotIn(msg['id'], msg_ids)
+        self.assertEqual(self.q.server_stats()['msg-dropped'], 1)
+        self.assertTrue(self.q.verify_counts())
+
+    @gen_test
+    def test_compress(self):
+        """Compress message bodies of at least compress_min_size bytes"""
+        chan_name = self.kwargs['chan_name']
+        self.q.compress_min_size = 100
+        body = json_encode([{'key': 'value', 'n': i} for i in range(100)])
+        for msg_body in (body, 'small', os.urandom(200)):
+            self.q.add_message(**dict(self.kwargs, body=msg_body))
+        msgs = yield self.q.get_messages(chan_name, 3, nowait=True)
+        self.assertEqual([msg['encoding'] for msg in msgs],
+                         ['gzip', None, None])
+        self.assertTrue(len(msgs[0]['body']) < len(body) / 5)
+        self.assertEqual(msgs[0]['size'], len(body))
+        self.assertEqual(linger.decode_body(msgs[0]), utf8(body))
+        self.assertEqual(linger.decode_body(msgs[1]), 'small')
+
+        # a published message is compressed once, for all the channels
+        for chan in ('a', 'b'):
+            self.q.add_subscription(chan, 'some-topic', 0, 30, 0, 0)
+        self.q.publish_message('some-topic', body, 'application/json')
+        for chan in ('a', 'b'):
+            msg = yield self.q.get_message(chan, nowait=True)
+            self.assertEqual(linger.decode_body(msg), utf8(body))
+        self.assertEqual(self.q.server_stats()['msg-compress'], 2)
+
+    @gen_test
+    def test_blobs(self):
+        """Store large message bodies in blob files"""
+        chan_name = self.kwargs['chan_name']
+        self.q.blob_min_size = 1000
+        body = base64.b64encode(os.urandom(1500)).decode()
+        for msg_body in (body, body, 'small'):
+            yield self.q.call('add_message', **dict(
+                self.kwargs, body=msg_body, timeout=0.1))
+        msgs = yield self.q.get_messages(chan_name, 3, nowait=True)
+        self.assertEqual([msg['body'] for msg in msgs], [None, None, 'small'])
+        # (a body added twice is stored once)
+        self.assertEqual(msgs[0]['blob'], msgs[1]['blob'])
+        self.assertTrue(os.path.exists(msgs[0]['blob']))
+        self.assertEqual(linger.decode_body(msgs[0]), utf8(body))
+        self.assertEqual(self.q.server_stats()['msg-blob'], 2)
+
+        # the body is read for a redelivery to a waiting listener
+        msg = yield with_timeout(
+            timedelta(seconds=1), self.q.get_message(chan_name))
+        self.assertEqual(linger.decode_body(msg), utf8(body))
+
+        # unused blob files are removed
+        self.q.delete_message_from_id(msgs[0]['id'])
+        self.q.collect_blobs()
+        self.assertTrue(os.path.exists(msgs[0]['blob']))
+        self.q.delete_message_from_id(msgs[1]['id'])
+        self.q.collect_blobs()
+        self.assertFalse(os.path.exists(msgs[0]['blob']))
+        self.assertEqual(self.q.server_stats()['blob-remove'], 1)
+
+        # the blob file of a rejected message is not written
+        self.q.set_channel_limits('full', 1, 0, 'reject')
+        self.q.add_message(**dict(self.kwargs, chan_name='full'))
+        with self.assertRaises(linger.HighLevelMarkError):
+            self.q.add_message(**dict(self.kwargs, chan_name='full',
+                                      body=body))
+        self.assertEqual([files for _, _, files in os.walk(
+            self.q.blobs.path) if files], [])
+
+    @gen_test
+    def test_listeners(self):
+        """Cancelled and expired listeners are removed"""
+        chan_name = self.kwargs['chan_name']
+        future = self.q.get_message(chan_name)
+        self.assertEqual(len(self.q.channels[chan_name]), 1)
+        # cancel (as when the connection is closed)
+        future.set_result(None)
+        yield sleep(0)
+        self.assertEqual(len(self.q.channels[chan_name]), 0)
+
+        time_out = linger.Listeners.time_out
+        linger.Listeners.time_out = 0.1
+        try:
+            msg = yield self.q.get_message(chan_name)
+        finally:
+            linger.Listeners.time_out = time_out
+        self.assertIsNone(msg)
+        self.assertEqual(len(self.q.channels[chan_name]), 0)
+
     @gen_test
     def test_linger(self):
         """Linger test"""
@@ -307,8 +725,384 @@ class UnitTestMethods(AsyncTestCase):
         self.assertEqual(msg['id'], msg3['id'])
 
 
+    @gen_test
+    def test_group_commit(self):
+        """Writes are committed in groups"""
+        q = self.queue_class(commit_interval=50, commit_max_ops=3)
+        q.add_message(**self.kwargs)
+        future = q.durable()
+        self.assertFalse(future.done())
+        yield future
+        self.assertEqual(q.db.pending, 0)
+
+        # reaching max ops commits right away
+        for _ in range(3):
+            q.add_message(**self.kwargs)
+        self.assertEqual(q.db.pending, 0)
+        self.assertTrue(q.durable().done())
+        q.stop()
+
+    @gen_test
+    def test_migrate(self):
+        """Upgrade the schema of an existing database"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dbfile = os.path.join(tmpdir, 'linger.db')
+            # a database with the initial (unversioned) schema
+            conn = sqlite3.connect(dbfile)
+            conn.execute('create table config (key unique,value)')
+            conn.execute(
+                'create table messages (id integer primary key '
+                'autoincrement, body, mimetype, topic, timeout, priority, '
+                'channel, ts, linger, purge, deliver, dcount, show)')
+            conn.execute(
+                'create table subscriptions (topic,channel,timeout,priority,'
+                'linger,deliver,ts, primary key (topic, channel))')
+            conn.execute("insert into config values ('server_id', 'test')")
+            conn.execute(
+                "insert into messages values (7, 'old', 'text/plain', '', "
+                "30, 0, 'test', ?, 0, 0, 0, 0, 0.0)", (time.time(),))
+            conn.commit()
+            conn.close()
+
+            q = self.queue_class(dbfile)
+            self.assertEqual(q.db.schema_version(), len(q._migrations))
+            self.assertIn('idx_messages_channel',
+                          q.db.table_names(include_indexes=True))
+            msg = yield q.get_message('test', nowait=True)
+            self.assertEqual((msg['id'], msg['body']), (7, 'old'))
+            q.stop()
+
+    @gen_test
+    def test_restore(self):
+        """Restore messages from a database file"""
+        chan_name = self.kwargs['chan_name']
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dbfile = os.path.join(tmpdir, 'linger.db')
+            q = self.queue_class(dbfile)
+            for body in ('1', '2'):
+                self.kwargs['body'] = body
+                q.add_message(**self.kwargs)
+            msg = yield q.get_message(chan_name, nowait=True)
+            self.assertEqual(msg['body'], '1')
+            q.stop()
+
+            q = self.queue_class(dbfile)
+            self.assertEqual(q.channel_stats(chan_name),
+                             {'ready': 1, 'hidden': 1})
+            msg2 = yield q.get_message(chan_name, nowait=True)
+            self.assertEqual(msg2['body'], '2')
+            msg_id = q.add_message(**self.kwargs)
+            self.assertTrue(msg_id > msg2['id'])
+            q.stop()
+
+
+    @gen_test
+    def test_db_profile(self):
+        """Use the performance profile, with WAL checkpoints in a thread"""
+        chan_name = self.kwargs['chan_name']
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dbfile = os.path.join(tmpdir, 'linger.db')
+            q = self.queue_class(dbfile, db_profile='performance')
+            self.assertEqual(q.db.execute('PRAGMA journal_mode').fetchone()[0],
+                             'wal')
+            self.assertEqual(q.db.execute('PRAGMA synchronous').fetchone()[0],
+                             1)
+            for _ in range(3):
+                q.add_message(**self.kwargs)
+            yield q.durable()
+            q.heartbeat()
+            q.db.checkpointing.result()
+            q.stop()
+
+            q = self.queue_class(dbfile)
+            self.assertEqual(q.channel_stats(chan_name),
+                             {'ready': 3, 'hidden': 0})
+            q.stop()
+
+    def test_incremental_vacuum(self):
+        """Free pages are vacuumed from the heartbeat, not on start"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dbfile = os.path.join(tmpdir, 'linger.db')
+            q = self.queue_class(dbfile)
+            q.db.execute('create table filler (data)')
+            q.db.executemany('insert into filler values (?)',
+                             [(b'x' * 10000,) for _ in range(200)])
+            q.db.execute('drop table filler')
+            q.db.flush()
+            q.stop()
+            size = os.path.getsize(dbfile)
+
+            q = self.queue_class(dbfile)
+            self.assertEqual(os.path.getsize(dbfile), size)
+            free = q.db.free_bytes()
+            self.assertGreater(free, 2000000)
+            q.vacuum_free_bytes = free - 1
+            q.vacuum_pages = 100
+            q.heartbeat()
+            self.assertLess(q.db.free_bytes(), free)
+            while q.db.free_bytes():
+                q.heartbeat()
+            self.assertLess(os.path.getsize(dbfile), size - 2000000)
+            self.assertGreater(q.stats['db-vacuum'], 1)
+            q.stop()
+
+    @gen_test
+    def test_db_profile_vacuum(self):
+        """Free pages are vacuumed with the performance profile"""
+        chan_name = self.kwargs['chan_name']
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dbfile = os.path.join(tmpdir, 'linger.db')
+            q = self.queue_class(dbfile, db_profile='performance')
+            self.assertEqual(q.db.execute('PRAGMA auto_vacuum').fetchone()[0],
+                             2)
+            for _ in range(200):
+                q.add_message(**dict(self.kwargs, body=os.urandom(10000)))
+            yield q.durable()
+            q.heartbeat()
+            q.db.checkpointing.result()
+            size = os.path.getsize(dbfile)
+            self.assertGreater(size, 2000000)
+
+            q.drain_channel(chan_name)
+            yield q.durable()
+            q.vacuum_free_bytes = 1
+            q.heartbeat()
+            while q.db.free_bytes():
+                q.heartbeat()
+            q.db.checkpointing.result()
+            q.heartbeat()
+            q.db.checkpointing.result()
+            self.assertLess(os.path.getsize(dbfile), size - 2000000)
+            q.stop()
+
+    @gen_test
+    def test_db_thread(self):
+        """Write to the database from a writer thread"""
+        chan_name = self.kwargs['chan_name']
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dbfile = os.path.join(tmpdir, 'linger.db')
+            q = self.queue_class(dbfile, commit_interval=10, db_thread=True)
+            msg_ids = [q.add_message(**self.kwargs) for _ in range(3)]
+            yield q.durable()
+            conn = sqlite3.connect(dbfile)
+            self.assertEqual(conn.execute(
+                'select count(*) from messages').fetchone()[0], 3)
+            conn.close()
+            q.delete_message_from_id(msg_ids[0])
+            q.stop()
+
+            q = self.queue_class(dbfile, db_thread=True)
+            self.assertEqual(q.channel_stats(chan_name),
+                             {'ready': 2, 'hidden': 0})
+            q.stop()
+
+
+class HeapUnitTestMethods(UnitTestMethods):
+
+    queue_class = linger.HeapLingerQueue
+
+    def test_overflow_heap(self):
+        """The overflow heap of a channel is pruned of deleted messages"""
+        chan_name = self.kwargs['chan_name']
+        msg_ids = [self.q.add_message(**dict(self.kwargs, priority=i % 3))
+                   for i in range(300)]
+        self.q.delete_messages_from_ids(msg_ids[:290])
+        self.q.add_message(**self.kwargs)
+        self.assertLessEqual(len(self.q.overflow_heaps[chan_name]), 86)
+        self.q.set_channel_limits(chan_name, 11, 0, 'drop-lowest')
+        self.q.add_message(**self.kwargs)
+        # the oldest message of the lowest priority is dropped
+        self.assertIsNone(self.q.find_message(msg_ids[290]))
+        self.assertIsNotNone(self.q.find_message(msg_ids[291]))
+        self.assertIsNotNone(self.q.find_message(msg_ids[293]))
+
+    @gen_test
+    def test_publish_blob(self):
+        """A published body in a blob file is not written to the bodies
+        table"""
+        body = base64.b64encode(os.urandom(1500)).decode()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dbfile = os.path.join(tmpdir, 'linger.db')
+            q = self.queue_class(dbfile)
+            q.blob_min_size = 1000
+            for chan in ('a', 'b'):
+                q.add_subscription(chan, 'some-topic', 0, 30, 0, 0)
+            yield q.publish_message('some-topic', body, 'text/plain')
+            yield q.durable()
+            self.assertEqual(q.db.execute(
+                'select count(*) from bodies').fetchone()[0], 0)
+            q.stop()
+
+            q = self.queue_class(dbfile)
+            for chan in ('a', 'b'):
+                msg = yield q.get_message(chan, nowait=True)
+                self.assertEqual(linger.decode_body(msg), utf8(body))
+            q.stop()
+
+
+class LogUnitTestMethods(UnitTestMethods):
+
+    queue_class = linger.LogLingerQueue
+
+    @gen_test
+    def test_publish_shared_body(self):
+        """Publish to many channels, logging the body once"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dbfile = os.path.join(tmpdir, 'linger.db')
+            q = self.queue_class(dbfile)
+            for chan_name in ('a', 'b', 'c'):
+                q.add_subscription(chan_name, 'some-topic', priority=0,
+                                   timeout=30, deliver=0, linger=0)
+            body = 'shared body ' * 100
+            published = q.publish_message('some-topic', body, 'text/plain')
+            self.assertEqual(sorted(published), ['a', 'b', 'c'])
+            yield q.durable()
+            self.assertLess(q.log.size(), 2 * len(body))
+            q.stop()
+
+            q = self.queue_class(dbfile)
+            for chan_name, msg_id in published.items():
+                msg = yield q.get_message(chan_name, nowait=True)
+                self.assertEqual((msg['id'], msg['body']), (msg_id, body))
+            q.stop()
+
+    def test_db_profile_vacuum(self):
+        """Incremental vacuum is enabled with the performance profile (the
+        messages are in the log)"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dbfile = os.path.join(tmpdir, 'linger.db')
+            q = self.queue_class(dbfile, db_profile='performance')
+            self.assertEqual(q.db.execute('PRAGMA auto_vacuum').fetchone()[0],
+                             2)
+            q.stop()
+
+    @gen_test
+    def test_group_commit(self):
+        """Records are written in groups"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dbfile = os.path.join(tmpdir, 'linger.db')
+            q = self.queue_class(dbfile, commit_interval=50,
+                                 commit_max_ops=4)
+            q.add_message(**self.kwargs)
+            future = q.durable()
+            self.assertFalse(future.done())
+            yield future
+            self.assertEqual(q.log.pending, 0)
+
+            # reaching max ops writes right away
+            for _ in range(4):
+                q.add_message(**self.kwargs)
+            self.assertEqual(q.log.pending, 0)
+            self.assertTrue(q.durable().done())
+            q.stop()
+
+    @gen_test
+    def test_db_thread(self):
+        """Write the log from a writer thread"""
+        chan_name = self.kwargs['chan_name']
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dbfile = os.path.join(tmpdir, 'linger.db')
+            q = self.queue_class(dbfile, commit_interval=10, db_thread=True)
+            msg_ids = [q.add_message(**self.kwargs) for _ in range(3)]
+            yield q.durable()
+            self.assertGreater(q.log.size(), 0)
+            q.delete_message_from_id(msg_ids[0])
+            q.stop()
+
+            q = self.queue_class(dbfile, db_thread=True)
+            self.assertEqual(q.channel_stats(chan_name),
+                             {'ready': 2, 'hidden': 0})
+            q.stop()
+
+    @gen_test
+    def test_log_restore(self):
+        """Restore the messages from the log, ignoring a torn record"""
+        chan_name = self.kwargs['chan_name']
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dbfile = os.path.join(tmpdir, 'linger.db')
+            q = self.queue_class(dbfile)
+            msg_ids = [q.add_message(**self.kwargs) for _ in range(4)]
+            msg = yield q.get_message(chan_name)
+            self.assertEqual(msg['id'], msg_ids[0])
+            q.delete_message_from_id(msg_ids[1])
+            q.drain_channel('other')
+            yield q.durable()
+            q.stop()
+            # a partly written record at the end of the log
+            segment = q.log.segment_path(q.log.segment_numbers()[-1])
+            with open(segment, 'ab') as fh:
+                fh.write(linger.MessageLog.header.pack(100, 0) + b'torn')
+
+            q = self.queue_class(dbfile)
+            self.assertEqual(q.channel_stats(chan_name),
+                             {'ready': 2, 'hidden': 1})
+            self.assertEqual(q.find_message(msg_ids[0])['dcount'], 1)
+            self.assertIsNone(q.find_message(msg_ids[1]))
+            # ids are not reused
+            self.assertGreater(q.add_message(**self.kwargs), msg_ids[-1])
+            self.assertTrue(q.verify_counts())
+            q.stop()
+
+    @gen_test
+    def test_log_restore_blobs(self):
+        """Restore messages with the body in a blob file from the log"""
+        chan_name = self.kwargs['chan_name']
+        body = base64.b64encode(os.urandom(1500)).decode()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dbfile = os.path.join(tmpdir, 'linger.db')
+            q = self.queue_class(dbfile)
+            q.blob_min_size = 1000
+            msg_id = yield q.add_message(**dict(self.kwargs, body=body))
+            yield q.durable()
+            q.stop()
+
+            q = self.queue_class(dbfile)
+            msg = yield q.get_message(chan_name, nowait=True)
+            self.assertEqual(msg['id'], msg_id)
+            self.assertEqual(msg['size'], len(body))
+            self.assertEqual(linger.decode_body(msg), utf8(body))
+            q.stop()
+
+    @gen_test
+    def test_log_compaction(self):
+        """Remove log segments without live messages, and copy the few
+        remaining messages of the oldest segment forward
+        """
+        chan_name = self.kwargs['chan_name']
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dbfile = os.path.join(tmpdir, 'linger.db')
+            q = self.queue_class(dbfile)
+            q.log.segment_size = 1000
+            q.compact_max_copy = 1
+            kwargs = dict(self.kwargs, body='x' * 100)
+            del kwargs['chan_name']
+            msg_ids = []
+            for _ in range(10):
+                msg_ids.extend(q.add_messages(chan_name, [kwargs] * 10))
+                yield q.durable()
+            self.assertGreaterEqual(len(q.log.segment_numbers()), 5)
+            for msg_id in msg_ids[1:-1]:
+                q.delete_message_from_id(msg_id)
+            yield q.durable()
+            for _ in range(20):
+                q.heartbeat()
+            yield q.durable()
+            q.log.sync()
+            self.assertLessEqual(len(q.log.segment_numbers()), 2)
+            self.assertGreaterEqual(q.stats['log-msg-copy'], 1)
+            q.stop()
+
+            q = self.queue_class(dbfile)
+            self.assertEqual(q.channel_stats(chan_name),
+                             {'ready': 2, 'hidden': 0})
+            self.assertEqual(sorted(q.messages), [msg_ids[0], msg_ids[-1]])
+            q.stop()
+
+
 class HTTPTestMethods(AsyncHTTPTestCase):
 
+    engine = 'sqlite'
+
     channel = 'test'
     topic = 'some-topic'
 
@@ -319,6 +1113,10 @@ class HTTPTestMethods(AsyncHTTPTestCase):
     messages_url = '/messages/'
 
     def get_app(self):
+        options.engine = self.engine
+        options.stats_check = True
+        options.compress_min_size = 100
+        options.blob_min_size = 10000
         application, self.settings = linger.make_app()
         return application
 
@@ -388,6 +1186,274 @@ class HTTPTestMethods(AsyncHTTPTestCase):
     # Test methods
     #
 
+    def test_batch(self):
+        """Add a batch of messages over HTTP"""
+        body = '\n'.join(json_encode(item) for item in (
+            {'msg': 'first', 'priority': 1},
+            {'msg': '{"a": 1}', 'mimetype': 'application/json'},
+            {'msg': 'last', 'priority': 2}))
+        resp = self.fetch(self.channel_url + '/batch?linger=10',
+                          method='POST', body=body)
+        self.assertEqual(resp.code, 202)
+        ids = json_decode(resp.body)['ids']
+        self.msgs.extend(zip(ids, ('first', '{"a": 1}', 'last')))
+        resp = self.fetch(self.channel_url + '/batch', method='POST',
+                          body='{"msg": "ok"}\n{"priority": 1}')
+        self.assertEqual(resp.code, 400)
+
+        # the second message has the highest priority
+        self.msgs.insert(0, self.msgs.pop(1))
+        for _ in ids:
+            self.delete(self.get(self.channel_url))
+        self.is_clean()
+
+    def test_get_batch(self):
+        """Get a batch of messages over HTTP"""
+        for msg in ('one', 'two', 'three'):
+            self.post(self.channel_url, msg)
+        resp = self.fetch(self.channel_url + '?max=2&nowait')
+        self.assertEqual(resp.code, 200)
+        self.assertEqual(resp.headers['X-LINGER-COUNT'], '2')
+        ctype = resp.headers['Content-Type']
+        self.assertTrue(ctype.startswith('multipart/mixed; boundary='))
+        boundary = ctype.split('=', 1)[1].encode()
+        parts = resp.body.split(b'--' + boundary)
+        self.assertEqual(parts[0], b'')
+        self.assertEqual(parts[-1], b'--\r\n')
+        for part in parts[1:-1]:
+            head, body = part.strip(b'\r\n').split(b'\r\n\r\n', 1)
+            headers = dict(line.split(b': ', 1)
+                           for line in head.split(b'\r\n'))
+            msg_id, msg = self.msgs.pop(0)
+            self.assertEqual(int(headers[b'x-linger-msg-id']), msg_id)
+            self.assertEqual(body.decode(), msg)
+            self.delete(msg_id)
+        for params in ('?max=x', '?max=-1', '?max=1.5'):
+            resp = self.fetch(self.channel_url + params)
+            self.assertEqual(resp.code, 400)
+
+        # the batch size is capped at batch_max_size
+        self._app.settings['batch_max_size'] = 2
+        for msg in ('four', 'five', 'six'):
+            self.post(self.channel_url, msg)
+        resp = self.fetch(self.channel_url + '?max=1000&nowait')
+        self.assertEqual(resp.headers['X-LINGER-COUNT'], '2')
+        for _ in range(2):
+            self.delete(self.msgs.pop(0)[0])
+        for _ in range(2):
+            self.delete(self.get(self.channel_url))
+        self.is_clean()
+
+    @gen_test
+    def test_get_batch_fill(self):
+        """Fill a batch of messages, until the batch is full or the client
+        disconnects"""
+        url = self.get_url(self.channel_url)
+        yield self.http_client.fetch(url, method='POST', body='one')
+        t0 = time.time()
+        future = self.http_client.fetch(url + '?max=2&fill=5')
+        yield sleep(0.2)
+        yield self.http_client.fetch(url, method='POST', body='two')
+        resp = yield future
+        self.assertTrue(time.time() - t0 < 1)
+        self.assertEqual(resp.headers['X-LINGER-COUNT'], '2')
+
+        # no messages are taken after the client disconnected
+        yield self.http_client.fetch(url, method='POST', body='three')
+        with self.assertRaises(HTTPClientError):
+            yield self.http_client.fetch(url + '?max=2&fill=1',
+                                         request_timeout=0.2)
+        yield self.http_client.fetch(url, method='POST', body='four')
+        yield sleep(1)
+        resp = yield self.http_client.fetch(self.get_url('/stats'))
+        stats = json_decode(resp.body)
+        self.assertEqual((stats['current-messages-hidden'],
+                          stats['current-messages-ready']), (3, 1))
+
+    def test_bulk_delete(self):
+        """Delete a batch of messages over HTTP"""
+        for msg in ('one', 'two'):
+            self.post(self.channel_url, msg)
+        ids = [msg_id for msg_id, _ in self.msgs]
+        resp = self.fetch(self.messages_url + 'touch', method='POST',
+                          body=json_encode({'ids': ids}))
+        self.assertEqual(resp.code, 200)
+        self.assertEqual(json_decode(resp.body),
+                         {'touched': ids, 'not-found': []})
+        resp = self.fetch(self.messages_url + 'delete', method='POST',
+                          body=json_encode({'ids': ids + [1000]}))
+        self.assertEqual(resp.code, 200)
+        self.assertEqual(json_decode(resp.body),
+                         {'deleted': ids, 'not-found': [1000]})
+        resp = self.fetch(self.messages_url + 'delete', method='POST',
+                          body=json_encode({'ids': ['x']}))
+        self.assertEqual(resp.code, 400)
+        self.is_clean()
+
+    def test_longpoll_closed(self):
+        """A message is not lost to a closed long-poll"""
+        with self.assertRaises(HTTPClientError):
+            self.fetch(self.channel_url, request_timeout=0.5)
+        self.io_loop.run_sync(lambda: sleep(0.1))
+        self.post(self.channel_url, 'one')
+        msg_id = self.get(self.channel_url + '?nowait')
+        self.delete(msg_id)
+        self.is_clean()
+
+    @gen_test
+    def test_stream(self):
+        """Stream messages over a WebSocket, with prefetch and acks"""
+        for body in ('one', 'two', 'three'):
+            yield self.http_client.fetch(self.get_url(self.channel_url),
+                                         method='POST', body=body)
+        url = self.get_url(self.channel_url + '/stream?prefetch=2')
+        conn = yield websocket_connect('ws' + url[4:])
+        msg_ids = []
+        for body in (b'one', b'two'):
+            frame = yield conn.read_message()
+            headers, _, msg = frame.partition(b'\r\n\r\n')
+            self.assertEqual(msg, body)
+            msg_ids.append(int(dict(
+                line.split(': ', 1) for line in headers.decode().split(
+                    '\r\n'))['x-linger-msg-id']))
+        # no more messages are delivered until one is acked
+        yield sleep(0.2)
+        resp = yield self.http_client.fetch(self.get_url('/stats'))
+        self.assertEqual(json_decode(resp.body)['current-messages-hidden'], 2)
+        conn.write_message(json_encode({'ack': msg_ids[:1]}))
+        reply = yield conn.read_message()
+        self.assertEqual(json_decode(reply),
+                         {'deleted': msg_ids[:1], 'not-found': []})
+        frame = yield conn.read_message()
+        self.assertTrue(frame.endswith(b'\r\n\r\nthree'))
+        conn.close()
+        yield sleep(0.1)
+        resp = yield self.http_client.fetch(self.get_url('/stats'))
+        stats = json_decode(resp.body)
+        self.assertEqual(stats['current-messages'], 2)
+        self.assertEqual(stats['current-messages-hidden'], 2)
+
+    def test_schedule(self):
+        """Add scheduled messages, and subscribe with a delay"""
+        self.post(self.channel_url, 'later', '?delay=60')
+        self.post(self.channel_url, 'later', '?not_before={}'.format(
+            time.time() + 60))
+        resp = self.fetch(self.channel_url + '?nowait')
+        self.assertEqual(resp.code, 204)
+        for params in ('?delay=-1', '?delay=inf', '?not_before=x'):
+            resp = self.fetch(self.channel_url + params, method='POST',
+                              body=self.e('msg'))
+            self.assertEqual(resp.code, 400)
+        resp = self.fetch(self.subscribe_url + '?not_before=1', method='PUT',
+                          body='')
+        self.assertEqual(resp.code, 400)
+        self.sub(self.subscribe_url, '?delay=60')
+        self.unsub(self.subscribe_url)
+        for msg_id, _ in self.msgs:
+            self.delete(msg_id)
+
+    def test_dead_letter(self):
+        """Set, get and remove the dead-letter channel"""
+        dead_letter_url = self.channel_url + '/dead-letter'
+        # ('dlq' is in the shard of the channel, with 3 shards)
+        resp = self.fetch(dead_letter_url + '?channel=dlq', method='PUT',
+                          body='')
+        self.assertEqual(resp.code, 204)
+        resp = self.fetch(dead_letter_url)
+        self.assertEqual(json_decode(resp.body), {'channel': 'dlq'})
+        for params in ('', '?channel=' + self.channel):
+            resp = self.fetch(dead_letter_url + params, method='PUT',
+                              body='')
+            self.assertEqual(resp.code, 400)
+        resp = self.fetch(dead_letter_url, method='DELETE')
+        self.assertEqual(resp.code, 204)
+        resp = self.fetch(dead_letter_url)
+        self.assertEqual(json_decode(resp.body), {'channel': None})
+
+        self.sub(self.subscribe_url, '?dead_letter=dlq')
+        self.unsub(self.subscribe_url)
+
+    def test_compress(self):
+        """Deliver a compressed body as is, or decompressed"""
+        body = json_encode([{'key': 'value', 'n': i} for i in range(100)])
+        self.post(self.channel_url, body)
+        self.post(self.channel_url, body)
+        # (the client accepts gzip, and decompresses the response)
+        resp = self.fetch(self.channel_url + '?nowait')
+        self.assertEqual(resp.headers['X-Consumed-Content-Encoding'], 'gzip')
+        self.assertEqual(resp.body.decode(), body)
+        self.delete(resp.headers['X-LINGER-MSG-ID'])
+        resp = self.fetch(self.channel_url + '?nowait',
+                          decompress_response=False)
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertEqual(resp.body.decode(), body)
+        self.delete(resp.headers['X-LINGER-MSG-ID'])
+
+    def test_blobs(self):
+        """Stream a body stored in a blob file"""
+        body = base64.b64encode(os.urandom(30000)).decode()
+        for _ in range(3):
+            self.post(self.channel_url, body)
+        resp = self.fetch(self.channel_url + '?nowait')
+        self.assertEqual(resp.headers['X-Consumed-Content-Encoding'], 'gzip')
+        self.assertEqual(resp.body.decode(), body)
+        self.delete(resp.headers['X-LINGER-MSG-ID'])
+        resp = self.fetch(self.channel_url + '?nowait',
+                          decompress_response=False)
+        self.assertEqual(int(resp.headers['Content-Length']), len(body))
+        self.assertEqual(resp.body.decode(), body)
+        self.delete(resp.headers['X-LINGER-MSG-ID'])
+        resp = self.fetch(self.channel_url + '?nowait&max=2')
+        self.assertIn(utf8(body), resp.body)
+        self.delete(self.msgs[-1][0])
+
+    def test_limits(self):
+        """Set, get and remove channel limits"""
+        limits_url = self.channel_url + '/limits'
+        resp = self.fetch(limits_url + '?max_messages=1&overflow=drop-oldest',
+                          method='PUT', body='')
+        self.assertEqual(resp.code, 204)
+        self.post(self.channel_url, 'one')
+        self.post(self.channel_url, 'two')
+        self.msgs.pop(0)
+        resp = self.fetch(limits_url)
+        self.assertEqual(resp.code, 200)
+        data = json_decode(resp.body)
+        self.assertEqual((data['max-messages'], data['overflow'],
+                          data['messages'], data['bytes']),
+                         (1, 'drop-oldest', 1, 3))
+        self.delete(self.get(self.channel_url + '?nowait'))
+
+        for params in ('?max_messages=-1', '?max_bytes=x',
+                       '?overflow=unknown'):
+            resp = self.fetch(limits_url + params, method='PUT', body='')
+            self.assertEqual(resp.code, 400)
+        resp = self.fetch(limits_url, method='DELETE')
+        self.assertEqual(resp.code, 204)
+        resp = self.fetch(limits_url)
+        self.assertTrue(json_decode(resp.body)['default'])
+
+    def test_metrics(self):
+        """Get metrics in the Prometheus text format"""
+        self.post(self.channel_url, 'one')
+        resp = self.fetch(self.channel_url + '?nowait')
+        self.assertEqual(resp.code, 200)
+        resp = self.fetch('/metrics')
+        self.assertEqual(resp.code, 200)
+        lines = resp.body.decode().splitlines()
+        self.assertIn('linger_msg_add_total 1', lines)
+        self.assertIn('linger_channel_messages{channel="test",state="hidden"} '
+                      '1', lines)
+        self.assertIn('linger_delivery_latency_seconds_count'
+                      '{channel="test"} 1', lines)
+        self.assertIn('# TYPE linger_request_duration_seconds histogram',
+                      lines)
+        if self.engine != 'memory-log':
+            # (messages are not written to the database with a log)
+            self.assertTrue(any(line.startswith(
+                'linger_sql_duration_seconds_count{statement="update '
+                'messages"}') for line in lines))
+
     def test_all(self):
         """Run some simple HTTP tests.
 
@@ -429,10 +1495,166 @@ class HTTPTestMethods(AsyncHTTPTestCase):
         self.is_clean()
 
 
+class HeapHTTPTestMethods(HTTPTestMethods):
+
+    engine = 'memory-heap'
+
+
+class LogHTTPTestMethods(HTTPTestMethods):
+
+    engine = 'memory-log'
+
+
+class WorkerHTTPTestMethods(HTTPTestMethods):
+    """HTTP tests with the queue served to the handlers by a QueueServer"""
+
+    def get_app(self):
+        options.engine = self.engine
+        options.stats_check = True
+        options.compress_min_size = 100
+        options.blob_min_size = 10000
+        queue = linger.make_queue()
+        queue_server = workers.QueueServer(queue)
+        tmpdir = tempfile.TemporaryDirectory()
+        path = os.path.join(tmpdir.name, 'queue.sock')
+        queue_server.add_socket(bind_unix_socket(path))
+        proxy = workers.QueueProxy(path)
+        self.io_loop.run_sync(proxy.connect)
+        application, self.settings = linger.make_app(proxy)
+
+        def shutdown():
+            proxy.stop()
+            queue_server.stop()
+            queue.stop()
+            tmpdir.cleanup()
+        self.settings['shutdown_callback'] = shutdown
+        return application
+
+
+class ShardedHTTPTestMethods(HTTPTestMethods):
+    """HTTP tests with the channels partitioned across queue shards"""
+
+    def get_app(self):
+        options.engine = self.engine
+        options.stats_check = True
+        options.compress_min_size = 100
+        options.blob_min_size = 10000
+        tmpdir = tempfile.TemporaryDirectory()
+        queues, servers, proxies = [], [], []
+        for i in range(3):
+            queues.append(linger.make_queue())
+            servers.append(workers.QueueServer(queues[-1]))
+            path = os.path.join(tmpdir.name, 'shard-{}.sock'.format(i))
+            servers[-1].add_socket(bind_unix_socket(path))
+            proxies.append(workers.QueueProxy(path))
+            self.io_loop.run_sync(proxies[-1].connect)
+        self.sharded = workers.ShardedQueue(proxies)
+        self.io_loop.run_sync(self.sharded.sync_routes)
+        application, self.settings = linger.make_app(self.sharded)
+
+        def shutdown():
+            self.sharded.stop()
+            for server, queue in zip(servers, queues):
+                server.stop()
+                queue.stop()
+            tmpdir.cleanup()
+        self.settings['shutdown_callback'] = shutdown
+        return application
+
+    def test_shard_dead_letter(self):
+        """The dead-letter channel must be in the shard of the channel"""
+        resp = self.fetch(self.channel_url + '/dead-letter?channel=dead',
+                          method='PUT', body='')
+        self.assertEqual(resp.code, 400)
+        resp = self.fetch(self.subscribe_url + '?dead_letter=dead',
+                          method='PUT', body='')
+        self.assertEqual(resp.code, 400)
+
+    def test_shard_ids(self):
+        chans = ['chan{}'.format(i) for i in range(12)]
+        shards = {self.sharded.shard_index(chan) for chan in chans}
+        self.assertEqual(shards, {0, 1, 2})
+        msg_ids = {}
+        for chan in chans:
+            response = self.fetch('/channels/{}'.format(chan),
+                                  method='POST', body='hello')
+            self.assertEqual(response.code, 202)
+            msg_id = json_decode(response.body)['id']
+            self.assertEqual(msg_id % 3, self.sharded.shard_index(chan))
+            msg_ids[chan] = msg_id
+        self.assertEqual(len(set(msg_ids.values())), len(chans))
+        stats = json_decode(self.fetch('/stats').body)
+        self.assertEqual(stats['shards'], 3)
+        self.assertEqual(stats['current-messages'], len(chans))
+        self.assertEqual(stats['msg-max-id'], max(msg_ids.values()))
+        for chan, msg_id in msg_ids.items():
+            response = self.fetch('/channels/{}?nowait'.format(chan))
+            self.assertEqual(response.code, 200)
+            self.assertEqual(int(response.headers['x-linger-msg-id']), msg_id)
+            response = self.fetch('/messages/{}'.format(msg_id),
+                                  method='DELETE')
+            self.assertEqual(response.code, 204)
+        stats = json_decode(self.fetch('/stats').body)
+        self.assertEqual(stats['current-messages'], 0)
+
+    @gen_test
+    def test_shard_publish(self):
+        """Topic publishes are sent to the shards of the subscribed channels
+        """
+        calls = []
+
+        def counted(index, call):
+            def wrapper(method, *args, **kwargs):
+                calls.append((index, method))
+                return call(method, *args, **kwargs)
+            return wrapper
+        for index, shard in enumerate(self.sharded.shards):
+            shard.call = counted(index, shard.call)
+
+        chans = ['chan{}'.format(i) for i in range(12)]
+        a = chans[0]
+        b = next(chan for chan in chans if self.sharded.shard_index(chan)
+                 != self.sharded.shard_index(a))
+        yield self.sharded.call('add_subscription', a, 'news.sport', 0, 30,
+                                0, 0)
+        yield self.sharded.call('add_subscription', b, 'news.*', 0, 30, 0, 0)
+        del calls[:]
+        published = yield self.sharded.call('publish_message', 'news.sport',
+                                            'goal', 'text/plain')
+        self.assertEqual(sorted(published), sorted([a, b]))
+        self.assertEqual(
+            sorted(index for index, method in calls
+                   if method == 'publish_message'),
+            sorted([self.sharded.shard_index(a), self.sharded.shard_index(b)]))
+        del calls[:]
+        yield self.sharded.call('durable', list(published))
+        self.assertEqual(len(calls), 2)
+
+        # the routes are kept in memory, and added by the workers on start
+        for shard in self.sharded.shards:
+            routes = yield shard.call('list_subscriptions')
+            yield self.sharded.broadcast('delete_routes', routes)
+        published = yield self.sharded.call('publish_message', 'news.sport',
+                                            'lost', 'text/plain')
+        self.assertEqual(published, {})
+        yield self.sharded.sync_routes()
+        published = yield self.sharded.call('publish_message', 'news.sport',
+                                            'goal', 'text/plain')
+        self.assertEqual(sorted(published), sorted([a, b]))
+
+        # and deleted with the subscriptions
+        yield self.sharded.call('delete_subscription', b, 'news.*')
+        published = yield self.sharded.call('publish_message', 'news.sport',
+                                            'goal', 'text/plain')
+        self.assertEqual(list(published), [a])
+
+
 def all():
     tests = unittest.defaultTestLoader.loadTestsFromTestCase(UnitTestMethods)
-    tests.addTests(
-        unittest.defaultTestLoader.loadTestsFromTestCase(HTTPTestMethods))
+    for case in (HeapUnitTestMethods, LogUnitTestMethods, HTTPTestMethods,
+                 HeapHTTPTestMethods, LogHTTPTestMethods,
+                 WorkerHTTPTestMethods, ShardedHTTPTestMethods):
+        tests.addTests(unittest.defaultTestLoader.loadTestsFromTestCase(case))
     return tests
 
 